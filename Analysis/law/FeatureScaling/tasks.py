@@ -9,12 +9,12 @@ import glob
 import shutil
 import yaml
 
-from framework import Task, HTCondorWorkflow
+from framework import Task, HTCondorWorkflow, LocalParallelWorkflow
 import luigi
 sys.path.append('{}/../../../Training/python'.format(os.path.dirname(os.path.abspath(__file__))))
 from feature_scaling import run_scaling as run_job
 
-class FeatureScaling(Task, HTCondorWorkflow, law.LocalWorkflow):
+class FeatureScaling(Task, HTCondorWorkflow, LocalParallelWorkflow, law.LocalWorkflow):
   ## '_' will be converted to '-' for the shell command invocation
   cfg           = luigi.Parameter(description = 'location of the input yaml configuration file')
   var_types     = luigi.Parameter(default = "-1", description = 'variable types from field "Features_all" of the cfg file for which to derive scaling parameters. Defaults to -1 for running on all those specified in the cfg')
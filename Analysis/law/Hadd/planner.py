@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+## Planning of the HaddFiles batches. Can be run standalone to preview the batches (dry-run):
+##   python Hadd/planner.py --input-path /path/to/tuples --output-size 10
+
+import os
+
+class InputFile:
+  def __init__(self, path, size):
+    self.path = path
+    self.size = size
+
+class FileBatch:
+  def __init__(self, dataset):
+    self.files = []
+    self.dataset = dataset
+  def size(self):
+    return sum([ff.size for ff in self.files])
+
+def list_datasets(input_path):
+  datasets = sorted([fol for fol in os.listdir(input_path) if os.path.isdir('/'.join([input_path, fol]))])
+  dataset_files = {}
+  for ds in datasets:
+    dataset_path = '/'.join([input_path, ds])
+    files = sorted(['/'.join([dataset_path, fil]) for fil in os.listdir(dataset_path) if os.path.isfile('/'.join([dataset_path, fil]))])
+    dataset_files[ds] = [InputFile(path = ff, size = os.path.getsize(ff)) for ff in files]
+  return dataset_files
+
+def pack_sequential(dataset, files, max_size):
+  ## files are added in the listing order, a new batch is started once the size of the current one exceeds max_size
+  batches = [FileBatch(dataset = dataset)]
+  for ff in files:
+    if batches[-1].size() > max_size:
+      batches.append(FileBatch(dataset = dataset))
+    batches[-1].files.append(ff)
+  return batches
+
+def pack_ffd(dataset, files, max_size):
+  ## the number of batches is given by the first-fit-decreasing bin packing.
+  ## Then, the files are redistributed in the decreasing order of size to the least filled batch that can fit them,
+  ## which results in batches of similar sizes. Files larger than max_size are placed in separate batches.
+  ordered = sorted(files, key = lambda ff: (-ff.size, ff.path))
+  free_space = []
+  for ff in ordered:
+    for ii, space in enumerate(free_space):
+      if ff.size <= space:
+        free_space[ii] -= ff.size
+        break
+    else:
+      free_space.append(max_size - ff.size)
+  n_batches = max(len(free_space), 1)
+
+  batches = [FileBatch(dataset = dataset) for _ in range(n_batches)]
+  sizes = [0] * n_batches
+  for ff in ordered:
+    ii = min(range(len(batches)), key = lambda jj: sizes[jj])
+    if sizes[ii] > 0 and sizes[ii] + ff.size > max_size:
+      batches.append(FileBatch(dataset = dataset))
+      sizes.append(0)
+      ii = len(batches) - 1
+    batches[ii].files.append(ff)
+    sizes[ii] += ff.size
+  for batch in batches:
+    batch.files.sort(key = lambda ff: ff.path)
+  return [batch for batch in batches if len(batch.files)]
+
+def plan_batches(input_path, output_size, packing = 'ffd'):
+  """Splits the files of each dataset into batches of at most output_size GB. Files of different datasets are never
+  merged together. Returns the list of batches ordered by dataset."""
+  pack = {'ffd': pack_ffd, 'sequential': pack_sequential}[packing]
+  batches = []
+  for ds, files in list_datasets(input_path).items():
+    if len(files):
+      batches.extend(pack(ds, files, output_size*1.e+9))
+  return batches
+
+def print_plan(batches):
+  print('{:>6} {:<50} {:>8} {:>12}'.format('branch', 'dataset', 'n_files', 'size [GB]'))
+  for ii, batch in enumerate(batches):
+    print('{:>6} {:<50} {:>8} {:>12.3f}'.format(ii, batch.dataset, len(batch.files), batch.size()*1.e-9))
+  sizes = [batch.size()*1.e-9 for batch in batches]
+  if len(sizes):
+    print('{} batches, predicted output size [GB]: min = {:.3f}, mean = {:.3f}, max = {:.3f}, total = {:.3f}'.format(
+      len(sizes), min(sizes), sum(sizes) / len(sizes), max(sizes), sum(sizes)))
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser('Preview of the HaddFiles batches. The output size is predicted as the sum of the input file sizes.')
+  parser.add_argument('--input-path' , required = True, type = str, help = 'input path with tuples for all the samples')
+  parser.add_argument('--output-size', default  = 10. , type = float, help = 'output file size in GB')
+  parser.add_argument('--packing'    , default  = 'ffd', choices = ['ffd', 'sequential'], help = 'batch packing algorithm')
+  args = parser.parse_args()
+
+  print_plan(plan_batches(args.input_path, args.output_size, args.packing))
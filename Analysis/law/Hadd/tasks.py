@@ -7,42 +7,26 @@ import os
 import re
 import sys
 
-from framework import Task, HTCondorWorkflow
+from framework import Task, HTCondorWorkflow, LocalParallelWorkflow
+from Hadd.planner import plan_batches
 import luigi
 
-class HaddFiles(Task, HTCondorWorkflow, law.LocalWorkflow):
-  class InputFile:
-    def __init__(self, path, size):
-      self.path = path
-      self.size = size
-  class FileBatch:
-    def __init__(self, dataset):
-      self.files = []
-      self.dataset = dataset
-    def size(self):
-      return sum([ff.size for ff in self.files])
-
+class HaddFiles(Task, HTCondorWorkflow, LocalParallelWorkflow, law.LocalWorkflow):
   ## '_' will be converted to '-' for the shell command invocation
   input_path  = luigi.Parameter(description = 'input path with tuples for all the samples')
   output_path = luigi.Parameter(description = 'output directory')
   output_size = luigi.FloatParameter(description = 'output file size in GB', default = 10.)
+  packing     = luigi.ChoiceParameter(default = 'ffd', choices = ['ffd', 'sequential'], var_type = str,
+    description = 'ffd: balanced batches from first-fit-decreasing bin packing of each dataset; '
+                  'sequential: files are added in the listing order until output_size is exceeded')
+  hadd_jobs   = luigi.IntParameter(default = 1, significant = False,
+    description = 'number of parallel processes used by hadd (hadd -j)')
 
   def create_branch_map(self):
-    batches = []
-    datasets = [fol for fol in os.listdir(self.input_path) if os.path.isdir('/'.join([self.input_path, fol]))]
-    for ds in datasets:
+    batches = plan_batches(self.input_path, self.output_size, self.packing)
+    for ds in set(batch.dataset for batch in batches):
       if not os.path.exists('/'.join([self.output_path, ds])):
-        os.mkdir('/'.join([self.output_path, ds]))
-
-      batches.append(self.FileBatch(dataset = ds))
-
-      dataset_path  = '/'.join([self.input_path, ds])
-      dataset_files = ['/'.join([dataset_path, fil]) for fil in os.listdir(dataset_path) if os.path.isfile('/'.join([dataset_path, fil]))]
-
-      for ff in dataset_files:
-        if batches[-1].size() > self.output_size*1.e+9:
-          batches.append(self.FileBatch(dataset = ds))
-        batches[-1].files.append(self.InputFile(path = ff, size = os.path.getsize(ff)))
+        os.makedirs('/'.join([self.output_path, ds]))
 
     return dict(enumerate(batches))
 
@@ -51,13 +35,14 @@ class HaddFiles(Task, HTCondorWorkflow, law.LocalWorkflow):
 
   def run(self):
     quote = lambda x: str('\"{}\"'.format(str(x)))
-    command = 'hadd -O -ff -k {OUT} {IN}'.format(
+    command = 'hadd {JOBS}-O -ff -k {OUT} {IN}'.format(
+      JOBS = '-j {} '.format(self.hadd_jobs) if self.hadd_jobs > 1 else '',
       OUT = '/'.join([self.output_path, self.branch_data.dataset, 'HaddFile_{}.root'.format(self.branch)]),
       IN  = ' '.join([ff.path for ff in self.branch_data.files])
     )
 
     print ('>> {}'.format(command))
-    proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
     stdout, stderr = proc.communicate()
 
     sys.stdout.write(stdout + '\n')
@@ -8,10 +8,10 @@ import re
 import sys
 import shutil
 
-from framework import Task, HTCondorWorkflow
+from framework import Task, HTCondorWorkflow, LocalParallelWorkflow
 import luigi
 
-class ShuffleMergeFlat(Task, HTCondorWorkflow, law.LocalWorkflow):
+class ShuffleMergeFlat(Task, HTCondorWorkflow, LocalParallelWorkflow, law.LocalWorkflow):
     ## '_' will be converted to '-' for the shell command invocation
     cfg               = luigi.Parameter(description = 'configuration file with the list of input sources')
     input_path        = luigi.Parameter(description = 'Input txt file with the list of files to read.')
@@ -50,12 +50,16 @@ class ShuffleMergeFlat(Task, HTCondorWorkflow, law.LocalWorkflow):
     def run(self):
         self.output_dir = '/'.join([self.output_path, 'tmp'])
         file_name   = '_'.join(['ShuffleMergeFlat', str(self.branch)]) + '.root'
-        output_name = '/'.join([self.output_dir, file_name])
+        output_name = os.path.abspath('/'.join([self.output_dir, file_name]))
+        ## each branch runs in its own working directory, where the hash tables are stored (./out)
+        work_dir    = os.path.abspath('job_{}'.format(self.branch))
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
 
         quote = lambda x: str('\"{}\"'.format(str(x)))
         command = ' '.join(['ShuffleMergeFlat',
-            '--cfg'               , str(self.cfg)             ,
-            '--input'             , str(self.input_path)      ,
+            '--cfg'               , os.path.abspath(str(self.cfg)),
+            '--input'             , os.path.abspath(str(self.input_path)),
             '--output'            , output_name               ,
             '--n-jobs'            , str(self.n_jobs)          ,
             '--job-idx'           , str(self.branch_data)     ] +\
@@ -69,7 +73,7 @@ class ShuffleMergeFlat(Task, HTCondorWorkflow, law.LocalWorkflow):
             ['--file-entries'     , str(self.file_entries)            ] * (not self.file_entries       is ''))
 
         print ('>> {}'.format(command))
-        proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE, cwd = work_dir)
         stdout, stderr = proc.communicate()
 
         sys.stdout.write(str(stdout) + '\n')
@@ -81,7 +85,8 @@ class ShuffleMergeFlat(Task, HTCondorWorkflow, law.LocalWorkflow):
             raise Exception('job {} return code is {}'.format(self.branch, retcode))
         else:
             self.move(os.path.abspath(output_name), os.path.abspath('/'.join([self.output_dir, '..', file_name])))
-            self.move(os.path.abspath('./out'    ), os.path.abspath('/'.join([self.output_dir, '..', 'hashes', 'out_{}'.format(self.branch)])))
+            self.move('/'.join([work_dir, 'out']), os.path.abspath('/'.join([self.output_dir, '..', 'hashes', 'out_{}'.format(self.branch)])))
+            shutil.rmtree(work_dir)
             print('Output file and hash tables moved to {}\n'.format(os.path.abspath('/'.join([self.output_dir, '..']))))
             taskout = self.output()
             taskout.dump('Task ended with code %s\n' %retcode)
\ No newline at end of file
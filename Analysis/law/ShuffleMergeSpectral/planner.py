@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+## Cost model of the ShuffleMergeSpectral jobs.
+## The entries of each data group are split between jobs by ShuffleMergeSpectral.cxx (sumBasedSplit).
+## The planner mirrors this split to compute, for each job, the number of entries read, the number of input files opened
+## and the expected number of entries written (from the spectrum of each dataset and the uniform target spectrum).
+## The predicted runtime is a linear combination of these features, which coefficients can be calibrated on the
+## runtime records of previous productions. Can be run standalone:
+##   python ShuffleMergeSpectral/planner.py plan --cfg ... --input ... --input-spec ... --pt-bins ... --eta-bins ...
+##   python ShuffleMergeSpectral/planner.py calibrate --records /path/to/output/runtime
+
+import glob
+import json
+import os
+import re
+import sys
+import numpy as np
+
+FEATURES = ['entries', 'files', 'output_entries']
+DEFAULT_COSTS = {'entries': 2.e-4, 'files': 2., 'output_entries': 1.e-3}
+
+def parse_bins(bins_str):
+  return np.array([float(x) for x in str(bins_str).split(',') if len(x.strip())])
+
+def read_cfg_groups(cfg):
+  ## each line has a form 'name: key=value key=value ...'
+  groups = []
+  with open(cfg, 'r') as f:
+    for line in f:
+      line = line.split('#')[0].strip()
+      if not len(line): continue
+      name, desc = line.split(':', 1)
+      items = dict(re.findall(r'(\w+)=(\S+)', desc))
+      groups.append({'name': name.strip(), 'dir': items['dir'], 'file': items['file'], 'types': items['types'].split(',')})
+  return groups
+
+def read_input_list(input_path):
+  ## each line has a form 'path/to/dataset_dir/file_name n_entries'
+  files = []
+  with open(input_path, 'r') as f:
+    for line in f:
+      line = line.rstrip('\n')
+      if not len(line.strip()): continue
+      path, n_entries = line.rsplit(' ', 1)
+      dir_name, file_name = path.split('/')[-2:]
+      files.append((dir_name, file_name, int(float(n_entries))))
+  return files
+
+def group_files(groups, files):
+  grouped = {}
+  for group in groups:
+    dir_pattern, file_pattern = re.compile(group['dir']), re.compile(group['file'])
+    matched = [ff for ff in files if dir_pattern.fullmatch(ff[0]) and file_pattern.fullmatch(ff[1])]
+    if not len(matched):
+      raise RuntimeError("No files are found for entry '{}' with pattern '{}'".format(group['name'], group['file']))
+    grouped[group['name']] = matched
+  return grouped
+
+def output_fraction(spectrum_dir, datasets, types, n_entries, pt_bins, eta_bins):
+  """Expected fraction of the read entries that are written to the output.
+  With the uniform target spectrum, the acceptance probability in each (eta, pt) bin is min(entries) / entries(bin),
+  hence the expected number of accepted taus of each type is n_bins * min(entries)."""
+  import uproot
+  n_accepted = 0.
+  for tau_type in types:
+    entries = np.zeros((len(eta_bins) - 1, len(pt_bins) - 1))
+    for ds in datasets:
+      with uproot.open(os.path.join(spectrum_dir, ds + '.root')) as f:
+        values, eta_edges, pt_edges = f['eta_pt_hist_{}'.format(tau_type)].to_numpy()
+      eta_idx = np.searchsorted(eta_bins, (eta_edges[1:] + eta_edges[:-1]) / 2, side = 'right') - 1
+      pt_idx  = np.searchsorted(pt_bins , (pt_edges[1:]  + pt_edges[:-1])  / 2, side = 'right') - 1
+      eta_ok = (eta_idx >= 0) & (eta_idx < entries.shape[0])
+      pt_ok  = (pt_idx  >= 0) & (pt_idx  < entries.shape[1])
+      np.add.at(entries, np.ix_(eta_idx[eta_ok], pt_idx[pt_ok]), values[np.ix_(eta_ok, pt_ok)])
+    non_empty = entries[entries > 0]
+    if len(non_empty):
+      n_accepted += entries.size * non_empty.min()
+  return min(n_accepted / max(n_entries, 1), 1.)
+
+def job_features(grouped_files, output_fractions, n_jobs, overflow_job = False):
+  """Returns an array [n_jobs, len(FEATURES)] with the features of each job, following sumBasedSplit."""
+  features = np.zeros((n_jobs, len(FEATURES)))
+  job_idx = np.arange(n_jobs)
+  for name, files in grouped_files.items():
+    files_entries = np.array([ff[2] for ff in files])
+    total = files_entries.sum()
+    step = total // n_jobs
+    if step == 0:
+      raise RuntimeError("Number of jobs {} is larger than the number of entries in '{}'.".format(n_jobs, name))
+    cumulative = np.concatenate([[0], np.cumsum(files_entries)])
+    first_entry = job_idx * step
+    last_entry  = (job_idx + 1) * step - 1
+    n_entries = np.full(n_jobs, step)
+    if overflow_job:
+      last_entry[-1] = total - 1
+      n_entries[-1] = step + total % n_jobs
+    first_file = np.searchsorted(cumulative, first_entry, side = 'right') - 1
+    last_file  = np.searchsorted(cumulative, last_entry , side = 'right') - 1
+    features[:, 0] += n_entries
+    features[:, 1] += last_file - first_file + 1
+    features[:, 2] += n_entries * output_fractions[name]
+  return features
+
+def predict_runtime(features, costs):
+  return features.dot(np.array([costs[f] for f in FEATURES]))
+
+class JobPlanner:
+  def __init__(self, cfg, input_path, pt_bins, eta_bins, spectrum_dir = None, overflow_job = False, costs = None):
+    self.costs = dict(DEFAULT_COSTS, **(costs or {}))
+    self.overflow_job = overflow_job
+    groups = read_cfg_groups(cfg)
+    self.grouped_files = group_files(groups, read_input_list(input_path))
+    self.max_jobs = min(sum(ff[2] for ff in files) for files in self.grouped_files.values())
+    self.output_fractions = {}
+    for group in groups:
+      files = self.grouped_files[group['name']]
+      if spectrum_dir is None:
+        self.output_fractions[group['name']] = 1.
+      else:
+        datasets = sorted(set(ff[0] for ff in files))
+        self.output_fractions[group['name']] = output_fraction(spectrum_dir, datasets, group['types'],
+                                                               sum(ff[2] for ff in files), parse_bins(pt_bins),
+                                                               parse_bins(eta_bins))
+
+  def features(self, n_jobs):
+    return job_features(self.grouped_files, self.output_fractions, n_jobs, self.overflow_job)
+
+  def predict(self, n_jobs):
+    return predict_runtime(self.features(n_jobs), self.costs)
+
+  def choose_n_jobs(self, target_runtime):
+    """Smallest number of jobs, such that the predicted runtime of the slowest job is below target_runtime (in s)."""
+    lo, hi = 1, self.max_jobs
+    if self.predict(hi).max() > target_runtime:
+      return hi
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.predict(mid).max() <= target_runtime:
+        hi = mid
+      else:
+        lo = mid + 1
+    return lo
+
+def calibrate(records_dir):
+  """Fits the cost coefficients to the runtime records of the successful jobs."""
+  records = []
+  for path in glob.glob(os.path.join(records_dir, '*.json')):
+    with open(path, 'r') as f:
+      records.append(json.load(f))
+  records = [rec for rec in records if rec.get('retcode', 1) == 0 and 'features' in rec]
+  if len(records) < len(FEATURES):
+    raise RuntimeError("At least {} successful job records are needed for the calibration.".format(len(FEATURES)))
+  x = np.array([[rec['features'][f] for f in FEATURES] for rec in records])
+  y = np.array([rec['runtime'] for rec in records])
+  coef = np.maximum(np.linalg.lstsq(x, y, rcond = None)[0], 0.)
+  predicted = x.dot(coef)
+  print('calibrated on {} jobs, relative residual = {:.3f}'.format(len(records), np.std(y - predicted) / np.mean(y)),
+        file = sys.stderr)
+  return dict(zip(FEATURES, coef))
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser('Cost model of the ShuffleMergeSpectral jobs.')
+  subparsers = parser.add_subparsers(dest = 'command')
+  plan_parser = subparsers.add_parser('plan', help = 'print the predicted runtime of the jobs')
+  plan_parser.add_argument('--cfg'           , required = True, type = str)
+  plan_parser.add_argument('--input'         , required = True, type = str)
+  plan_parser.add_argument('--input-spec'    , default  = None, type = str)
+  plan_parser.add_argument('--pt-bins'       , required = True, type = str)
+  plan_parser.add_argument('--eta-bins'      , required = True, type = str)
+  plan_parser.add_argument('--n-jobs'        , default  = 0   , type = int)
+  plan_parser.add_argument('--target-runtime', default  = 4.  , type = float, help = 'target runtime per job in hours')
+  plan_parser.add_argument('--overflow-job'  , action = 'store_true')
+  plan_parser.add_argument('--costs'         , default  = None, type = str, help = 'json with the cost coefficients')
+  calib_parser = subparsers.add_parser('calibrate', help = 'fit the cost coefficients to the recorded runtimes')
+  calib_parser.add_argument('--records', required = True, type = str, help = 'directory with the job runtime records')
+  args = parser.parse_args()
+
+  if args.command == 'plan':
+    costs = json.load(open(args.costs, 'r')) if args.costs is not None else None
+    planner = JobPlanner(args.cfg, args.input, args.pt_bins, args.eta_bins, args.input_spec, args.overflow_job, costs)
+    n_jobs = args.n_jobs if args.n_jobs > 0 else planner.choose_n_jobs(args.target_runtime * 3600)
+    runtime = planner.predict(n_jobs)
+    print('n_jobs = {}, predicted runtime [h]: min = {:.2f}, mean = {:.2f}, max = {:.2f}'.format(
+      n_jobs, runtime.min() / 3600, runtime.mean() / 3600, runtime.max() / 3600))
+  elif args.command == 'calibrate':
+    print(json.dumps(calibrate(args.records), indent = 2))
+  else:
+    parser.print_help()
@@ -6,12 +6,15 @@ import subprocess
 import os
 import re
 import sys
+import json
+import time
 import shutil
 
-from framework import Task, HTCondorWorkflow
+from framework import Task, HTCondorWorkflow, LocalParallelWorkflow
+from ShuffleMergeSpectral.planner import JobPlanner, FEATURES
 import luigi
 
-class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
+class ShuffleMergeSpectral(Task, HTCondorWorkflow, LocalParallelWorkflow, law.LocalWorkflow):
   ## '_' will be converted to '-' for the shell command invocation
   cfg               = luigi.Parameter(description = 'configuration file with the list of input sources')
   input_path        = luigi.Parameter(description = 'Input file with the list of files to read. '
@@ -21,7 +24,11 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
   eta_bins          = luigi.Parameter(description = 'eta bins')
   input_spec        = luigi.Parameter(description = '')
   tau_ratio         = luigi.Parameter(description = '')
-  n_jobs            = luigi.IntParameter(description = 'number of HTCondor jobs to run')
+  n_jobs            = luigi.IntParameter(default = 0, description = 'number of HTCondor jobs to run. '
+                                                                    'If 0, it is chosen by the cost model to fit --target-runtime')
+  target_runtime    = luigi.FloatParameter(default = 0., description = 'target runtime of the slowest job in hours (used if --n-jobs is 0)')
+  cost_model        = luigi.Parameter(default = '', significant = False,
+                                      description = 'json file with the cost coefficients, see ShuffleMergeSpectral/planner.py calibrate')
   ## optional arguments (default will be an empty string: don't override ShuffleMergeSpectral.cxx default values)
   prefix            = luigi.Parameter(description = 'Prefix to place before the input file path read from --input.'
                                                     'It can include a remote server to use with xrootd.', default = "")
@@ -48,7 +55,32 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
     if not os.path.exists(os.path.abspath('/'.join([self.output_dir, '..', 'hashes']))):
       os.makedirs(os.path.abspath('/'.join([self.output_dir, '..', 'hashes'])))
 
-    return {i: i for i in range(self.n_jobs)}
+    if self.n_jobs > 0:
+      ## the number of jobs is given explicitly: the inputs are not needed to build the branches
+      return {i: {'job_idx': i, 'n_jobs': self.n_jobs} for i in range(self.n_jobs)}
+    if self.target_runtime <= 0:
+      raise Exception('Either --n-jobs or --target-runtime should be specified')
+    planner = self.job_planner()
+    n_jobs = planner.choose_n_jobs(self.target_runtime * 3600)
+    features = planner.features(n_jobs)
+    runtime  = planner.predict(n_jobs)
+    print('ShuffleMergeSpectral: {} jobs, predicted runtime of the slowest job {:.2f} h'.format(n_jobs, runtime.max() / 3600))
+
+    return {i: {'job_idx': i, 'n_jobs': n_jobs, 'predicted_runtime': float(runtime[i]),
+                'features': {ff: float(features[i, j]) for j, ff in enumerate(FEATURES)}} for i in range(n_jobs)}
+
+  def job_planner(self):
+    costs = None
+    if self.cost_model != '':
+      with open(self.cost_model, 'r') as f:
+        costs = json.load(f)
+    return JobPlanner(cfg = self.cfg, input_path = self.input_path, pt_bins = self.pt_bins, eta_bins = self.eta_bins,
+                      spectrum_dir = None if self.is_true(self.refill_spectrum) else self.input_spec,
+                      overflow_job = self.is_true(self.overflow_job), costs = costs)
+
+  @staticmethod
+  def is_true(value):
+    return str(value).lower() in ['true', '1']
 
   def output(self):
     return self.local_target("empty_file_{}.txt".format(self.branch))
@@ -59,24 +91,51 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
       else: os.remove(dest)
     shutil.move(src, dest)
 
+  def record_runtime(self, runtime, retcode):
+    ## predicted and actual runtime are stored to calibrate the cost model (ShuffleMergeSpectral/planner.py calibrate)
+    records_dir = '/'.join([self.output_path, 'runtime'])
+    if not os.path.exists(records_dir):
+      os.makedirs(records_dir)
+    record = dict(self.branch_data, runtime = runtime, retcode = retcode)
+    if 'features' not in record:
+      ## with explicit --n-jobs the features are computed here, only for this job
+      try:
+        planner = self.job_planner()
+        features = planner.features(record['n_jobs'])[record['job_idx']]
+        record['features'] = {ff: float(features[j]) for j, ff in enumerate(FEATURES)}
+        record['predicted_runtime'] = float(planner.predict(record['n_jobs'])[record['job_idx']])
+      except Exception as e:
+        print('Features of job {} are not recorded: {}'.format(self.branch, e))
+    with open('/'.join([records_dir, 'job_{}.json'.format(self.branch)]), 'w') as f:
+      json.dump(record, f, indent = 2)
+    if 'predicted_runtime' in record:
+      print('Runtime {:.0f} s, predicted {:.0f} s'.format(runtime, record['predicted_runtime']))
+    else:
+      print('Runtime {:.0f} s'.format(runtime))
+
   def run(self):
     self.output_dir = '/'.join([self.output_path, 'tmp'])
     file_name   = '_'.join(['ShuffleMergeSpectral', str(self.branch)]) + '.root'
-    output_name = '/'.join([self.output_dir, file_name])
+    output_name = os.path.abspath('/'.join([self.output_dir, file_name]))
+    ## each branch runs in its own working directory, where the hash tables are stored (./out)
+    work_dir    = os.path.abspath('job_{}'.format(self.branch))
+    if not os.path.exists(work_dir):
+      os.makedirs(work_dir)
 
     if not (self.mode == 'MergeAll' or self.mode == ''):
       raise Exception('Only --mode MergeAll is supported by the law tool')
 
     quote = lambda x: str('\"{}\"'.format(str(x)))
+    local_path = lambda x: x if '://' in x else os.path.abspath(x)
     command = ' '.join(['ShuffleMergeSpectral',
-      '--cfg'               , str(self.cfg)             ,
-      '--input'             , str(self.input_path)      ,
+      '--cfg'               , os.path.abspath(str(self.cfg)),
+      '--input'             , os.path.abspath(str(self.input_path)),
       '--output'            , output_name               ,
       '--pt-bins'           , quote(str(self.pt_bins))  ,
       '--eta-bins'          , quote(str(self.eta_bins)) ,
-      '--input-spec'        , str(self.input_spec)      ,
-      '--n-jobs'            , str(self.n_jobs)          ,
-      '--job-idx'           , str(self.branch_data)     ,
+      '--input-spec'        , local_path(str(self.input_spec)),
+      '--n-jobs'            , str(self.branch_data['n_jobs'] ) ,
+      '--job-idx'           , str(self.branch_data['job_idx']) ,
       '--tau-ratio'         , quote(str(self.tau_ratio))] +\
       ## optional arguments
       ['--mode'             , str(self.mode)                    ] * (not self.mode               is '') +\
@@ -95,8 +154,10 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
       ['--overflow-job'     , str(self.overflow_job)            ] * (not self.overflow_job       is '')  )
 
     print ('>> {}'.format(command))
-    proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    start_time = time.time()
+    proc = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE, cwd = work_dir)
     stdout, stderr = proc.communicate()
+    self.record_runtime(time.time() - start_time, proc.returncode)
 
     sys.stdout.write(str(stdout) + '\n')
     sys.stderr.write(str(stderr) + '\n')
@@ -107,7 +168,8 @@ class ShuffleMergeSpectral(Task, HTCondorWorkflow, law.LocalWorkflow):
       raise Exception('job {} return code is {}'.format(self.branch, retcode))
     else:
       self.move(os.path.abspath(output_name), os.path.abspath('/'.join([self.output_dir, '..', file_name])))
-      self.move(os.path.abspath('./out'    ), os.path.abspath('/'.join([self.output_dir, '..', 'hashes', 'out_{}'.format(self.branch)])))
+      self.move('/'.join([work_dir, 'out']), os.path.abspath('/'.join([self.output_dir, '..', 'hashes', 'out_{}'.format(self.branch)])))
+      shutil.rmtree(work_dir)
       print('Output file and hash tables moved to {}\n'.format(os.path.abspath('/'.join([self.output_dir, '..']))))
       taskout = self.output()
       taskout.dump('Task ended with code %s\n' %retcode)
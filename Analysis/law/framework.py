@@ -10,10 +10,16 @@ and only needs to be defined once per user / group / etc.
 
 
 import os
+import json
 import math
+import time
+import resource
+import traceback
+import multiprocessing
 
 import luigi
 import law
+from law.workflow.base import BaseWorkflow, BaseWorkflowProxy
 
 
 # the htcondor workflow implementation is part of a law contrib package
@@ -108,3 +114,93 @@ class HTCondorWorkflow(law.htcondor.HTCondorWorkflow):
     config.custom_content.append(("x509userproxy", os.environ['X509_USER_PROXY']))
 
     return config
+
+
+def run_branch_process(branch_task, max_memory, queue):
+  """
+  Runs a branch task in a forked process. The address space of the process (and of the commands it starts) is limited
+  to max_memory MB. Wall time and peak RSS (maximum of the process and of its finished children) are sent to the queue.
+  """
+  if max_memory > 0:
+    limit = int(max_memory * 2**20)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+  start_time = time.time()
+  error = None
+  try:
+    branch_task.run()
+  except BaseException:
+    error = traceback.format_exc()
+  # ru_maxrss is in kB on Linux
+  peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  queue.put({ 'branch': branch_task.branch, 'wall_time': time.time() - start_time, 'peak_rss_mb': peak_rss / 1024.,
+              'error': error })
+
+
+class LocalParallelWorkflowProxy(BaseWorkflowProxy):
+  """
+  Runs the branches of the workflow in a pool of local processes. Branches with complete outputs are skipped,
+  so an interrupted workflow is resumed by running the same command again.
+  """
+  workflow_type = "local_parallel"
+
+  def run(self):
+    super(LocalParallelWorkflowProxy, self).run()
+    task = self.task
+    branch_tasks = task.get_branch_tasks()
+    pending = [ branch for branch, branch_task in sorted(branch_tasks.items()) if not branch_task.complete() ]
+    print('{}: {} branches to run, {} already complete'.format(task.task_family, len(pending), len(branch_tasks) - len(pending)))
+
+    queue = multiprocessing.Queue()
+    running = {}
+    results = {}
+    while len(pending) or len(running):
+      while len(pending) and len(running) < task.local_workers:
+        branch = pending.pop(0)
+        process = multiprocessing.Process(target = run_branch_process,
+                                          args = (branch_tasks[branch], task.branch_max_memory, queue))
+        process.start()
+        running[branch] = process
+      while not queue.empty():
+        result = queue.get()
+        results[result['branch']] = result
+      for branch, process in list(running.items()):
+        if process.is_alive(): continue
+        process.join()
+        while branch not in results and not queue.empty():
+          result = queue.get()
+          results[result['branch']] = result
+        if branch not in results:
+          results[branch] = { 'branch': branch, 'wall_time': None, 'peak_rss_mb': None,
+                              'error': 'process exited with code {}'.format(process.exitcode) }
+        self.dump_resources(results[branch])
+        del running[branch]
+      time.sleep(0.1)
+
+    failed = [ branch for branch, result in results.items() if result['error'] is not None ]
+    if len(failed):
+      raise Exception('{} branches failed: {}'.format(len(failed), ', '.join(str(b) for b in sorted(failed))))
+
+  def dump_resources(self, result):
+    if result['error'] is None:
+      print('branch {}: done in {:.1f} s, peak RSS {:.0f} MB'.format(result['branch'], result['wall_time'], result['peak_rss_mb']))
+    else:
+      print('branch {}: failed\n{}'.format(result['branch'], result['error']))
+    target = self.task.local_target('resources', 'branch_{}.json'.format(result['branch']))
+    target.parent.touch()
+    with open(target.path, 'w') as f:
+      json.dump(result, f, indent = 2)
+
+
+class LocalParallelWorkflow(BaseWorkflow):
+  """
+  Workflow running the branches in parallel local processes (--workflow local_parallel), for machines without a
+  batch system. Wall time and peak RSS of each branch are stored in resources/branch_N.json of the task directory.
+  """
+  workflow_proxy_cls = LocalParallelWorkflowProxy
+
+  local_workers     = luigi.IntParameter(default = 4, significant = False,
+    description = 'number of branches running in parallel with --workflow local_parallel')
+  branch_max_memory = luigi.IntParameter(default = 0, significant = False,
+    description = 'maximum address space of a branch in MB with --workflow local_parallel, 0: no limit')
+
+  exclude_index = True
@@ -2,18 +2,21 @@
 
 import os
 import re
+import sys
 import argparse
-import shutil
-import random
 from glob import glob
-import subprocess
+from dataset_driver import DatasetJob, run_jobs
 
 parser = argparse.ArgumentParser(description='Creating histograms for shuffle and merge.')
 parser.add_argument('--input', required=True, type=str, help="input directory")
 parser.add_argument('--output', required=True, type=str, help="output directory")
-parser.add_argument('--n-threads', required=False, type=int, default=1, help="number of threads")
+parser.add_argument('--n-threads', required=False, type=int, default=1, help="number of threads per dataset")
+parser.add_argument('--n-cores', required=False, type=int, default=os.cpu_count(),
+                    help="total number of cores shared by the datasets processed in parallel")
+parser.add_argument('--n-retries', required=False, type=int, default=2, help="number of retries of a failed dataset")
 parser.add_argument('--filter', required=False, type=str, default='.*', help="regex filter for dataset names")
-parser.add_argument('--rewrite',required=False, action='store_true', default=False, help="rewrite existing histograms")
+parser.add_argument('--rewrite',required=False, action='store_true', default=False,
+                    help="rewrite existing histograms, even if they are up to date")
 args = parser.parse_args()
 
 if not os.path.isdir(args.input):
@@ -28,7 +31,7 @@ eta_hist = "25, 0, 2.5"
 print ("regex filter for dataset names: "+args.filter)
 
 input_path = []
-for dir_name in glob(args.input+"/*"):
+for dir_name in sorted(glob(args.input+"/*")):
     if (re.match(args.filter, dir_name) is None):
         continue
     else:
@@ -37,41 +40,21 @@ for dir_name in glob(args.input+"/*"):
 print ("list of input files: ")
 print (input_path)
 
+jobs = []
 for dir_path in input_path:
 
     split_path = dir_path.split("/")
     if not os.path.isdir(dir_path): continue
 
-    output_root = args.output + "/" \
-                + split_path[-1] + ".root"
-    output_entries = args.output + "/" \
-                + split_path[-1] + ".txt"
-                
+    output_prefix = args.output + "/" + split_path[-1]
+    output_root = output_prefix + ".root"
+    output_entries = output_prefix + ".txt"
 
-    if os.path.exists(output_root):
-        print("{} was already processed.".format(dir_path))
-        if args.rewrite:
-            print("{} was removed".format(output_root))
-            os.remove(output_root)
-        else:
-            continue
-    if os.path.exists(output_entries):
-        print("{} was already processed.".format(dir_path))
-        if args.rewrite:
-            print("{} was removed".format(output_entries))
-            os.remove(output_entries)
-        else:
-            continue
-
-    print("Added {}...".format(dir_path))
-
-    cmd = 'CreateSpectralHists --outputfile "{}" --output_entries "{}" --input-dir "{}" --pt-hist "{}" --eta-hist "{}" --n-threads {}' \
-        .format(output_root, output_entries, dir_path, pt_hist, eta_hist, args.n_threads)
-    result = subprocess.call([cmd], shell=True)
-
-    if result != 0:
-        if os.path.exists(output_root):
-            os.remove(output_root)
-        raise RuntimeError("MergeTuples has failed.")
-    print("{} has been successfully processed".format(dir_path))
+    cmd = [ 'CreateSpectralHists', '--outputfile', output_root, '--output_entries', output_entries, '--input-dir', dir_path,
+            '--pt-hist', pt_hist, '--eta-hist', eta_hist, '--n-threads', args.n_threads ]
+    jobs.append(DatasetJob(split_path[-1], dir_path, cmd, [ output_root, output_entries ], output_prefix,
+                           n_threads=args.n_threads))
 
+failed = run_jobs(jobs, args.n_cores, n_retries=args.n_retries, rewrite=args.rewrite)
+if len(failed) > 0:
+    sys.exit(1)
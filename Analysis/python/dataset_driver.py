@@ -0,0 +1,130 @@
+"""Runs a command for several dataset directories concurrently within a global core budget.
+
+Each dataset job declares its outputs. After a successful run, a hash of the job command and of the dataset content
+(names, sizes and modification times of all input files) is stored next to the outputs in '{output_prefix}.hash'.
+A job is skipped when all outputs exist and the stored hash is up to date. Outputs that exist without a hash file
+(e.g. produced before the hash was introduced) are never overwritten unless rewrite is set. Failed jobs are retried, and failures are
+reported at the end without interrupting the processing of other datasets.
+"""
+
+import hashlib
+import os
+import subprocess
+import time
+
+class DatasetJob:
+    # options that do not affect the outputs are not included in the hash
+    hash_excluded_options = [ '--n-threads' ]
+
+    def __init__(self, name, input_dir, cmd, outputs, output_prefix, n_threads=1):
+        self.name = name
+        self.input_dir = input_dir
+        self.cmd = [ str(arg) for arg in cmd ]
+        self.outputs = outputs
+        self.hash_file = output_prefix + '.hash'
+        self.log_file = output_prefix + '.log'
+        self.n_threads = n_threads
+        self.n_attempts = 0
+
+    def input_hash(self):
+        h = hashlib.sha1()
+        cmd = []
+        for arg in self.cmd:
+            if len(cmd) > 0 and cmd[-1] in self.hash_excluded_options:
+                cmd.pop()
+            else:
+                cmd.append(arg)
+        h.update('\0'.join(cmd).encode())
+        for root, dirs, files in os.walk(self.input_dir):
+            dirs.sort()
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                stat = os.stat(path)
+                h.update('{}\0{}\0{}\0'.format(os.path.relpath(path, self.input_dir), stat.st_size,
+                                               stat.st_mtime_ns).encode())
+        return h.hexdigest()
+
+    def is_up_to_date(self, input_hash):
+        if not all(os.path.exists(output) for output in self.outputs + [ self.hash_file ]):
+            return False
+        with open(self.hash_file, 'r') as f:
+            return f.read().strip() == input_hash
+
+    def has_unhashed_outputs(self):
+        return not os.path.exists(self.hash_file) and any(os.path.exists(output) for output in self.outputs)
+
+    def remove_outputs(self):
+        for output in self.outputs + [ self.hash_file ]:
+            if os.path.exists(output):
+                os.remove(output)
+
+def run_jobs(jobs, n_cores, n_retries=2, rewrite=False, poll_interval=1.):
+    """Runs jobs concurrently, such that the total number of threads of the running jobs does not exceed n_cores.
+    Returns the list of jobs that failed after all retries."""
+    input_hashes = {}
+    queue = []
+    n_unhashed = 0
+    for job in jobs:
+        input_hashes[job.name] = job.input_hash()
+        if not rewrite and job.is_up_to_date(input_hashes[job.name]):
+            print("{} is up to date.".format(job.name))
+            continue
+        if not rewrite and job.has_unhashed_outputs():
+            print("WARNING: outputs of {} exist without {}, skipping. Use --rewrite to reprocess.".format(job.name,
+                                                                                                         job.hash_file))
+            n_unhashed += 1
+            continue
+        queue.append(job)
+    print("{} dataset(s) to process, {} up to date, {} skipped with outputs without hash.".format(
+          len(queue), len(jobs) - len(queue) - n_unhashed, n_unhashed))
+
+    running = []
+    failed = []
+
+    def on_failure(job, reason):
+        job.remove_outputs()
+        if job.n_attempts <= n_retries:
+            print("{} has failed with {}, retrying. See {}".format(job.name, reason, job.log_file))
+            queue.append(job)
+        else:
+            print("{} has failed with {}. See {}".format(job.name, reason, job.log_file))
+            failed.append(job)
+
+    while len(queue) > 0 or len(running) > 0:
+        used_cores = sum(job.n_threads for job, process, log in running)
+        while len(queue) > 0 and (len(running) == 0 or used_cores + queue[0].n_threads <= n_cores):
+            job = queue.pop(0)
+            job.remove_outputs()
+            job.n_attempts += 1
+            log = open(job.log_file, 'w')
+            print("Starting {} (attempt {})...".format(job.name, job.n_attempts))
+            try:
+                process = subprocess.Popen(job.cmd, stdout=log, stderr=subprocess.STDOUT)
+            except OSError as e:
+                # e.g. the executable is missing: the job fails without affecting the other datasets
+                log.write("Unable to start {}: {}\n".format(job.cmd[0], e))
+                log.close()
+                on_failure(job, "OSError ({})".format(e))
+                continue
+            running.append((job, process, log))
+            used_cores += job.n_threads
+
+        time.sleep(poll_interval)
+        still_running = []
+        for job, process, log in running:
+            result = process.poll()
+            if result is None:
+                still_running.append((job, process, log))
+                continue
+            log.close()
+            if result == 0 and all(os.path.exists(output) for output in job.outputs):
+                with open(job.hash_file, 'w') as f:
+                    f.write(input_hashes[job.name] + '\n')
+                print("{} has been successfully processed.".format(job.name))
+                continue
+            on_failure(job, "exit code {}".format(result))
+        running = still_running
+
+    if len(failed) > 0:
+        print("Processing has failed for {} dataset(s): {}".format(len(failed), ', '.join(job.name for job in failed)))
+    return failed
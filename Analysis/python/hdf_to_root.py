@@ -6,28 +6,71 @@ parser.add_argument('--input', required=True, type=str, help="Input HDF5 file")
 parser.add_argument('--output', required=True, type=str, help="Output ROOT file")
 parser.add_argument('--tree', required=False, type=str, default="taus", help="Tree name")
 parser.add_argument('--chunk-size', required=False, type=int, default=100000, help="Number of entries per iteration")
-parser.add_argument('--boolean-columns', required=False, type=str, default="", help="List of boolean columns")
+parser.add_argument('--boolean-columns', required=False, type=str, default="",
+                    help="List of boolean columns (needed only for inputs where booleans were stored as integers)")
+parser.add_argument('--compression', required=False, type=str, default='ZSTD', choices=['ZLIB', 'LZMA', 'LZ4', 'ZSTD'],
+                    help="Compression algorithm")
+parser.add_argument('--comp-level', required=False, type=int, default=4, help="Compression level")
+parser.add_argument('--n-threads', required=False, type=int, default=4, help="Number of threads used for blosc decompression")
 args = parser.parse_args()
 
 import os
-import h5py
+import numpy as np
+import awkward as ak
 import pandas
-import root_pandas
+import uproot
+import tables
 from tqdm import tqdm
 
+def iterate_chunks(h5_file, tree, chunk_size):
+    """Yields dictionaries of numpy/awkward arrays for consecutive chunks of entries.
+    Supports layout produced by root_to_hdf.py and pandas tables."""
+    group = h5_file.get_node('/', tree)
+    if 'pandas_type' in group._v_attrs:
+        for df in pandas.read_hdf(h5_file.filename, tree, chunksize=chunk_size):
+            yield { column: df[column].values for column in df.columns }
+        return
+    table = group.table if 'table' in group else None
+    jagged = { column_group._v_name: (column_group.values, column_group.offsets)
+               for column_group in group.jagged } if 'jagged' in group else {}
+    n_total = get_n_entries(h5_file, tree)
+    for start in range(0, n_total, chunk_size):
+        stop = min(start + chunk_size, n_total)
+        chunk = {}
+        if table is not None:
+            rows = table.read(start, stop)
+            chunk.update({ column: rows[column] for column in rows.dtype.names })
+        for column, (values, offsets) in jagged.items():
+            entry_offsets = offsets[start:stop + 1]
+            chunk[column] = ak.unflatten(values[entry_offsets[0]:entry_offsets[-1]], np.diff(entry_offsets))
+        yield chunk
+
+def get_n_entries(h5_file, tree):
+    group = h5_file.get_node('/', tree)
+    if 'table' in group:
+        return group.table.nrows
+    jagged_columns = list(group.jagged) if 'jagged' in group else []
+    if len(jagged_columns) == 0:
+        raise RuntimeError("Tree '{}' has neither a flat table nor jagged columns.".format(tree))
+    return jagged_columns[0].offsets.nrows - 1
+
 if os.path.isfile(args.output):
     os.remove(args.output)
 
-with h5py.File(args.input, 'r') as file:
-    n_total = file[args.tree]['table'].shape[0]
-
+tables.set_blosc_max_threads(args.n_threads)
 boolean_columns = [ c.strip() for c in args.boolean_columns.split(',') if len(c.strip()) != 0 ]
+compression = getattr(uproot, args.compression)(args.comp_level)
 
-with tqdm(total=n_total, unit='entries') as pbar:
-    for df in pandas.read_hdf(args.input, args.tree, chunksize=args.chunk_size):
-        for c in boolean_columns:
-            df[c] = pandas.Series(df[c].astype(bool), index=df.index)
-        df.to_root(args.output, mode='a', key=args.tree)
-        pbar.update(df.shape[0])
+with tables.open_file(args.input, mode='r') as input_file, uproot.recreate(args.output, compression=compression) as output_file:
+    n_total = get_n_entries(input_file, args.tree)
+    with tqdm(total=n_total, unit='entries') as pbar:
+        for chunk in iterate_chunks(input_file, args.tree, args.chunk_size):
+            for c in boolean_columns:
+                chunk[c] = chunk[c].astype(bool)
+            if args.tree in output_file:
+                output_file[args.tree].extend(chunk)
+            else:
+                output_file[args.tree] = chunk
+            pbar.update(len(next(iter(chunk.values()))))
 
 print("All entries has been processed.")
@@ -6,38 +6,82 @@ parser.add_argument('--input', required=True, type=str, help="Input ROOT file")
 parser.add_argument('--output', required=True, type=str, help="Output HDF5 file")
 parser.add_argument('--trees', required=True, type=str, help="List of tree names to ")
 parser.add_argument('--chunk-size', required=False, type=int, default=100000, help="Number of entries per iteration")
+parser.add_argument('--compression', required=False, type=str, default='blosc:lz4',
+                    help="Compression library supported by PyTables, e.g. zlib, lzf, blosc:lz4, blosc:zstd, blosc:blosclz")
+parser.add_argument('--comp-level', required=False, type=int, default=4, help="Compression level")
+parser.add_argument('--n-threads', required=False, type=int, default=4,
+                    help="Number of threads used for decompression of ROOT baskets and for blosc compression")
 args = parser.parse_args()
 
 import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import awkward as ak
 import uproot
-import pandas
-from root_pandas import read_root
+import tables
 from tqdm import tqdm
 
+# Output layout for each tree:
+#   /{tree}/table                     - table with one column per flat branch
+#   /{tree}/jagged/{branch}/values    - concatenated values of a jagged branch
+#   /{tree}/jagged/{branch}/offsets   - offsets of the entries in values (n_entries + 1 elements, starting from 0)
+
 if os.path.isfile(args.output):
     os.remove(args.output)
 
-trees = args.trees.split(',')
-for tree in trees:
-
-    print("Processing tree '{}'...".format(tree))
-    with uproot.open(args.input) as file:
-        tree_obj = file[tree]
-        n_total = tree_obj.numentries
+tables.set_blosc_max_threads(args.n_threads)
+filters = tables.Filters(complevel=args.comp_level, complib=args.compression, shuffle=True)
 
-    first_pass = True
-    boolean_columns = ""
-    with tqdm(total=n_total, unit='entries') as pbar:
-        for df in read_root(args.input, tree, chunksize=args.chunk_size):
-            for n in range(df.shape[1]):
-                if df.dtypes[n] == bool:
-                    df[df.columns[n]] = pandas.Series(df[df.columns[n]].astype(int), index=df.index)
-                    if first_pass:
-                        boolean_columns += df.columns[n] + ","
-            df.to_hdf(args.output, tree, append=True, complevel=1, complib='zlib')
-            pbar.update(df.shape[0])
-            first_pass = False
-    if len(boolean_columns):
-        print("Boolean columns: {}".format(boolean_columns))
-    print("All entries for tree '{}' has been processed.".format(tree))
+trees = args.trees.split(',')
+with ThreadPoolExecutor(args.n_threads) as executor, \
+     uproot.open(args.input, decompression_executor=executor) as input_file, \
+     tables.open_file(args.output, mode='w', filters=filters) as output_file:
+    for tree in trees:
+        print("Processing tree '{}'...".format(tree))
+        tree_obj = input_file[tree]
+        n_total = tree_obj.num_entries
+        group = output_file.create_group('/', tree)
+        table = None
+        jagged = {}
+        boolean_columns = []
+        with tqdm(total=n_total, unit='entries') as pbar:
+            for chunk in tree_obj.iterate(step_size=args.chunk_size, library='ak'):
+                n_entries = len(chunk)
+                flat_columns = {}
+                for column in chunk.fields:
+                    ndim = chunk[column].ndim
+                    if ndim == 1:
+                        flat_columns[column] = ak.to_numpy(chunk[column])
+                    elif ndim == 2:
+                        if column not in jagged:
+                            values = ak.to_numpy(ak.flatten(chunk[column][:0]))
+                            if 'jagged' not in group:
+                                output_file.create_group(group, 'jagged')
+                            column_group = output_file.create_group(group.jagged, column)
+                            jagged[column] = (
+                                output_file.create_earray(column_group, 'values', atom=tables.Atom.from_dtype(values.dtype),
+                                                          shape=(0,)),
+                                output_file.create_earray(column_group, 'offsets', atom=tables.Int64Atom(), shape=(0,),
+                                                          expectedrows=n_total + 1, obj=np.zeros(1, dtype=np.int64)),
+                            )
+                        values_array, offsets_array = jagged[column]
+                        offsets_array.append(offsets_array[-1] + np.cumsum(ak.to_numpy(ak.num(chunk[column]))))
+                        values_array.append(ak.to_numpy(ak.flatten(chunk[column])))
+                    else:
+                        raise RuntimeError("Branch '{}' with {} dimensions is not supported.".format(column, ndim))
+                if table is None and len(flat_columns):
+                    dtype = np.dtype([ (column, values.dtype) for column, values in flat_columns.items() ])
+                    table = output_file.create_table(group, 'table', description=dtype, expectedrows=n_total)
+                    boolean_columns = [ column for column, values in flat_columns.items() if values.dtype == bool ]
+                if table is not None:
+                    rows = np.empty(n_entries, dtype=table.dtype)
+                    for column, values in flat_columns.items():
+                        rows[column] = values
+                    table.append(rows)
+                pbar.update(n_entries)
+        if len(boolean_columns):
+            print("Boolean columns: {}".format(','.join(boolean_columns)))
+        if len(jagged):
+            print("Jagged columns: {}".format(','.join(jagged.keys())))
+        print("All entries for tree '{}' has been processed.".format(tree))
 print("All trees are processed")
@@ -2,12 +2,27 @@
 
 import argparse
 parser = argparse.ArgumentParser(description='Shuffle hdf5 container.')
-parser.add_argument('--input', required=True, type=str, help="Input ROOT file")
+parser.add_argument('--input', required=True, type=str, help="Input HDF5 file")
 parser.add_argument('--tree', required=False, type=str, default="taus", help="Tree name")
+parser.add_argument('--output', required=False, type=str, default=None,
+                    help="Output HDF5 file. If not specified, the input table is shuffled in place.")
+parser.add_argument('--seed', required=False, type=int, default=None, help="Seed of the random generator")
+parser.add_argument('--max-memory', required=False, type=float, default=2048.,
+                    help="Approximate amount of memory in MB to be used for the shuffle buffers")
+parser.add_argument('--tmp-dir', required=False, type=str, default=None,
+                    help="Directory for the temporary file with buckets (default: directory of the output file)")
+parser.add_argument('--method', required=False, type=str, default='buckets', choices=['buckets', 'fisher-yates'],
+                    help="'buckets': out-of-core two-pass shuffle with block I/O;" \
+                         " 'fisher-yates': in-place swaps of single entries (slow, kept for comparison)")
 args = parser.parse_args()
 
+import os
 import random
+import shutil
+import tempfile
+import time
 import h5py
+import numpy as np
 from tqdm import tqdm
 
 # based on: https://svn.python.org/projects/python/trunk/Lib/random.py
@@ -22,7 +37,61 @@ def shuffle(x):
                 pbar.update(n_proc)
                 n_proc = 0
 
+def shuffle_buckets(table, tmp_dir, max_memory, rng):
+    """Two-pass out-of-core shuffle. In the first pass the table is read in contiguous blocks and each entry is sent to
+    a randomly chosen bucket in a temporary file. In the second pass each bucket is read, permuted in memory and written
+    back to the table sequentially. Assigning entries to buckets uniformly at random and shuffling each bucket uniformly
+    results in a uniformly random permutation of the whole table."""
+    n_entries = table.shape[0]
+    if n_entries == 0: # the output is left as the (empty) input table
+        print("The table is empty, nothing to shuffle.")
+        return
+    max_entries_in_memory = max(1, int(max_memory * 2**20 / table.dtype.itemsize))
+    block_size = min(n_entries, max_entries_in_memory)
+    # buckets are ~2 times smaller than the memory limit to accommodate fluctuations of their sizes
+    n_buckets = max(1, int(np.ceil(2 * n_entries / max_entries_in_memory)))
+    print("Shuffling {} entries using {} bucket(s) and blocks of {} entries.".format(n_entries, n_buckets, block_size))
 
-with h5py.File(args.input, 'r+') as file:
-    print("Number of entries = {}.".format(file[args.tree]["table"].shape[0]))
-    shuffle(file[args.tree]["table"])
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp_path, h5py.File(os.path.join(tmp_path, 'buckets.h5'), 'w') as tmp:
+        buckets = [ tmp.create_dataset('bucket_{}'.format(n), shape=(0,), maxshape=(None,), dtype=table.dtype,
+                                       chunks=(max(1, min(block_size // n_buckets, 2**16)),)) for n in range(n_buckets) ]
+        with tqdm(total=n_entries, unit='entries', desc='pass 1/2') as pbar:
+            for block_start in range(0, n_entries, block_size):
+                block = table[block_start:block_start + block_size]
+                bucket_idx = rng.integers(n_buckets, size=block.shape[0])
+                order = np.argsort(bucket_idx, kind='stable')
+                bucket_bounds = np.searchsorted(bucket_idx[order], np.arange(n_buckets + 1))
+                for n, bucket in enumerate(buckets):
+                    entries = block[order[bucket_bounds[n]:bucket_bounds[n + 1]]]
+                    if entries.shape[0] == 0: continue
+                    bucket_size = bucket.shape[0]
+                    bucket.resize((bucket_size + entries.shape[0],))
+                    bucket[bucket_size:] = entries
+                pbar.update(block.shape[0])
+
+        with tqdm(total=n_entries, unit='entries', desc='pass 2/2') as pbar:
+            output_start = 0
+            for bucket in buckets:
+                entries = bucket[:]
+                rng.shuffle(entries)
+                table[output_start:output_start + entries.shape[0]] = entries
+                output_start += entries.shape[0]
+                pbar.update(entries.shape[0])
+
+start_time = time.time()
+if args.output is not None:
+    shutil.copyfile(args.input, args.output)
+output = args.output if args.output is not None else args.input
+tmp_dir = args.tmp_dir if args.tmp_dir is not None else os.path.dirname(os.path.abspath(output))
+
+with h5py.File(output, 'r+') as file:
+    if "jagged" in file[args.tree]:
+        raise RuntimeError("Shuffling of trees with jagged columns is not supported.")
+    table = file[args.tree]["table"]
+    print("Number of entries = {}.".format(table.shape[0]))
+    if args.method == 'buckets':
+        shuffle_buckets(table, tmp_dir, args.max_memory, np.random.default_rng(args.seed))
+    else:
+        random.seed(args.seed)
+        shuffle(table)
+print("Shuffle finished in {:.1f} s.".format(time.time() - start_time))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import argparse
+parser = argparse.ArgumentParser(description='Compare shuffle methods of shuffle.py on a synthetic hdf5 container.')
+parser.add_argument('--n-entries', required=False, type=int, default=1000000, help="Number of entries in the table")
+parser.add_argument('--n-columns', required=False, type=int, default=50, help="Number of float columns in the table")
+parser.add_argument('--max-memory', required=False, type=float, default=64., help="--max-memory passed to shuffle.py")
+parser.add_argument('--tmp-dir', required=False, type=str, default=None, help="Directory for the test files")
+parser.add_argument('--methods', required=False, type=str, default='buckets,fisher-yates', help="Comma separated list of methods")
+args = parser.parse_args()
+
+import os
+import sys
+import subprocess
+import tempfile
+import time
+import shutil
+import numpy as np
+import pandas
+import h5py
+
+shuffle_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shuffle.py')
+
+with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_path:
+    input_file = os.path.join(tmp_path, 'input.h5')
+    df = pandas.DataFrame(np.random.rand(args.n_entries, args.n_columns).astype(np.float32),
+                          columns=[ 'var_{}'.format(n) for n in range(args.n_columns) ])
+    df['entry_id'] = np.arange(args.n_entries)
+    df.to_hdf(input_file, key='taus', format='table', complevel=1, complib='zlib')
+    size_mb = os.path.getsize(input_file) / 2**20
+    print("Input: {} entries, {:.1f} MB".format(args.n_entries, size_mb))
+
+    for method in args.methods.split(','):
+        output_file = os.path.join(tmp_path, 'output_{}.h5'.format(method))
+        shutil.copyfile(input_file, output_file)
+        start_time = time.time()
+        subprocess.check_call([ sys.executable, shuffle_script, '--input', output_file, '--tree', 'taus', '--seed', '42',
+                                '--method', method, '--max-memory', str(args.max_memory), '--tmp-dir', tmp_path ],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.time() - start_time
+        with h5py.File(output_file, 'r') as file:
+            entry_id = file['taus']['table']['values_block_1'][:, 0]
+        assert np.array_equal(np.sort(entry_id), np.arange(args.n_entries)), "shuffled table doesn't contain the original entries"
+        n_in_place = np.count_nonzero(entry_id == np.arange(args.n_entries))
+        print("{:>14}: {:8.1f} s, {:10.0f} entries/s, {:8.1f} MB/s, entries left in place: {}".format(
+              method, elapsed, args.n_entries / elapsed, size_mb / elapsed, n_in_place))
@@ -17,100 +17,181 @@ parser.add_argument('--input-prefix', required=False, type=str, default='',
                     help="prefix to be added to input each input file")
 parser.add_argument('--processing-module', required=False, type=str, default=None,
                     help="Python module used to process DataFrame. Should be in form file:method")
-parser.add_argument('--comp-algo', required=False, type=str, default='LZMA', help="compression algorithm")
-parser.add_argument('--comp-level', required=False, type=int, default=9, help="compression level")
-parser.add_argument('--n-threads', required=False, type=int, default=None, help="number of threads")
+parser.add_argument('--comp-algo', required=False, type=str, default='LZ4',
+                    help="compression algorithm (LZ4 and ZSTD are fast to write and read, LZMA gives smaller files)")
+parser.add_argument('--comp-level', required=False, type=int, default=5, help="compression level")
+parser.add_argument('--n-threads', required=False, type=int, default=4,
+                    help="number of threads. If an input range is specified, it is split into n-threads sub-ranges" \
+                         " processed in parallel")
 parser.add_argument('--input-range', required=False, type=str, default=None,
                     help="read only entries in range begin:end (before any selection)")
 parser.add_argument('--output-range', required=False, type=str, default=None,
                     help="write only entries in range begin:end (after all selections)")
 args = parser.parse_args()
 
+import shutil
+import tempfile
+import multiprocessing
 import ROOT
 ROOT.gROOT.SetBatch(True)
 
-if args.n_threads is None:
-    if args.input_range is not None or args.output_range is not None:
-        args.n_threads = 1
+def parse_range(range_str):
+    if range_str is None:
+        return None
+    begin, end = [ int(x) for x in range_str.split(':') ]
+    return begin, end
+
+def get_inputs():
+    inputs = []
+    if args.input.endswith('.root'):
+        inputs.append(args.input_prefix + args.input)
+    elif args.input.endswith('.txt'):
+        with open(args.input, 'r') as input_list:
+            for name in input_list.readlines():
+                name = name.strip()
+                if len(name) > 0 and name[0] != '#':
+                    inputs.append(args.input_prefix + name)
+    elif os.path.isdir(args.input):
+        for f in sorted(os.listdir(args.input)):
+            if not f.endswith('.root'): continue
+            inputs.append(os.path.join(args.input, f))
     else:
-        args.n_threads = 4
+        raise RuntimeError("Input format is not supported.")
+    return inputs
+
+def to_vector(items):
+    v = ROOT.vector('string')()
+    for item in items:
+        v.push_back(item)
+    return v
+
+def snapshot_options(lazy):
+    opt = ROOT.RDF.RSnapshotOptions()
+    opt.fCompressionAlgorithm = getattr(ROOT.ROOT, 'k' + args.comp_algo)
+    opt.fCompressionLevel = args.comp_level
+    opt.fLazy = lazy
+    return opt
+
+def book_main_tree(inputs, output, input_range, lazy, verbose):
+    df = ROOT.RDataFrame(args.tree, to_vector(inputs))
+    if input_range is not None:
+        df = df.Range(*input_range)
+
+    if args.processing_module is not None:
+        module_desc = args.processing_module.split(':')
+        import imp
+        module = imp.load_source('processing', module_desc[0])
+        fn = getattr(module, module_desc[1])
+        df = fn(df)
+
+    branches = []
+    for column in df.GetColumnNames():
+        include_column = False
+        if len(columns_to_include) == 0 or column in columns_to_include:
+            include_column = True
+        if column in columns_to_exclude:
+            include_column = False
+        if include_column:
+            branches.append(str(column))
+            if verbose:
+                print("Adding column '{}'...".format(column))
+
+    if args.sel is not None:
+        df = df.Filter(args.sel)
+
+    output_range = parse_range(args.output_range)
+    if output_range is not None:
+        df = df.Range(*output_range)
+
+    return df.Snapshot(args.tree, output, to_vector(branches), snapshot_options(lazy))
+
+def book_other_tree(inputs, tree_name, output, lazy):
+    df = ROOT.RDataFrame(tree_name, to_vector(inputs))
+    return df.Snapshot(tree_name, output, df.GetColumnNames(), snapshot_options(lazy))
+
+def skim_sub_range(task):
+    inputs, output, sub_range, verbose = task
+    book_main_tree(inputs, output, sub_range, lazy=False, verbose=verbose)
+    return output
+
+def split_range(input_range, n_splits):
+    begin, end = input_range
+    bounds = [ begin + (end - begin) * n // n_splits for n in range(n_splits + 1) ]
+    return [ (bounds[n], bounds[n + 1]) for n in range(n_splits) if bounds[n + 1] > bounds[n] ]
+
+def merge_files(part_files, output):
+    if len(part_files) == 1:
+        shutil.move(part_files[0], output)
+        return
+    merger = ROOT.TFileMerger(False, False)
+    merger.SetFastMethod(True)
+    merger.SetPrintLevel(0)
+    compression = ROOT.ROOT.CompressionSettings(getattr(ROOT.ROOT, 'k' + args.comp_algo), args.comp_level)
+    if not merger.OutputFile(output, 'RECREATE', compression):
+        raise RuntimeError("Unable to create output file '{}'.".format(output))
+    for part_file in part_files:
+        if not merger.AddFile(part_file, False):
+            raise RuntimeError("Unable to add '{}' to the merger.".format(part_file))
+    if not merger.Merge():
+        raise RuntimeError("Unable to merge the skimmed trees into '{}'.".format(output))
 
-if args.n_threads > 1:
-    ROOT.ROOT.EnableImplicitMT(args.n_threads)
 columns_to_include = []
 if args.include_columns is not None:
     columns_to_include = args.include_columns.split(',')
 columns_to_exclude = []
 if args.exclude_columns is not None:
     columns_to_exclude = args.exclude_columns.split(',')
+other_trees = args.other_trees.split(',') if args.other_trees is not None else []
 
-inputs = ROOT.vector('string')()
-if args.input.endswith('.root'):
-    inputs.push_back(args.input_prefix + args.input)
-    print("Adding input '{}'...".format(args.input))
-elif args.input.endswith('.txt'):
-    with open(args.input, 'r') as input_list:
-        for name in input_list.readlines():
-            name = name.strip()
-            if len(name) > 0 and name[0] != '#':
-                inputs.push_back(args.input_prefix + name)
-                print("Adding input '{}'...".format(name))
-elif os.path.isdir(args.input):
-    for f in os.listdir(args.input):
-        if not f.endswith('.root'): continue
-        file_name = os.path.join(args.input, f)
-        inputs.push_back(file_name)
-        print("Adding input '{}'...".format(file_name))
-else:
-    raise RuntimeError("Input format is not supported.")
-
-df = ROOT.RDataFrame(args.tree, inputs)
-
-if args.input_range is not None:
-    begin, end = [ int(x) for x in args.input_range.split(':') ]
-    df = df.Range(begin, end)
-
-if args.processing_module is not None:
-    module_desc = args.processing_module.split(':')
-    import imp
-    module = imp.load_source('processing', module_desc[0])
-    fn = getattr(module, module_desc[1])
-    df = fn(df)
-
-branches = ROOT.vector('string')()
-for column in df.GetColumnNames():
-    include_column = False
-    if len(columns_to_include) == 0 or column in columns_to_include:
-        include_column = True
-    if column in columns_to_exclude:
-        include_column = False
-    if include_column:
-        branches.push_back(column)
-        print("Adding column '{}'...".format(column))
-
-if args.sel is not None:
-    df = df.Filter(args.sel)
+inputs = get_inputs()
+for name in inputs:
+    print("Adding input '{}'...".format(name))
 
+input_range = parse_range(args.input_range)
+# Range is not available in multi-threaded event loops and the output range depends on the order of the entries,
+# hence a range skim is split into sub-ranges, each processed single-threaded in a separate process.
+n_threads = args.n_threads
 if args.output_range is not None:
-    begin, end = [ int(x) for x in args.output_range.split(':') ]
-    df = df.Range(begin, end)
+    n_threads = 1
+sub_ranges = split_range(input_range, n_threads) if input_range is not None else None
+
+output_dir = os.path.dirname(os.path.abspath(args.output))
+with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+    main_parts = []
+    if sub_ranges is not None and len(sub_ranges) > 1:
+        print("Skimming {} sub-ranges of {} in parallel...".format(len(sub_ranges), args.tree))
+        tasks = [ (inputs, os.path.join(tmp_dir, '{}_{}.root'.format(args.tree, n)), sub_range, n == 0)
+                  for n, sub_range in enumerate(sub_ranges) ]
+        with multiprocessing.Pool(len(tasks)) as pool:
+            main_parts = pool.map(skim_sub_range, tasks)
+        sub_ranges = None
 
-print("Creating a snapshot...")
-opt = ROOT.RDF.RSnapshotOptions()
-opt.fCompressionAlgorithm = getattr(ROOT.ROOT, 'k' + args.comp_algo)
-opt.fCompressionLevel = args.comp_level
-df.Snapshot(args.tree, args.output, branches, opt)
+    if n_threads > 1 and sub_ranges is None:
+        ROOT.ROOT.EnableImplicitMT(n_threads)
 
-if args.other_trees is not None:
-    other_trees = args.other_trees.split(',')
+    # All remaining trees are booked lazily and written in a single concurrent run of the event loops.
+    # Each tree is written into a separate file, because snapshots can not update the same file concurrently.
+    handles = []
+    if len(main_parts) == 0:
+        main_output = os.path.join(tmp_dir, '{}.root'.format(args.tree))
+        main_range = sub_ranges[0] if sub_ranges is not None else None
+        handles.append(book_main_tree(inputs, main_output, main_range, lazy=True, verbose=True))
+        main_parts.append(main_output)
+    other_parts = []
     for tree_name in other_trees:
-        print("Copying {}...".format(tree_name))
-        other_df = ROOT.RDataFrame(tree_name, inputs)
-        branches = ROOT.vector('string')()
-        for column in other_df.GetColumnNames():
-            branches.push_back(column)
-            print("\tAdding column '{}'...".format(column))
-        opt.fMode = 'UPDATE'
-        other_df.Snapshot(tree_name, args.output, branches, opt)
+        print("Booking a copy of {}...".format(tree_name))
+        other_output = os.path.join(tmp_dir, '{}.root'.format(tree_name))
+        handles.append(book_other_tree(inputs, tree_name, other_output, lazy=True))
+        other_parts.append(other_output)
+
+    if len(handles) > 0:
+        print("Creating snapshots...")
+        if hasattr(ROOT.RDF, 'RunGraphs'):
+            ROOT.RDF.RunGraphs(handles)
+        else:
+            for handle in handles:
+                handle.GetValue()
+
+    merge_files(main_parts + other_parts, args.output)
 
 print("Skim successfully finished.")
@@ -6,47 +6,141 @@ parser.add_argument('--input', required=True, type=str, help="Input root file")
 parser.add_argument('--tree', required=True, type=str, help="Tree name")
 parser.add_argument('--max-entries', required=False, type=int, default=None,
                     help="Maximal number of entries to process")
+parser.add_argument('--branches', required=False, type=str, default=None,
+                    help="Comma separated list of branches to check (default: all branches)")
+parser.add_argument('--chunk-size', required=False, type=int, default=100000, help="Number of entries per iteration")
+parser.add_argument('--n-threads', required=False, type=int, default=4,
+                    help="Number of threads used for decompression and for the computation of the statistics")
+parser.add_argument('--output-csv', required=False, type=str, default=None, help="Output CSV file with the report")
+parser.add_argument('--output-json', required=False, type=str, default=None, help="Output JSON file with the report")
+parser.add_argument('--max-nan-frac', required=False, type=float, default=None,
+                    help="Fail (non-zero exit code) if the fraction of NaN values in any branch exceeds this value")
+parser.add_argument('--max-inf-frac', required=False, type=float, default=None,
+                    help="Fail (non-zero exit code) if the fraction of inf values in any branch exceeds this value")
 args = parser.parse_args()
 
-import uproot
-import pandas
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import awkward as ak
+import numba
 import numpy as np
-
-with uproot.open(args.input) as file:
-    tree = file[args.tree]
-    #df = tree.arrays('*', outputtype=pandas.DataFrame, entrystop=args.max_entries)
-    df = tree.arrays('*', entrystop=args.max_entries)
+import uproot
 
 std_thr = 1e-7
 valid_thr = -1e9
 
-#print("dataset size: {} features, {} entries".format(df.shape[1], df.shape[0]))
-print(",".join(["feature", "min", "max", "average", "std", "abs_max", "abs_avg", "is_const"]))
-# print("{:<50}{:>15}{:>15}{:>15}{:>15}{:>15}{:>15}{:>10}".format("feature", "min", "max", "average", "std", "abs_max",
-#                                                                 "abs_avg", "is_const"))
-for column in sorted(df):
-    #values = get_flat(df[column])
-    values = df[column].flatten()
-    values = values[values > valid_thr]
-    # if values.shape[0] == 0:
-    #     raise RuntimeError("Feature '' is empty.".format(column))
-    # if column == "isoTrack_dz_error":
-    #     print(column)
-    #     print(values)
-    if values.shape[0] > 0:
-        avg = np.average(values)
-        std = np.std(values)
-        amin = np.amin(values)
-        amax = np.amax(values)
-        abs_values = np.abs(values)
-        abs_avg = np.average(abs_values)
-        abs_max = np.amax(abs_values)
+# Layout of the per-branch accumulator
+N_TOTAL, N_NAN, N_INF, N_VALID, SHIFT, SUM, SUM2, ABS_SUM, MIN, MAX = range(10)
+
+def create_accumulator():
+    acc = np.zeros(10)
+    acc[SHIFT] = np.nan
+    acc[MIN] = np.inf
+    acc[MAX] = -np.inf
+    return acc
+
+@numba.njit(nogil=True)
+def fill_accumulator(acc, values):
+    """Updates all statistics in a single pass over the values.
+    Sums are computed relative to the first valid value to avoid a loss of precision in the variance."""
+    shift = acc[SHIFT]
+    for x in values:
+        acc[N_TOTAL] += 1
+        if np.isnan(x):
+            acc[N_NAN] += 1
+            continue
+        if np.isinf(x):
+            acc[N_INF] += 1
+            continue
+        if not x > valid_thr:
+            continue
+        if np.isnan(shift):
+            shift = x
+            acc[SHIFT] = x
+        dx = x - shift
+        acc[N_VALID] += 1
+        acc[SUM] += dx
+        acc[SUM2] += dx * dx
+        acc[ABS_SUM] += abs(x)
+        if x < acc[MIN]:
+            acc[MIN] = x
+        if x > acc[MAX]:
+            acc[MAX] = x
+
+def summarize(column, acc):
+    n_valid = acc[N_VALID]
+    if n_valid > 0:
+        mean_shifted = acc[SUM] / n_valid
+        avg = acc[SHIFT] + mean_shifted
+        std = np.sqrt(max(acc[SUM2] / n_valid - mean_shifted ** 2, 0.))
+        amin, amax = acc[MIN], acc[MAX]
+        abs_avg = acc[ABS_SUM] / n_valid
+        abs_max = max(abs(amin), abs(amax))
     else:
-        avg = std = abs_avg = abs_max = amax = amin = np.NAN
+        avg = std = abs_avg = abs_max = amax = amin = np.nan
+    n_total = acc[N_TOTAL]
+    return {
+        'feature': column,
+        'min': float(amin),
+        'max': float(amax),
+        'average': float(avg),
+        'std': float(std),
+        'abs_max': float(abs_max),
+        'abs_avg': float(abs_avg),
+        'is_const': bool(not (std > std_thr)),
+        'n_values': int(n_total),
+        'nan_frac': float(acc[N_NAN] / n_total) if n_total > 0 else 0.,
+        'inf_frac': float(acc[N_INF] / n_total) if n_total > 0 else 0.,
+    }
+
+def to_flat_numpy(array):
+    values = ak.to_numpy(ak.flatten(array, axis=None))
+    if values.dtype == bool:
+        values = values.astype(np.uint8)
+    return values
+
+csv_columns = [ "feature", "min", "max", "average", "std", "abs_max", "abs_avg", "is_const", "nan_frac", "inf_frac" ]
+def format_csv_row(row):
+    return "{},{:.4E},{:.4E},{:.4E},{:.4E},{:.4E},{:.4E},{},{:.4E},{:.4E}".format(
+        *[ row[c] for c in csv_columns[:7] ], str(row['is_const']), row['nan_frac'], row['inf_frac'])
+
+with ThreadPoolExecutor(args.n_threads) as executor, \
+     uproot.open(args.input, decompression_executor=executor) as file:
+    tree = file[args.tree]
+    if args.branches is not None:
+        branches = args.branches.split(',')
+    else:
+        branches = tree.keys()
+    accumulators = { column: create_accumulator() for column in branches }
+    for chunk in tree.iterate(branches, step_size=args.chunk_size, entry_stop=args.max_entries, library='ak'):
+        # each branch has its own accumulator, therefore branches can be processed concurrently
+        list(executor.map(lambda column: fill_accumulator(accumulators[column], to_flat_numpy(chunk[column])),
+                          branches))
+
+report = [ summarize(column, accumulators[column]) for column in sorted(branches) ]
+
+print(",".join(csv_columns))
+for row in report:
+    print(format_csv_row(row))
+
+if args.output_csv is not None:
+    with open(args.output_csv, 'w') as f:
+        f.write(",".join(csv_columns) + "\n")
+        for row in report:
+            f.write(format_csv_row(row) + "\n")
 
-    is_const = not (std > std_thr)
+if args.output_json is not None:
+    with open(args.output_json, 'w') as f:
+        json.dump(report, f, indent=4)
 
-    print("{},{:.4E},{:.4E},{:.4E},{:.4E},{:.4E},{:.4E},{}".format(column, amin, amax, avg, std, abs_max, abs_avg,
-                                                                  str(is_const)))
-    # print("{:<50}{:>15.4E}{:>15.4E}{:>15.4E}{:>15.4E}{:>15.4E}{:>15.4E}{:>10}".format(column, amin, amax, avg, std,
-    #       abs_max, abs_avg, str(is_const)))
+failed = []
+for row in report:
+    if args.max_nan_frac is not None and row['nan_frac'] > args.max_nan_frac:
+        failed.append("{}: NaN fraction = {:.4E}".format(row['feature'], row['nan_frac']))
+    if args.max_inf_frac is not None and row['inf_frac'] > args.max_inf_frac:
+        failed.append("{}: inf fraction = {:.4E}".format(row['feature'], row['inf_frac']))
+if len(failed) > 0:
+    print("Data quality check failed for {} branch(es):\n  {}".format(len(failed), "\n  ".join(failed)),
+          file=sys.stderr)
+    sys.exit(1)
@@ -10,7 +10,7 @@ import hydra
 from hydra.utils import to_absolute_path, instantiate, call
 from omegaconf import DictConfig, ListConfig
 
-import uproot
+import eval_tools
 
 @dataclass
 class WPMaker:
@@ -18,6 +18,7 @@ class WPMaker:
     tpr_step: int = 0.0001
     require_wp_vs_others: bool = True
     WPs_to_require: dict = None
+    weight_column: str = None
     epsilon: float = 1e-7
     n_iterations: int = 100
     verbose: bool = False
@@ -34,6 +35,24 @@ class WPMaker:
     def tau_vs_other(prob_tau, prob_other):
         return np.where(prob_tau > 0, prob_tau / (prob_tau + prob_other), np.zeros(prob_tau.shape))
 
+    @staticmethod
+    def weighted_quantile(sorted_values, sorted_weights, q):
+        # unweighted (or uniformly weighted) taus: reproduces np.quantile with linear interpolation,
+        # i.e. the i-th value is placed at i/(n-1)
+        # weighted taus: step CDF, the quantile is the first value at which the cumulative weight reaches q * total
+        if len(sorted_values) == 0:
+            raise RuntimeError('No taus left to compute quantiles')
+        if np.any(sorted_weights < 0):
+            raise RuntimeError('Negative weights are not supported in the computation of quantiles')
+        if np.all(sorted_weights == sorted_weights[0]):
+            if sorted_weights[0] == 0:
+                raise RuntimeError('Sum of the weights of the taus is zero')
+            return np.interp(q, np.linspace(0, 1, len(sorted_values)), sorted_values)
+        non_zero = sorted_weights > 0 # values without weight do not affect the quantiles
+        sorted_values, cum_weights = sorted_values[non_zero], np.cumsum(sorted_weights[non_zero])
+        idx = np.searchsorted(cum_weights, np.asarray(q) * cum_weights[-1], side='left')
+        return sorted_values[np.minimum(idx, len(sorted_values) - 1)]
+
     def _reset_thrs(self):
         for vs_type in self.vs_types:
             WPs = self.wp_definitions[vs_type]
@@ -41,35 +60,62 @@ class WPMaker:
                 wp_cfg['thrs'] = []
         self.__converged = False
 
+    def _prepare_taus(self):
+        # presort scores once per vs_type, the order is then reused for quantile lookups and updates of pass masks
+        n_taus = self._taus.shape[0]
+        self._weights = self._taus[self.weight_column].values if self.weight_column is not None else np.ones(n_taus)
+        if np.any(self._weights < 0):
+            raise RuntimeError(f'Negative values in the weight column "{self.weight_column}" are not supported')
+        self._order, self._sorted_scores, self._pass_masks, self._pass_thrs = {}, {}, {}, {}
+        for vs_type in self.vs_types:
+            scores = self._taus[f'score_vs_{vs_type}'].values
+            self._order[vs_type] = np.argsort(scores, kind='stable')
+            self._sorted_scores[vs_type] = scores[self._order[vs_type]]
+            self._pass_masks[vs_type] = np.ones(n_taus, dtype=bool) # score_vs_{vs_type} > self._pass_thrs[vs_type]
+            self._pass_thrs[vs_type] = -np.inf
+
+    def _update_pass_mask(self, vs_type, thr):
+        # only taus with the score between the previous and the new threshold change their state
+        old_thr = self._pass_thrs[vs_type]
+        if thr == old_thr: return
+        idx_old, idx_new = np.searchsorted(self._sorted_scores[vs_type], [old_thr, thr], side='right')
+        self._pass_masks[vs_type][self._order[vs_type][min(idx_old, idx_new):max(idx_old, idx_new)]] = thr < old_thr
+        self._pass_thrs[vs_type] = thr
+
     def is_converged(self):
         return self.__converged
 
-    def apply_wp_vs_others(self, current_vs_type):
-        df = self._taus
+    def wp_vs_others_mask(self, current_vs_type):
+        mask = np.ones(self._taus.shape[0], dtype=bool)
         for other_vs_type in self.vs_types:
             if other_vs_type == current_vs_type: continue
             wp_to_require = self.WPs_to_require[other_vs_type]
             thrs = self.wp_definitions[other_vs_type][wp_to_require]['thrs'] # select thresholds for specified WP
             if len(thrs) > 0:
-                sel_thr = thrs[-1] # select the last computed threshold
-                df = df.query(f'score_vs_{other_vs_type} > {sel_thr}', inplace=False) # require passing it
-        return df
+                self._update_pass_mask(other_vs_type, thrs[-1]) # select the last computed threshold
+                mask &= self._pass_masks[other_vs_type] # require passing it
+        return mask
+
+    def apply_wp_vs_others(self, current_vs_type):
+        return self._taus[self.wp_vs_others_mask(current_vs_type)]
 
     def update_thrs(self):
         thrs = {}
         # firstly compute and collect thresholds
-        for vs_type in self.vs_types:
+        for vs_type, WPs in self.wp_definitions.items():
+            order = self._order[vs_type]
             if self.require_wp_vs_others: # apply loosest WP from the previous iteration 
-                taus = self.apply_wp_vs_others(vs_type)
+                sel = self.wp_vs_others_mask(vs_type)[order]
+                sorted_scores, sorted_weights = self._sorted_scores[vs_type][sel], self._weights[order][sel]
             else:
-                taus = self._taus 
-            thrs[vs_type] = np.quantile(taus[f'score_vs_{vs_type}'], 1 - self.tpr)
+                sorted_scores, sorted_weights = self._sorted_scores[vs_type], self._weights[order]
+            wp_tpr = [self.tpr[(self.tpr >= wp_cfg["eff"]).argmax()] for wp_cfg in WPs.values()]
+            thrs[vs_type] = self.weighted_quantile(sorted_scores, sorted_weights, 1 - np.array(wp_tpr))
 
         # then update them in the class 
         for vs_type, WPs in self.wp_definitions.items():
-            for wp_cfg in WPs.values():
-                idx = (self.tpr >= wp_cfg["eff"]).argmax()
-                wp_cfg['thrs'].append(thrs[vs_type][idx])
+            for wp_cfg, thr in zip(WPs.values(), thrs[vs_type]):
+                wp_cfg['thrs'].append(thr)
 
     def print_wp(self):
         print("\nworking_points = {")
@@ -83,6 +129,7 @@ class WPMaker:
     def run(self):
         if self.__converged:
             self._reset_thrs()
+        self._prepare_taus()
         
         for i in range(self.n_iterations):
             print("\n-> Iteration", i)
@@ -104,9 +151,10 @@ class WPMaker:
                 print('\n-> Converged!')
                 break
 
-def create_df(path_to_preds, pred_samples, input_branches, input_tree_name, selection, **kwargs):
+def create_df(path_to_preds, pred_samples, input_branches, input_tree_name, selection, path_to_df_cache=None, run_id=None, **kwargs):
     df = []
     path_to_preds = os.path.abspath(to_absolute_path(path_to_preds))
+    path_to_df_cache = to_absolute_path(path_to_df_cache) if path_to_df_cache is not None else None
 
     # loop over input samples
     for sample_name, filename_pattern in pred_samples.items():
@@ -121,37 +169,22 @@ def create_df(path_to_preds, pred_samples, input_branches, input_tree_name, sele
             pred_files = glob(f'{path_to_preds}/{sample_name}/{filename_pattern}')
         else:
             raise Exception(f"unknown type of filename_pattern: {type(filename_pattern)}")
-        
-        for pred_file in pred_files:
-            # read predictions and labels
-            l_ = []
-            for group in ['predictions', 'targets']:
-                df_ = pd.read_hdf(pred_file, group)
-                df_ = df_.rename(columns={column: f'{group}_{column}' for column in df_.columns})
-                l_.append(df_)
-            assert l_[0].shape[0] == l_[1].shape[0], "Sizes of prediction and target dataframes don't match."
-            df_pred = pd.concat(l_, axis=1)
-
-            # read input_branches from the corresponding input file
-            with uproot.open(target_input_map[pred_file]) as f:
-                df_input = f[input_tree_name].arrays(input_branches, library='pd')
-            
-            # concatenate input branches and predictions/labels
-            assert df_pred.shape[0] == df_input.shape[0], "Sizes of prediction and input dataframes don't match."
-            df_ = pd.concat([df_pred, df_input], axis=1)
-            assert not any(df_.isna().any(axis=0)), 'found NaNs!'
-            df.append(df_)
-
-    # select+combine taus across input samples and apply selection
-    df = pd.concat(df, axis=0)
-    taus = df.query(f'targets_node_tau==1')
+        input_files = [target_input_map[pred_file] for pred_file in pred_files]
+
+        # read predictions, labels and input_branches from the corresponding input files, keeping only genuine taus
+        df_ = eval_tools.create_sample_df(sample_name, input_files, pred_files, pred_files, [], list(input_branches), 'node_', 'node_',
+                                          tau_types=['tau'], input_tree_name=input_tree_name, path_to_cache=path_to_df_cache, run_id=run_id)
+        assert not any(df_.isna().any(axis=0)), 'found NaNs!'
+        df.append(df_)
+
+    # combine taus across input samples and apply selection
+    taus = pd.concat(df, axis=0, ignore_index=True)
     if selection is not None:
         taus = taus.query(selection)
 
-    # compute vs_type discriminator scores
+    # vs_type discriminator scores are computed in `eval_tools.create_df()`
     vs_types = ['e', 'mu', 'jet']
-    for vs_type in vs_types:
-        taus['score_vs_' + vs_type] = WPMaker.tau_vs_other(taus['predictions_node_tau'].values, taus['predictions_node_' + vs_type].values)
+    taus = taus.rename(columns={f'node_{vs_type}': f'score_vs_{vs_type}' for vs_type in vs_types})
    
     print(f'\n-> Selected {taus.shape[0]} taus\n')
     return taus
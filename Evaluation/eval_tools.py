@@ -5,11 +5,10 @@ import math
 import copy
 from sklearn import metrics
 from scipy import interpolate
-from _ctypes import PyObj_FromPtr
 import os
 import h5py
 import json
-import re
+import hashlib
 import sys
 from glob import glob
 from dataclasses import dataclass, field
@@ -30,6 +29,7 @@ class RocCurve:
         self.ratio = None
         self.thresholds = None
         self.auc_score = None
+        self.auc_error = None
         self.dots_only = dots_only
         self.dashed = dashed
         self.marker_size = '5'
@@ -93,6 +93,111 @@ class RocCurve:
             pruned.pr_err[:, :, :] = self.pr_err[:, :, idx]
         return pruned
 
+class ScoreHistograms:
+    """Weighted histograms of discriminator scores for genuine taus (index 1) and fakes (index 0).
+
+    Bin k contains the scores edges[k] < score <= edges[k+1], so that the sum of weights of the bins above an edge
+    is the sum of weights with score > edge, as in Discriminator.count_passed(). Scores outside of the range are
+    clipped to it, i.e. put into the first (score <= edges[0]) or the last (score > edges[-1]) bin. NaN scores are
+    counted separately in sumw_nan: they are included in the totals and never pass a threshold.
+    ROC points are evaluated at the bin edges, where they coincide with the points of the exact ROC curve,
+    so the approximation only comes from the limited number of thresholds. Histograms filled from different
+    files with the same binning can be added together, which allows to run the evaluation as map/reduce.
+    """
+    def __init__(self, n_bins=10000, score_range=(0., 1.)):
+        self.edges = np.linspace(score_range[0], score_range[1], n_bins + 1)
+        self.sumw = np.zeros((2, n_bins))
+        self.sumw2 = np.zeros((2, n_bins))
+        self.sumw_nan = np.zeros(2)
+
+    @property
+    def n_bins(self):
+        return len(self.edges) - 1
+
+    @property
+    def n_total(self):
+        return self.sumw.sum(axis=1) + self.sumw_nan
+
+    def Fill(self, labels, scores, weights=None):
+        if weights is None:
+            weights = np.ones(len(scores))
+        is_nan = np.isnan(scores)
+        bin_idx = np.clip(np.searchsorted(self.edges, scores, side='left') - 1, 0, self.n_bins - 1)
+        for kind in [0, 1]:
+            sel = (labels == kind) & ~is_nan
+            self.sumw[kind] += np.bincount(bin_idx[sel], weights=weights[sel], minlength=self.n_bins)
+            self.sumw2[kind] += np.bincount(bin_idx[sel], weights=weights[sel]**2, minlength=self.n_bins)
+            self.sumw_nan[kind] += np.sum(weights[(labels == kind) & is_nan])
+        return self
+
+    def __iadd__(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise RuntimeError('Unable to add score histograms with different binning.')
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        self.sumw_nan += other.sumw_nan
+        return self
+
+    @staticmethod
+    def Merge(hists_list):
+        merged = copy.deepcopy(hists_list[0])
+        for hists in hists_list[1:]:
+            merged += hists
+        return merged
+
+    def Save(self, path):
+        np.savez(path, edges=self.edges, sumw=self.sumw, sumw2=self.sumw2, sumw_nan=self.sumw_nan)
+
+    @staticmethod
+    def Load(path):
+        with np.load(path) as data:
+            hists = ScoreHistograms(len(data['edges']) - 1, (data['edges'][0], data['edges'][-1]))
+            hists.sumw[:, :] = data['sumw']
+            hists.sumw2[:, :] = data['sumw2']
+            if 'sumw_nan' in data:
+                hists.sumw_nan[:] = data['sumw_nan']
+        return hists
+
+    def CountPassed(self, thrs):
+        """Returns sum of weights with score > thr per class and threshold (shape [2, len(thrs)]), linearly interpolated
+        within the bin containing thr, together with the maximal deviation from the exact value (i.e. the content of that bin).
+        At the edges the result is exact, except for the thresholds at or outside of the range limits, where the clipped
+        scores of the first/last bin are counted as passing below the range and as failing above it."""
+        thrs = np.atleast_1d(thrs)
+        # bin k covers edges[k] < thr <= edges[k+1], as in Fill()
+        thr_bin = np.clip(np.searchsorted(self.edges, thrs, side='left') - 1, 0, self.n_bins - 1)
+        bin_frac = np.clip((self.edges[thr_bin + 1] - thrs) / (self.edges[thr_bin + 1] - self.edges[thr_bin]), 0., 1.)
+        passed_above = np.zeros((2, self.n_bins + 1)) # sum of weights in bins with index >= k
+        passed_above[:, :-1] = np.cumsum(self.sumw[:, ::-1], axis=1)[:, ::-1]
+        n_passed = passed_above[:, thr_bin + 1] + bin_frac * self.sumw[:, thr_bin]
+        n_passed_bound = np.where((bin_frac > 0) & (bin_frac < 1) | (thrs <= self.edges[0]) | (thrs >= self.edges[-1]),
+                                  self.sumw[:, thr_bin], 0.)
+        return n_passed, n_passed_bound
+
+    def CreateRocCurve(self, color, dashed=False):
+        n_total = self.n_total
+        if np.any(n_total <= 0):
+            return None
+        # sum of weights with score > thr, where thr goes over the edges from the tightest to the loosest cut
+        passed = np.zeros((2, self.n_bins + 1))
+        passed[:, 1:] = np.cumsum(self.sumw[:, ::-1], axis=1)
+        pr = passed / n_total[:, np.newaxis]
+        thresholds = self.edges[::-1]
+
+        # drop thresholds which don't change the ROC point
+        keep = np.ones(pr.shape[1], dtype=bool)
+        keep[1:] = np.any(np.diff(pr, axis=1) != 0, axis=0)
+        pr, thresholds = pr[:, keep], thresholds[keep]
+
+        roc = RocCurve(pr.shape[1], color, False, dashed=dashed)
+        roc.pr[:, :] = pr
+        roc.thresholds = thresholds
+        roc.auc_score = metrics.auc(roc.pr[0, :], roc.pr[1, :])
+        # between two neighbouring edges the exact ROC curve is a monotone path within the box spanned by them,
+        # hence the trapezoid deviates from the exact area by at most half of the box area
+        roc.auc_error = 0.5 * np.sum(np.diff(roc.pr[0, :]) * np.diff(roc.pr[1, :]))
+        return roc
+
 @dataclass
 class PlotSetup:
     xlim: list = None
@@ -156,6 +261,9 @@ class Discriminator:
     wp_name_to_index: dict = None
     working_points: list = field(default_factory=list)
     working_points_thrs: dict = None 
+    roc_approx: bool = False # compute ROC curve and WP efficiencies from score histograms
+    roc_n_bins: int = 10000
+    roc_score_range: list = field(default_factory=lambda: [0., 1.])
 
     def __post_init__(self):
         if self.wp_from is None:
@@ -178,8 +286,55 @@ class Discriminator:
         else:
             raise RuntimeError(f'count_passed() behaviour not defined for: wp_from={self.wp_from}')
         
-    def create_roc_curve(self, df):
+    def count_passed_all(self, df):
+        """Returns sum of weights passing each of the working points (shape [2, n_wp]) and total sum of weights (shape [2])
+        for gen_tau == 0 and gen_tau == 1."""
+        gen_tau = df['gen_tau'].values
+        weights = df.weight.values
+        n_passed = np.zeros((2, len(self.working_points)))
+        n_total = np.zeros(2)
+        if self.wp_from == 'wp_column':
+            assert self.wp_column in df.columns
+            wp_column = df[self.wp_column].values
+            wp_flags = np.array([1 << self.wp_name_to_index[wp_name] for wp_name in self.working_points]).astype(wp_column.dtype)
+            passed = np.bitwise_and(wp_column[:, np.newaxis], wp_flags) != 0
+            for kind in [0, 1]:
+                sel = gen_tau == kind
+                n_passed[kind] = weights[sel] @ passed[sel]
+                n_total[kind] = np.sum(weights[sel])
+        elif self.wp_from == 'pred_column':
+            if self.working_points_thrs is None:
+                raise RuntimeError('Working points thresholds are not specified for discriminator "{}"'.format(self.name))
+            assert self.pred_column in df.columns
+            wp_thrs = np.array([self.working_points_thrs[wp_name] for wp_name in self.working_points])
+            scores = df[self.pred_column].values
+            # NaN scores are sorted last by argsort and would pass every threshold: they never pass, as in count_passed
+            valid = ~np.isnan(scores)
+            for kind in [0, 1]:
+                sel = gen_tau == kind
+                sel_valid = sel & valid
+                order = np.argsort(scores[sel_valid], kind='stable')
+                sorted_scores = scores[sel_valid][order]
+                # tail_weights[i] = sum of the weights of the entries from position i on, accumulated from the highest score,
+                # so that the tight WPs are not computed as a difference of two large sums
+                tail_weights = np.zeros(len(order) + 1)
+                tail_weights[:-1] = np.cumsum(weights[sel_valid][order][::-1])[::-1]
+                # entries after position searchsorted(thr, side='right') have score > thr
+                n_passed[kind] = tail_weights[np.searchsorted(sorted_scores, wp_thrs, side='right')]
+                n_total[kind] = np.sum(weights[sel])
+        else:
+            raise RuntimeError(f'count_passed_all() behaviour not defined for: wp_from={self.wp_from}')
+        return n_passed, n_total
+
+    def fill_score_hists(self, df, hists=None):
+        if hists is None:
+            hists = ScoreHistograms(self.roc_n_bins, self.roc_score_range)
+        return hists.Fill(df['gen_tau'].values, df[self.pred_column].values, df.weight.values)
+
+    def create_roc_curve(self, df, hists=None):
         roc, wp_roc = None, None
+        if self.roc_approx and hists is None:
+            hists = self.fill_score_hists(df)
         if self.raw: # construct ROC curve
 
             # print(self.pred_column)
@@ -189,16 +344,23 @@ class Discriminator:
             # print((df[df["gen_tau"]==0][self.pred_column]<0).value_counts())
             # print((df[df["gen_tau"]==0][self.pred_column]>1).value_counts())
 
-            fpr, tpr, thresholds = metrics.roc_curve(df['gen_tau'].values, df[self.pred_column].values, sample_weight=df.weight.values)
-            roc = RocCurve(len(fpr), self.color, False, dashed=self.dashed)
-            roc.pr[0, :] = fpr
-            roc.pr[1, :] = tpr
-            roc.thresholds = thresholds
-            if not (np.isnan(roc.pr[0, :]).any() or np.isnan(roc.pr[1, :]).any()):
-              roc.auc_score = metrics.roc_auc_score(df['gen_tau'].values, df[self.pred_column].values, sample_weight=df.weight.values)
+            if hists is not None:
+                roc = hists.CreateRocCurve(self.color, dashed=self.dashed)
+                if roc is None:
+                    print('[INFO] ROC curve is empty!')
+                    return None, None
+                print(f'[INFO] ROC curve from score histograms with {hists.n_bins} bins, AUC uncertainty <= {roc.auc_error:.2e}')
             else:
-              print('[INFO] ROC curve is empty!')
-              return None, None
+                fpr, tpr, thresholds = metrics.roc_curve(df['gen_tau'].values, df[self.pred_column].values, sample_weight=df.weight.values)
+                roc = RocCurve(len(fpr), self.color, False, dashed=self.dashed)
+                roc.pr[0, :] = fpr
+                roc.pr[1, :] = tpr
+                roc.thresholds = thresholds
+                if not (np.isnan(roc.pr[0, :]).any() or np.isnan(roc.pr[1, :]).any()):
+                  roc.auc_score = metrics.roc_auc_score(df['gen_tau'].values, df[self.pred_column].values, sample_weight=df.weight.values)
+                else:
+                  print('[INFO] ROC curve is empty!')
+                  return None, None
         else:
             print('[INFO] raw=False, will skip creating ROC curve')        
         
@@ -206,21 +368,29 @@ class Discriminator:
         if self.wp_from in ['wp_column', 'pred_column']:  
             if (n_wp:=len(self.working_points)) > 0:
                 wp_roc = RocCurve(n_wp, self.color, not self.raw, self.raw)
-                for wp_i, wp_name in enumerate(self.working_points):
+                if hists is not None and self.wp_from == 'pred_column':
+                    if self.working_points_thrs is None:
+                        raise RuntimeError('Working points thresholds are not specified for discriminator "{}"'.format(self.name))
+                    n_passed, n_passed_bound = hists.CountPassed([self.working_points_thrs[wp_name] for wp_name in self.working_points])
+                    n_total = hists.n_total
                     for kind in [0, 1]:
-                        df_x = df[df['gen_tau'] == kind]
-                        n_passed = self.count_passed(df_x, wp_name)
-                        n_total = np.sum(df_x.weight.values)
-                        eff = float(n_passed) / n_total if n_total > 0 else 0.0
-                        wp_roc.pr[kind, n_wp - wp_i - 1] = eff
-                        if not self.raw:
-                            if sys.version_info.major > 2:
-                                ci_low, ci_upp = proportion_confint(n_passed, n_total, alpha=1-0.68, method='beta')
-                            else:
-                                err = math.sqrt(eff * (1 - eff) / n_total)
-                                ci_low, ci_upp = eff - err, eff + err
-                            wp_roc.pr_err[kind, 1, n_wp - wp_i - 1] = ci_upp - eff
-                            wp_roc.pr_err[kind, 0, n_wp - wp_i - 1] = eff - ci_low
+                        for wp_i, wp_name in enumerate(self.working_points):
+                            if n_total[kind] > 0 and n_passed_bound[kind, wp_i] / n_total[kind] > 1e-3:
+                                print(f'[INFO] {wp_name} efficiency (gen_tau={kind}) from score histograms is uncertain up to {n_passed_bound[kind, wp_i] / n_total[kind]:.2e}')
+                else:
+                    n_passed, n_total = self.count_passed_all(df)
+                n_total = np.repeat(n_total[:, np.newaxis], n_wp, axis=1)
+                eff = np.divide(n_passed, n_total, out=np.zeros((2, n_wp)), where=n_total > 0)
+                # WPs are stored from the tightest to the loosest one
+                wp_roc.pr[:, :] = eff[:, ::-1]
+                if not self.raw:
+                    if sys.version_info.major > 2:
+                        ci_low, ci_upp = proportion_confint(n_passed, n_total, alpha=1-0.68, method='beta')
+                    else:
+                        err = np.sqrt(eff * (1 - eff) / n_total)
+                        ci_low, ci_upp = eff - err, eff + err
+                    wp_roc.pr_err[:, 1, :] = (ci_upp - eff)[:, ::-1]
+                    wp_roc.pr_err[:, 0, :] = (eff - ci_low)[:, ::-1]
             else:
                 raise RuntimeError('No working points specified')
         elif self.wp_from is None:
@@ -267,72 +437,114 @@ def select_curve(curve_list, **selection):
     else:
         raise Exception(f"Failed to find a single curve for selection: {[f'{k}=={v}' for k,v in selection.items()]}")
 
-def create_df(path_to_input_file, input_branches, id_branches, path_to_pred_file, path_to_target_file, path_to_weights, pred_column_prefix=None, target_column_prefix=None):
-    def read_branches(path_to_file, tree_name, branches):
-        if not os.path.exists(path_to_input_file):
-            raise RuntimeError(f"Specified file for inputs ({path_to_input_file}) does not exist")
-        if path_to_file.endswith('.root'):
-            with uproot.open(path_to_file) as f:
-                tree = f[tree_name]
-                df = tree.arrays(branches, library='pd')
-            return df
-        elif path_to_file.endswith('.h5') or path_to_file.endswith('.hdf5'):
-            return pd.read_hdf(path_to_file, tree_name)
-        raise RuntimeError("Unsupported file type.")
-
-    def add_group(df, group_name, path_to_file, group_column_prefix):
-        if not os.path.exists(path_to_file):
-            raise RuntimeError(f"Specified file {path_to_file} for {group_name} does not exist")
+def read_columns(path_to_file, key, columns=None):
+    """Reads the specified columns (all if None) from a ROOT tree or from a group of a pandas HDF5 file
+    into a dictionary of numpy arrays. Only the requested columns are read from disk."""
+    if not os.path.exists(path_to_file):
+        raise RuntimeError(f"Specified file {path_to_file} does not exist")
+    if path_to_file.endswith('.root'):
+        with uproot.open(path_to_file) as f:
+            return f[key].arrays(columns, library='np')
+    elif path_to_file.endswith('.h5') or path_to_file.endswith('.hdf5'):
         with h5py.File(path_to_file, 'r') as f:
-            file_keys = list(f.keys())
-        if group_name in file_keys: 
-            group_df = pd.read_hdf(path_to_file, group_name)
-        else:
-            group_df = pd.read_hdf(path_to_file)
-        
-        # weight case
-        if group_name == 'weights':
-            group_df = pd.read_hdf(path_to_file)
-            df['weight'] = pd.Series(group_df['weight'].values, index=df.index)
-            return df
-        elif group_name == 'predictions': 
-            prob_tau = group_df[f'{group_column_prefix}tau'].values
-        elif group_name != 'targets':
-            raise ValueError(f'group_name should be one of [predictions, targets, weights], got {group_name}')
-        
-        # add columns for predictions/targets case
-        for node_column in group_df.columns:
-            if not node_column.startswith(group_column_prefix): continue # assume prediction column name to be "{group_column_prefix}{tau_type}"
-            tau_type = node_column.split(f'{group_column_prefix}')[-1] 
-            if group_name == 'predictions':
-                if tau_type != 'tau':
-                    prob_vs_type = group_df[group_column_prefix + tau_type].values
-                    tau_vs_other_type = np.where(prob_tau > 0, prob_tau / (prob_tau + prob_vs_type), np.zeros(prob_tau.shape))
-                    df[group_column_prefix + tau_type] = pd.Series(tau_vs_other_type, index=df.index)
-            elif group_name == 'targets':
-                df[f'gen_{tau_type}'] = group_df[node_column]
-        return df
-
+            if key is None:
+                if len(f.keys()) != 1:
+                    raise RuntimeError(f"Key should be specified for file {path_to_file} with multiple groups")
+                key = list(f.keys())[0]
+            group = f[key]
+            if group.attrs.get('pandas_type', b'') == b'frame' and all(f'block{i}_values' in group and isinstance(group[f'block{i}_values'], h5py.Dataset)
+                                                                       for i in range(group.attrs['nblocks'])):
+                # pandas "fixed" format: columns are stored in blocks of the same dtype with shape (n_rows, n_columns_in_block)
+                data = {}
+                for i in range(group.attrs['nblocks']):
+                    block_items = [item.decode() for item in group[f'block{i}_items'][:]]
+                    block_idx = [idx for idx, item in enumerate(block_items) if columns is None or item in columns]
+                    if len(block_idx) == 0: continue
+                    block_values = group[f'block{i}_values'][:, block_idx]
+                    data.update({block_items[idx]: block_values[:, n] for n, idx in enumerate(block_idx)})
+            else:
+                data = None
+        if data is None: # other formats are delegated to pandas
+            df = pd.read_hdf(path_to_file, key)
+            data = {column: df[column].values for column in df.columns if columns is None or column in columns}
+        if columns is not None and len(missing_columns := set(columns) - set(data.keys())) > 0:
+            raise RuntimeError(f"Columns {missing_columns} are not found in {key} of {path_to_file}")
+        return data
+    raise RuntimeError("Unsupported file type.")
+
+def tau_vs_other_scores(predictions, column_prefix):
+    """Computes tau vs other type scores for all prediction columns "{column_prefix}{tau_type}" at once."""
+    vs_columns = [column for column in predictions if column.startswith(column_prefix) and column != f'{column_prefix}tau']
+    if len(vs_columns) == 0:
+        return {}
+    prob_tau = predictions[f'{column_prefix}tau'][:, np.newaxis]
+    prob_vs_types = np.stack([predictions[column] for column in vs_columns], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau_vs_others = np.where(prob_tau > 0, prob_tau / (prob_tau + prob_vs_types), 0.)
+    return {column: tau_vs_others[:, n] for n, column in enumerate(vs_columns)}
+
+def create_df(path_to_input_file, input_branches, id_branches, path_to_pred_file, path_to_target_file, path_to_weights, pred_column_prefix=None, target_column_prefix=None,
+              input_tree_name='taus'):
+    columns = {}
     # TODO: add on the fly branching creation for uproot
-    # df = read_branches(path_to_input_file, 'taus', input_branches)
+    # columns.update(read_columns(path_to_input_file, input_tree_name, input_branches))
     # Alternatively we read variables from target file:
-    df = read_branches(path_to_target_file, 'propagated_vars', input_branches)
+    if len(input_branches):
+        columns.update(read_columns(path_to_target_file, 'propagated_vars', input_branches))
     if len(id_branches):
-        df_ids = read_branches(path_to_input_file, 'taus', id_branches)
-        df = pd.concat([df,df_ids],axis=1)
+        columns.update(read_columns(path_to_input_file, input_tree_name, id_branches))
     if path_to_pred_file is not None:
-        add_group(df, 'predictions', path_to_pred_file, pred_column_prefix)
+        columns.update(tau_vs_other_scores(read_columns(path_to_pred_file, 'predictions'), pred_column_prefix))
     else:
         print(f'[INFO] path_to_pred_file=None, will proceed without reading predictions from there')
     if path_to_target_file is not None:
-        add_group(df, 'targets', path_to_target_file, target_column_prefix)
+        targets = read_columns(path_to_target_file, 'targets') # assume target column name to be "{target_column_prefix}{tau_type}"
+        columns.update({f'gen_{column[len(target_column_prefix):]}': values for column, values in targets.items() if column.startswith(target_column_prefix)})
     else:
         print(f'[INFO] path_to_target_file=None, will proceed without reading targets from there')
     if path_to_weights is not None:
-        add_group(df, 'weights', path_to_weights, None)
+        with h5py.File(path_to_weights, 'r') as f:
+            weights_key = 'weights' if 'weights' in f.keys() else None
+        columns['weight'] = read_columns(path_to_weights, weights_key, ['weight'])['weight']
     else:
-        df['weight'] = pd.Series(np.ones(df.shape[0]), index=df.index)
-
+        columns['weight'] = np.ones(len(next(iter(columns.values()))) if len(columns) else 0)
+
+    n_entries = set(len(values) for values in columns.values())
+    if len(n_entries) > 1:
+        raise RuntimeError(f"Inconsistent number of entries in input/prediction/target files: {n_entries}")
+    return pd.DataFrame(columns)
+
+def create_sample_df(sample_alias, input_files, pred_files, target_files, input_branches, id_branches, pred_column_prefix=None, target_column_prefix=None,
+                     tau_types=None, input_tree_name='taus', path_to_cache=None, run_id=None):
+    """Combines dataframes created for all files of a given sample, keeping only entries with gen_{tau_type}==1 for specified tau_types.
+    If path_to_cache is specified, the combined dataframe is stored there per (run_id, sample_alias) and is reused
+    as long as the list of files, their modification times and the requested columns stay the same."""
+    if path_to_cache is not None:
+        cache_info = {
+            'files': sorted([[os.path.abspath(f), os.path.getmtime(f), os.path.getsize(f)]
+                             for f in set(input_files + pred_files + target_files) if f is not None]),
+            'input_branches': list(input_branches), 'id_branches': list(id_branches),
+            'pred_column_prefix': pred_column_prefix, 'target_column_prefix': target_column_prefix,
+            'tau_types': None if tau_types is None else list(tau_types), 'input_tree_name': input_tree_name,
+        }
+        cache_hash = hashlib.sha1(json.dumps(cache_info, sort_keys=True).encode()).hexdigest()[:16]
+        cache_file = f'{path_to_cache}/{run_id}_{sample_alias}_{cache_hash}.h5'
+        if os.path.exists(cache_file):
+            print(f'[INFO] Reading cached dataframe for sample {sample_alias}: {cache_file}')
+            return pd.read_hdf(cache_file, 'df')
+
+    df_list = []
+    for input_file, pred_file, target_file in zip(input_files, pred_files, target_files):
+        df = create_df(input_file, input_branches, id_branches, pred_file, target_file, None, # weights functionality is WIP
+                       pred_column_prefix, target_column_prefix, input_tree_name)
+        if tau_types is not None: # gen_* are constructed in `create_df()`
+            df = df[np.any([df[f'gen_{tau_type}'].values == 1 for tau_type in tau_types], axis=0)]
+        df_list.append(df)
+    df = pd.concat(df_list, ignore_index=True)
+
+    if path_to_cache is not None:
+        os.makedirs(path_to_cache, exist_ok=True)
+        df.to_hdf(cache_file, key='df', mode='w', format='fixed')
     return df
 
 def prepare_filelists(sample_alias, path_to_input, path_to_pred, path_to_target, path_to_artifacts):
@@ -405,29 +617,89 @@ def fill_placeholders(string, placeholder_to_value):
         string = string.replace(placeholder, str(value))
     return string
 
-class FloatList(object):
-    def __init__(self, value):
-        self.value = value
-
-class CustomJsonEncoder(json.JSONEncoder):
-    placeholder = '@@{}@@'
-    placeholder_re = re.compile(placeholder.format(r'(\d+)'))
-
-    def __init__(self, **kwargs):
-        self.__sort_keys = kwargs.get('sort_keys', None)
-        super(CustomJsonEncoder, self).__init__(**kwargs)
-
-    def default(self, obj):
-        if isinstance(obj, FloatList):
-            return self.placeholder.format(id(obj))
-        return super(CustomJsonEncoder, self).default(obj)
-
-    def encode(self, obj):
-        json_repr = super(CustomJsonEncoder, self).encode(obj)
-        for match in self.placeholder_re.finditer(json_repr):
-            id = int(match.group(1))
-            float_list = PyObj_FromPtr(id)
-            json_obj_repr = '[ ' + ', '.join([ '{:.4e}'.format(x) for x in float_list.value ]) + ' ]'
-            json_repr = json_repr.replace('"{}"'.format(self.placeholder.format(id)), json_obj_repr)
-
-        return json_repr
+class PerformanceStore:
+    """Storage of curves' data in HDF5 file, where each curve is kept in a separate group with the path built from
+    curve_type and phase space region (pt, eta, L bins, vs_type, dataset_alias). This allows to update or to read
+    a single curve without loading the whole file. Arrays are stored as float64, scalars and plot setup as attributes.
+    The name and period of the discriminator which produced the curve are stored with each curve.
+    The content can be exported to (and imported from) the performance.json format."""
+    key_fields = ['pt_min', 'pt_max', 'eta_min', 'eta_max', 'L_min', 'L_max', 'vs_type', 'dataset_alias']
+    info_fields = ['discriminator_name', 'discriminator_period']
+
+    def __init__(self, path, mode='r'):
+        self.file = h5py.File(path, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    @staticmethod
+    def CurveKey(curve_type, pt_min, pt_max, eta_min, eta_max, L_min, L_max, vs_type, dataset_alias):
+        to_str = lambda x: repr(float(x))
+        return f'{curve_type}/{dataset_alias}/{vs_type}/pt_{to_str(pt_min)}_{to_str(pt_max)}' \
+               f'/eta_{to_str(eta_min)}_{to_str(eta_max)}/L_{to_str(L_min)}_{to_str(L_max)}'
+
+    def Contains(self, curve_type, **selection):
+        return self.CurveKey(curve_type, **selection) in self.file
+
+    def Write(self, curve_type, curve_data, name, period):
+        key = self.CurveKey(curve_type, **{k: curve_data[k] for k in self.key_fields})
+        if key in self.file:
+            del self.file[key]
+        group = self.file.create_group(key)
+        group.attrs['discriminator_name'] = name
+        group.attrs['discriminator_period'] = period
+        for field, value in curve_data.items():
+            if field == 'plot_setup':
+                group.attrs[field] = json.dumps(value)
+            elif isinstance(value, np.ndarray):
+                group.create_dataset(field, data=value.astype(np.float64))
+            elif value is not None:
+                group.attrs[field] = value
+
+    def _ReadGroup(self, group):
+        curve_data = {name: group[name][:] for name in group.keys()}
+        for name, value in group.attrs.items():
+            if name in self.info_fields: continue
+            curve_data[name] = json.loads(value) if name == 'plot_setup' else value
+        return curve_data
+
+    def Read(self, curve_type, **selection):
+        key = self.CurveKey(curve_type, **selection)
+        if key not in self.file:
+            return None
+        return self._ReadGroup(self.file[key])
+
+    def ReadInfo(self, curve_type, **selection):
+        """Returns name and period of the discriminator which produced the curve."""
+        group = self.file[self.CurveKey(curve_type, **selection)]
+        return tuple(group.attrs[name] for name in self.info_fields)
+
+    def Curves(self):
+        """Yields (curve_type, curve_data, name, period) for all stored curves."""
+        groups = []
+        self.file.visititems(lambda path, obj: groups.append(path) if isinstance(obj, h5py.Group) and 'pt_min' in obj.attrs else None)
+        for path in groups:
+            group = self.file[path]
+            yield (path.split('/')[0], self._ReadGroup(group)) + tuple(group.attrs[name] for name in self.info_fields)
+
+    def ImportJson(self, json_path):
+        """Adds the curves from performance.json written by earlier versions of evaluate_performance.py."""
+        with open(json_path, 'r') as json_file:
+            performance_data = json.load(json_file)
+        for curve_type, curves in performance_data['metrics'].items():
+            for curve_data in curves:
+                curve_data = {k: np.array(v, dtype=np.float64) if isinstance(v, list) else v for k, v in curve_data.items()}
+                self.Write(curve_type, curve_data, performance_data['name'], performance_data['period'])
+
+    def ExportJson(self, json_path, name, period):
+        """Writes all curves in the performance.json format read by plot_predict.py and external consumers.
+        The format keeps a single discriminator name and period for the whole file."""
+        to_json = lambda x: x.tolist() if isinstance(x, (np.ndarray, np.generic)) else x
+        performance_data = {'name': name, 'period': period, 'metrics': {}, 'roc_curve': {}, 'roc_wp': {}}
+        for curve_type, curve_data, _, _ in self.Curves():
+            performance_data['metrics'].setdefault(curve_type, []).append({k: to_json(v) for k, v in curve_data.items()})
+        with open(json_path, 'w') as json_file:
+            json.dump(performance_data, json_file, indent=4)
@@ -1,8 +1,6 @@
 import os
 import math
-import json
 import pandas as pd
-from collections import defaultdict
 from dataclasses import fields
 
 import mlflow
@@ -20,6 +18,7 @@ def main(cfg: DictConfig) -> None:
     # path_to_weights_taus = to_absolute_path(cfg.path_to_weights_taus) if cfg.path_to_weights_taus is not None else None
     # path_to_weights_vs_type = to_absolute_path(cfg.path_to_weights_vs_type) if cfg.path_to_weights_vs_type is not None else None
     path_to_artifacts = to_absolute_path(f'{cfg.path_to_mlflow}/{cfg.experiment_id}/{cfg.run_id}/artifacts/')
+    output_path = f'{path_to_artifacts}/performance.h5'
     output_json_path = f'{path_to_artifacts}/performance.json'
 
     # init Discriminator() class from filtered input configuration
@@ -46,15 +45,13 @@ def main(cfg: DictConfig) -> None:
     for sample_alias, tau_types in cfg.input_samples.items():
         input_files, pred_files, target_files = eval_tools.prepare_filelists(sample_alias, cfg.path_to_input, cfg.path_to_pred, cfg.path_to_target, path_to_artifacts)
 
-        # loop over all input files per sample with associated predictions/targets (if present) and combine together into df
+        # combine all input files per sample with associated predictions/targets (if present) into df, selecting specified tau types
         print(f'[INFO] Creating dataframe for sample: {sample_alias}')
-        for input_file, pred_file, target_file in zip(input_files, pred_files, target_files):
-            df = eval_tools.create_df(input_file, input_branches, id_branches, pred_file, target_file, None, # weights functionality is WIP
-                                            cfg.discriminator.pred_column_prefix,
-                                            cfg.discriminator.target_column_prefix)
-            gen_selection = ' or '.join([f'(gen_{tau_type}==1)' for tau_type in tau_types]) # gen_* are constructed in `add_targets()`
-            df = df.query(gen_selection)
-            df_list.append(df)
+        path_to_df_cache = to_absolute_path(cfg.path_to_df_cache) if cfg.path_to_df_cache is not None else None
+        df = eval_tools.create_sample_df(sample_alias, input_files, pred_files, target_files, input_branches, id_branches,
+                                         cfg.discriminator.pred_column_prefix, cfg.discriminator.target_column_prefix,
+                                         tau_types=tau_types, path_to_cache=path_to_df_cache, run_id=cfg.run_id)
+        df_list.append(df)
     df_all = pd.concat(df_list)
 
     # df_all.to_csv('/afs/desy.de/user/m/mykytaua/nfscms/softDeepTau/RecoML/DisTauTag/TauMLTools/Evaluation/DeepTauId_predictions_old.csv', encoding='utf-8')
@@ -66,15 +63,12 @@ def main(cfg: DictConfig) -> None:
     # # inverse scaling
     # df_all['tau_pt'] = df_all.tau_pt*(1000 - 20) + 20
     
-    # dump curves' data into json file
-    json_exists = os.path.exists(output_json_path)
-    json_open_mode = 'r+' if json_exists else 'w'
-    with open(output_json_path, json_open_mode) as json_file:
-        if json_exists: # read performance data to append additional info 
-            performance_data = json.load(json_file)
-        else: # create dictionary to fill with data
-            performance_data = {'name': discriminator.name, 'period': cfg.period, 'metrics': defaultdict(list), 
-                                'roc_curve': defaultdict(list), 'roc_wp': defaultdict(list)}
+    # dump curves' data into performance store
+    store_exists = os.path.exists(output_path)
+    with eval_tools.PerformanceStore(output_path, 'a') as performance_store:
+        if not store_exists and os.path.exists(output_json_path): # run evaluated before the store was introduced
+            print(f'[INFO] Importing curves from {output_json_path} into performance store.')
+            performance_store.ImportJson(output_json_path)
 
         # loop over pt bins
         print(f'\n{discriminator.name}')
@@ -107,14 +101,9 @@ def main(cfg: DictConfig) -> None:
                     # loop over [ROC curve, ROC curve WP] for a given discriminator and store its info into dict
                     for curve_type, curve in zip(['roc_curve', 'roc_wp'], [roc, wp_roc]):
                         if curve is None: continue
-                        if json_exists and curve_type in performance_data['metrics'] \
-                                        and (existing_curve := eval_tools.select_curve(performance_data['metrics'][curve_type], 
-                                                                                        pt_min=pt_min, pt_max=pt_max, eta_min=eta_min, eta_max=eta_max, 
-                                                                                        L_min=L_min, L_max=L_max,
-                                                                                        vs_type=cfg.vs_type,
-                                                                                        dataset_alias=cfg.dataset_alias)) is not None:
-                            print(f'[INFO] Found already existing curve (type: {curve_type}) in json file for a specified set of parameters: will overwrite it.')
-                            performance_data['metrics'][curve_type].remove(existing_curve)
+                        if performance_store.Contains(curve_type, pt_min=pt_min, pt_max=pt_max, eta_min=eta_min, eta_max=eta_max, 
+                                                                  L_min=L_min, L_max=L_max, vs_type=cfg.vs_type, dataset_alias=cfg.dataset_alias):
+                            print(f'[INFO] Found already existing curve (type: {curve_type}) in performance store for a specified set of parameters: will overwrite it.')
 
                         curve_data = {
                             'pt_min': pt_min, 'pt_max': pt_max, 
@@ -123,16 +112,18 @@ def main(cfg: DictConfig) -> None:
                             'vs_type': cfg.vs_type,
                             'dataset_alias': cfg.dataset_alias,
                             'auc_score': curve.auc_score,
-                            'false_positive_rate': eval_tools.FloatList(curve.pr[0, :].tolist()),
-                            'true_positive_rate': eval_tools.FloatList(curve.pr[1, :].tolist()),
+                            'false_positive_rate': curve.pr[0, :],
+                            'true_positive_rate': curve.pr[1, :],
                         }
+                        if curve.auc_error is not None:
+                            curve_data['auc_score_error'] = curve.auc_error
                         if curve.thresholds is not None:
-                            curve_data['thresholds'] = eval_tools.FloatList(curve.thresholds.tolist())
+                            curve_data['thresholds'] = curve.thresholds
                         if curve.pr_err is not None:
-                            curve_data['false_positive_rate_up'] = eval_tools.FloatList(curve.pr_err[0, 0, :].tolist())
-                            curve_data['false_positive_rate_down'] = eval_tools.FloatList(curve.pr_err[0, 1, :].tolist())
-                            curve_data['true_positive_rate_up'] = eval_tools.FloatList(curve.pr_err[1, 0, :].tolist())
-                            curve_data['true_positive_rate_down'] = eval_tools.FloatList(curve.pr_err[1, 1, :].tolist())
+                            curve_data['false_positive_rate_up'] = curve.pr_err[0, 0, :]
+                            curve_data['false_positive_rate_down'] = curve.pr_err[0, 1, :]
+                            curve_data['true_positive_rate_up'] = curve.pr_err[1, 0, :]
+                            curve_data['true_positive_rate_down'] = curve.pr_err[1, 1, :]
 
                         # plot setup for the curve
                         curve_data['plot_setup'] = {
@@ -182,13 +173,12 @@ def main(cfg: DictConfig) -> None:
                         # else:
                         #     curve_data['plot_setup']['dm_text'] = r'DM$ \in {}$'.format(dm_bin)
 
-                        # append data for a given curve_type and pt bin
+                        # write data for a given curve_type and pt bin
                         curve_data['plot_setup']['Lrel'] = r'${} < Lrel < {} cm$'.format(L_min, L_max)
-                        performance_data['metrics'][curve_type].append(curve_data)
+                        performance_store.Write(curve_type, curve_data, discriminator.name, cfg.period)
 
-        json_file.seek(0) 
-        json_file.write(json.dumps(performance_data, indent=4, cls=eval_tools.CustomJsonEncoder))
-        json_file.truncate()
+        # performance.json is kept up to date for plot_predict.py and other consumers of the artifacts
+        performance_store.ExportJson(output_json_path, discriminator.name, cfg.period)
     print()
     
 if __name__ == '__main__':
@@ -50,15 +50,13 @@ def main(cfg: DictConfig) -> None:
     for sample_alias, tau_types in cfg.input_samples.items():
         input_files, pred_files, target_files = eval_tools.prepare_filelists(sample_alias, cfg.path_to_input, cfg.path_to_pred, cfg.path_to_target, path_to_artifacts)
 
-        # loop over all input files per sample with associated predictions/targets (if present) and combine together into df
+        # combine all input files per sample with associated predictions/targets (if present) into df, selecting specified tau types
         print(f'[INFO] Creating dataframe for sample: {sample_alias}')
-        for input_file, pred_file, target_file in zip(input_files, pred_files, target_files):
-            df = eval_tools.create_df(input_file, input_branches, id_branches, pred_file, target_file, None, # weights functionality is WIP
-                                            cfg.discriminator.pred_column_prefix,
-                                            cfg.discriminator.target_column_prefix)
-            gen_selection = ' or '.join([f'(gen_{tau_type}==1)' for tau_type in tau_types]) # gen_* are constructed in `add_targets()`
-            df = df.query(gen_selection)
-            df_list.append(df)
+        path_to_df_cache = to_absolute_path(cfg.path_to_df_cache) if cfg.path_to_df_cache is not None else None
+        df = eval_tools.create_sample_df(sample_alias, input_files, pred_files, target_files, input_branches, id_branches,
+                                         cfg.discriminator.pred_column_prefix, cfg.discriminator.target_column_prefix,
+                                         tau_types=tau_types, path_to_cache=path_to_df_cache, run_id=cfg.run_id)
+        df_list.append(df)
     df_all = pd.concat(df_list)
 
     # df_all.to_csv('/afs/desy.de/user/m/mykytaua/nfscms/softDeepTau/RecoML/DisTauTag/TauMLTools/Evaluation/DeepTauId_predictions_old.csv', encoding='utf-8')
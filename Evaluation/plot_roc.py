@@ -2,13 +2,16 @@
 
 import os
 import json
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
 from scipy import interpolate
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 # from matplotlib.backends.backend_pdf import PdfPages
-from eval_tools import select_curve, create_roc_ratio
+from eval_tools import select_curve, create_roc_ratio, PerformanceStore
 
 class RocCurve:
     def __init__(self, data, ref_roc=None, WPcurve=False):
@@ -130,71 +133,116 @@ class PlotSetup:
             ax_ratio.tick_params(labelsize=10)
             ax_ratio.grid(True, which='both')
 
-import mlflow
-import hydra
-from hydra.utils import to_absolute_path
-from omegaconf import OmegaConf, DictConfig
+class CurveReader:
+    """Reads curves from performance stores of the runs in a given experiment, keeping the stores open and the parsed
+    curve data cached, so that each of them is read only once when rendering many figures.
+    Curves missing in performance.h5 (e.g. for runs evaluated with earlier versions of evaluate_performance.py)
+    are read from performance.json."""
+    def __init__(self, path_to_mlflow, experiment_id):
+        self.path_to_mlflow = path_to_mlflow
+        self.experiment_id = experiment_id
+        self.stores = {}
+        self.jsons = {}
+        self.curves = {}
 
-@hydra.main(config_path='configs', config_name='plot_roc')
-def main(cfg: DictConfig) -> None:
-    path_to_mlflow = to_absolute_path(cfg.path_to_mlflow)
-    mlflow.set_tracking_uri(f"file://{path_to_mlflow}")
-    # dmname = '_'.join([str(x) for x in cfg.dm_bin])
-    path_to_pdf = f'./{cfg.output_name}.png' # hydra log directory
-    print()
+    def _path(self, run_id, file_name):
+        return f'{self.path_to_mlflow}/{self.experiment_id}/{run_id}/artifacts/{file_name}'
 
+    def _store(self, run_id):
+        if run_id not in self.stores:
+            path_to_store = self._path(run_id, 'performance.h5')
+            self.stores[run_id] = PerformanceStore(path_to_store, 'r') if os.path.exists(path_to_store) else None
+        return self.stores[run_id]
+
+    def _json(self, run_id):
+        if run_id not in self.jsons:
+            self.jsons[run_id] = None
+            if os.path.exists(path_to_json := self._path(run_id, 'performance.json')):
+                with open(path_to_json, 'r') as f:
+                    self.jsons[run_id] = json.load(f)
+        return self.jsons[run_id]
+
+    def Read(self, run_id, curve_type, **selection):
+        """Returns curve data for the specified curve_type and phase space region together with the discriminator's name and period."""
+        key = (run_id, curve_type, tuple(sorted(selection.items())))
+        if key not in self.curves:
+            store = self._store(run_id)
+            if store is not None and store.Contains(curve_type, **selection):
+                self.curves[key] = (store.Read(curve_type, **selection),) + store.ReadInfo(curve_type, **selection)
+            else:
+                print(f'[INFO] Curve ({curve_type}) for run {run_id} is not in performance.h5, reading performance.json.')
+                discr_data = self._json(run_id)
+                if discr_data is None:
+                    self.curves[key] = (None, None, None)
+                else:
+                    self.curves[key] = (select_curve(discr_data['metrics'].get(curve_type, []), **selection),
+                                        discr_data['name'], discr_data['period'])
+        return self.curves[key]
+
+    def Close(self):
+        for store in self.stores.values():
+            if store is not None:
+                store.file.close()
+        self.stores = {}
+
+def collect_figure_inputs(curve_reader, discriminators, reference, vs_type, dataset_alias, pt_bin, eta_bin, L_bin):
+    """Retrieves the data of all curves to be drawn on a single figure for the specified phase space region."""
     # retrieve pt bin from input cfg 
-    assert len(cfg.pt_bin)==2 and cfg.pt_bin[0] <= cfg.pt_bin[1]
-    pt_min, pt_max = cfg.pt_bin[0], cfg.pt_bin[1]
-    assert len(cfg.eta_bin)==2 and cfg.eta_bin[0] <= cfg.eta_bin[1]
-    eta_min, eta_max = cfg.eta_bin[0], cfg.eta_bin[1]
-    assert len(cfg.L_bin)==2
-    L_min, L_max = cfg.L_bin[0], cfg.L_bin[1]
-    # rho_min, rho_max, z_min, z_max = cfg.L_bin[0], cfg.L_bin[1], cfg.L_bin[2], cfg.L_bin[3]
+    assert len(pt_bin)==2 and pt_bin[0] <= pt_bin[1]
+    pt_min, pt_max = pt_bin[0], pt_bin[1]
+    assert len(eta_bin)==2 and eta_bin[0] <= eta_bin[1]
+    eta_min, eta_max = eta_bin[0], eta_bin[1]
+    assert len(L_bin)==2
+    L_min, L_max = L_bin[0], L_bin[1]
+    # rho_min, rho_max, z_min, z_max = L_bin[0], L_bin[1], L_bin[2], L_bin[3]
     # assert len(cfg.dm_bin)>=1
     # dm_bin = cfg.dm_bin
+    selection = dict(pt_min=pt_min, pt_max=pt_max, eta_min=eta_min, eta_max=eta_max,
+                     L_min=L_min, L_max=L_max, vs_type=vs_type, dataset_alias=dataset_alias)
 
     # retrieve reference curve
-    if len(cfg.reference)>1:
-        raise RuntimeError(f'Expect to have only one reference discriminator, got: {cfg.reference.keys()}')
-    reference_cfg = OmegaConf.to_object(cfg.reference) # convert to python dict to enable popitem()
-    ref_discr_name, ref_curve_type = reference_cfg.popitem()
-    reference_json = f'{path_to_mlflow}/{cfg.experiment_id}/{ref_discr_name}/artifacts/performance.json'
-    with open(reference_json, 'r') as f:
-        ref_discr_data = json.load(f)
-    ref_curve = select_curve(ref_discr_data['metrics'][ref_curve_type], 
-                                pt_min=pt_min, pt_max=pt_max, eta_min=eta_min, eta_max=eta_max,
-                                L_min=L_min, L_max=L_max, vs_type=cfg.vs_type,
-                                dataset_alias=cfg.dataset_alias)
+    if len(reference)>1:
+        raise RuntimeError(f'Expect to have only one reference discriminator, got: {reference.keys()}')
+    (ref_discr_name, ref_curve_type), = reference.items()
+    ref_curve, _, ref_period = curve_reader.Read(ref_discr_name, ref_curve_type, **selection)
     if ref_curve is None:
-        raise RuntimeError('[INFO] didn\'t manage to retrieve a reference curve from performance.json')
-    ref_roc = RocCurve(ref_curve, None)
+        raise RuntimeError('[INFO] didn\'t manage to retrieve a reference curve from performance store')
 
     curves_to_plot = []
-    curve_names = []
-    # with PdfPages(path_to_pdf) as pdf:
-    for discr_name, curve_types in cfg.discriminators.items():
-        # retrieve discriminator data from corresponding json 
-        json_file = f'{path_to_mlflow}/{cfg.experiment_id}/{discr_name}/artifacts/performance.json'
-        with open(json_file, 'r') as f:
-            discr_data = json.load(f)
-
+    for discr_name, curve_types in discriminators.items():
+        # retrieve discriminator data from corresponding performance store
         for curve_type in curve_types: 
-            discr_curve = select_curve(discr_data['metrics'][curve_type], 
-                                        pt_min=pt_min, pt_max=pt_max, eta_min=eta_min, eta_max=eta_max,
-                                        L_min=L_min, L_max=L_max, vs_type=cfg.vs_type,
-                                        dataset_alias=cfg.dataset_alias)
+            discr_curve, discr_full_name, _ = curve_reader.Read(discr_name, curve_type, **selection)
             if discr_curve is None:
-                print(f'[INFO] Didn\'t manage to retrieve a curve ({curve_type}) for discriminator ({discr_name}) from performance.json. Will proceed without plotting it.')
+                print(f'[INFO] Didn\'t manage to retrieve a curve ({curve_type}) for discriminator ({discr_name}) from performance store. Will proceed without plotting it.')
                 continue
             # elif (discr_name==ref_discr_name and curve_type==ref_curve_type) or ('wp' in curve_type and any('curve' in ctype for ctype in curve_types)): # Temporary: Don't make ratio for 'roc_wp' if there's a ratio for 'roc_curve' already
             # elif (discr_name==ref_discr_name and curve_type==ref_curve_type):
             #     curves_to_plot.append(RocCurve(discr_curve, ref_roc=None))
             # else:
             #     curves_to_plot.append(RocCurve(discr_curve, ref_roc=ref_roc, WPcurve='wp' in curve_type))
-            
-            curves_to_plot.append(RocCurve(discr_curve, WPcurve='wp' in curve_type))
-            curve_names.append(discr_data['name'])
+            curves_to_plot.append((discr_full_name, curve_type, discr_curve))
+
+    return {'ref_curve': ref_curve, 'period': ref_period, 'curves': curves_to_plot}
+
+def figure_hash(figure_inputs):
+    """Content hash of the figure inputs used to skip rendering of figures which haven't changed."""
+    def to_hashable(obj):
+        if isinstance(obj, np.ndarray):
+            return hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+        if isinstance(obj, dict):
+            return {str(k): to_hashable(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [to_hashable(v) for v in obj]
+        if isinstance(obj, np.generic):
+            return obj.item()
+        return obj
+    return hashlib.sha1(json.dumps(to_hashable(figure_inputs), sort_keys=True).encode()).hexdigest()
+
+def render_figure(figure_inputs, path_to_pdf):
+    ref_curve = figure_inputs['ref_curve']
+    curves_to_plot = [RocCurve(curve_data, WPcurve='wp' in curve_type) for _, curve_type, curve_data in figure_inputs['curves']]
+    curve_names = [discr_name for discr_name, _, _ in figure_inputs['curves']]
 
     fig, ax = plt.subplots(figsize=(7, 7), sharex=True)
     plot_entries = []
@@ -214,18 +262,81 @@ def main(cfg: DictConfig) -> None:
     ax.text(0.01, header_y, 'CMS', fontsize=14, transform=ax.transAxes, fontweight='bold', fontfamily='sans-serif')
     ax.text(0.12, header_y, 'Simulation Preliminary', fontsize=14, transform=ax.transAxes, fontstyle='italic',
             fontfamily='sans-serif')
-    ax.text(0.73, header_y, ref_discr_data['period'], fontsize=13, transform=ax.transAxes, fontweight='bold',
+    ax.text(0.73, header_y, figure_inputs['period'], fontsize=13, transform=ax.transAxes, fontweight='bold',
             fontfamily='sans-serif')
     plt.subplots_adjust(hspace=0)
     plt.savefig(path_to_pdf, bbox_inches='tight')
-    plt.figure().clear()
-    plt.close()
-    plt.cla()
-    plt.clf()
-
-    with mlflow.start_run(experiment_id=cfg.experiment_id, run_id=list(cfg.discriminators.keys())[0]):
-        mlflow.log_artifact(path_to_pdf, 'plots')
-    print(f'\n    Saved the plot in artifacts/plots for runID={list(cfg.discriminators.keys())[0]}\n')
+    plt.close(fig)
+    return path_to_pdf
+
+def _render_figure_args(args):
+    return render_figure(*args)
+
+import mlflow
+import hydra
+from hydra.utils import to_absolute_path
+from omegaconf import OmegaConf, DictConfig
+
+@hydra.main(config_path='configs', config_name='plot_roc')
+def main(cfg: DictConfig) -> None:
+    path_to_mlflow = to_absolute_path(cfg.path_to_mlflow)
+    mlflow.set_tracking_uri(f"file://{path_to_mlflow}")
+    output_run_id = list(cfg.discriminators.keys())[0]
+    path_to_plots = f'{path_to_mlflow}/{cfg.experiment_id}/{output_run_id}/artifacts/plots'
+    print()
+
+    # pt_bin/eta_bin/L_bin are either single bins or lists of bins, in the latter case figures are rendered for all their combinations
+    is_bin_list = lambda bins: len(bins) > 0 and not isinstance(bins[0], (int, float))
+    if any(is_bin_list(bins) for bins in [cfg.pt_bin, cfg.eta_bin, cfg.L_bin]):
+        to_bin_list = lambda bins: OmegaConf.to_object(bins) if is_bin_list(bins) else [OmegaConf.to_object(bins)]
+        regions = list(itertools.product(to_bin_list(cfg.pt_bin), to_bin_list(cfg.eta_bin), to_bin_list(cfg.L_bin)))
+        output_names = [f'roc_curve_vs_{cfg.vs_type}_{cfg.dataset_alias}_pt_{pt_bin[0]}_{pt_bin[1]}_eta_{eta_bin[0]}_{eta_bin[1]}_L_{L_bin[0]}_{L_bin[1]}'
+                        for pt_bin, eta_bin, L_bin in regions]
+    else:
+        regions = [(OmegaConf.to_object(cfg.pt_bin), OmegaConf.to_object(cfg.eta_bin), OmegaConf.to_object(cfg.L_bin))]
+        output_names = [cfg.output_name]
+
+    # collect inputs for all figures, performance stores are read only once per run
+    curve_reader = CurveReader(path_to_mlflow, cfg.experiment_id)
+    discriminators = OmegaConf.to_object(cfg.discriminators)
+    reference = OmegaConf.to_object(cfg.reference)
+    figures = []
+    for (pt_bin, eta_bin, L_bin), output_name in zip(regions, output_names):
+        figure_inputs = collect_figure_inputs(curve_reader, discriminators, reference, cfg.vs_type, cfg.dataset_alias, pt_bin, eta_bin, L_bin)
+        figures.append((output_name, figure_inputs, figure_hash(figure_inputs)))
+    curve_reader.Close()
+
+    # skip figures with unchanged inputs which were already rendered and logged
+    path_to_hashes = f'{path_to_plots}/render_hashes.json'
+    render_hashes = {}
+    if os.path.exists(path_to_hashes):
+        with open(path_to_hashes, 'r') as f:
+            render_hashes = json.load(f)
+    to_render = []
+    for output_name, figure_inputs, input_hash in figures:
+        path_to_pdf = f'./{output_name}.png' # hydra log directory
+        if cfg.skip_unchanged and render_hashes.get(output_name) == input_hash and os.path.exists(f'{path_to_plots}/{output_name}.png'):
+            print(f'[INFO] Inputs of {output_name} haven\'t changed since the last rendering, skipping it.')
+            continue
+        to_render.append((figure_inputs, path_to_pdf))
+        render_hashes[output_name] = input_hash
+
+    # render figures, possibly distributing them across processes
+    if cfg.n_workers > 1 and len(to_render) > 1:
+        with multiprocessing.Pool(min(cfg.n_workers, len(to_render))) as pool:
+            rendered = pool.map(_render_figure_args, to_render)
+    else:
+        rendered = [render_figure(*args) for args in to_render]
+    if len(rendered) == 0:
+        print('\n    Nothing to render\n')
+        return
+
+    with mlflow.start_run(experiment_id=cfg.experiment_id, run_id=output_run_id):
+        for path_to_pdf in rendered:
+            mlflow.log_artifact(path_to_pdf, 'plots')
+    with open(path_to_hashes, 'w') as f:
+        json.dump(render_hashes, f, indent=4)
+    print(f'\n    Saved {len(rendered)} plot(s) in artifacts/plots for runID={output_run_id}\n')
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,7 @@ from __future__ import print_function
 import ROOT
 import json
 from collections import OrderedDict
+import multiprocessing
 import os
 import re
 
@@ -25,6 +26,12 @@ parser.add_argument('--id_json'       , required = True, type = str, help = 'dat
 parser.add_argument('--group_id_json' , required = True, type = str, help = 'dataset group id json file')
 parser.add_argument('--use_dataset_id', action = 'store_true', help = 'Add \'dataset_id\' column for comparison and binning')
 parser.add_argument('--formats'       , default ='pdf', type = str, help = 'comma separated list of output file formats')
+parser.add_argument('--backend'       , default ='root', type = str, choices = ['root', 'numpy'],
+                    help = 'root: ROOT Chi2Test/KolmogorovTest for each chunk; numpy: histograms are converted to numpy arrays with uproot and '\
+                           'the tests of all chunks are computed at once (same statistics as Chi2Test("NORM") and KolmogorovTest)')
+parser.add_argument('--check_backends', action = 'store_true', help = 'with --backend numpy, run also the ROOT tests and warn if the p-values differ')
+parser.add_argument('--no_plots'      , action = 'store_true', help = 'Do not draw the chunk distributions (histograms and p-values are still saved)')
+parser.add_argument('--n_plot_workers', default  = 1   , type = int, help = 'number of processes used to draw the plots')
 
 parser.add_argument('--visual', action = 'store_true', help = 'Won\'t run the script in batch mode')
 parser.add_argument('--legend', action = 'store_true', help = 'Draw a TLegend on canvases')
@@ -33,7 +40,13 @@ args = parser.parse_args()
 ROOT.gROOT.SetBatch(not args.visual)
 ROOT.gStyle.SetOptStat(0)
 
-for formats in args.formats.split(","):
+if args.backend == 'numpy':
+  import numpy as np
+  import uproot
+  from scipy import special, stats
+
+FORMATS = args.formats.split(",") if not args.no_plots else []
+for formats in FORMATS:
   pdf_dir = os.path.join(args.output, formats)
   if not os.path.exists(pdf_dir):
     os.makedirs(pdf_dir)
@@ -65,7 +78,7 @@ class Entry:  ## 2D entry (chunk_id x variable)
     self.hst = histo
     self.tdir = tdir if not tdir is None else self.var
 
-  def run_test(self, test, norm = True):
+  def make_chunks(self, norm = True):
     self.chunks = [self.hst.ProjectionY('chunk_{}'.format(cc), cc+1, cc+1).Clone() for cc in range(N_SPLIT)]
 
     self.chunks[0].SetMarkerStyle(20)
@@ -79,42 +92,109 @@ class Entry:  ## 2D entry (chunk_id x variable)
     
     self.chunks[0].GetYaxis().SetRangeUser(0, 1.1*max(hh.GetMaximum() for hh in self.chunks))
 
+  def run_test(self, test, norm = True):
+    self.make_chunks(norm = norm)
+
     if not self.chunks[0].Integral():
       print ('[WARNING] control histogram is empty inside {}'.format(self.tdir))
 
+    self.pvalues = self.root_pvalues(test, norm = norm)
+    self.check_pvalues()
+
+  def root_pvalues(self, test, norm = True):
     if test == 'Chi2':
       # see https://root.cern.ch/doc/master/classTH1.html#a6c281eebc0c0a848e7a0d620425090a5
-      self.pvalues = [self.chunks[0].Chi2Test(hh, "NORM" if norm else "UU") if self.chunks[0].Integral()*hh.Integral() else 99 for hh in self.chunks]
+      return [self.chunks[0].Chi2Test(hh, "NORM" if norm else "UU") if self.chunks[0].Integral()*hh.Integral() else 99 for hh in self.chunks]
     elif test == 'KS':
       # see https://root.cern.ch/doc/master/classTH1.html#aeadcf087afe6ba203bcde124cfabbee4
-      self.pvalues = [self.chunks[0].KolmogorovTest(hh)   if self.chunks[0].Integral()*hh.Integral() else 99 for hh in self.chunks]
+      return [self.chunks[0].KolmogorovTest(hh)   if self.chunks[0].Integral()*hh.Integral() else 99 for hh in self.chunks]
     else:
       raise ValueError("Test {} not valid".format(args.test))
 
+  def run_test_numpy(self, test):
+    ## counts[chunk, bin] without under/overflow, all chunks are compared to the first one at once
+    counts = uproot.from_pyroot(self.hst).values(flow = False)[:N_SPLIT].astype(np.float64)
+    ref    = counts[0]
+    n_ref  = ref.sum()
+    n_chunk = counts.sum(axis = 1)
+    non_empty = n_ref * n_chunk > 0
+
+    if not n_ref:
+      print ('[WARNING] control histogram is empty inside {}'.format(self.tdir))
+
+    if test == 'Chi2':
+      # the ROOT backend compares the chunks normalized to unit integral with Sumw2, which Chi2Test treats as weighted
+      # histograms (WW test, the option NORM is ignored without UU). With contents w_i = n_i / N and errors s_i^2 = n_i / N^2
+      # chi2 = sum_i (W1 w2_i - W2 w1_i)^2 / (W1^2 s2_i^2 + W2^2 s1_i^2) = sum_i (N m_i - M n_i)^2 / (N^2 m_i + M^2 n_i),
+      # ndf = number of non-empty bins - 1
+      bin_sum  = ref[np.newaxis, :] + counts
+      filled   = bin_sum > 0
+      residual = (n_ref * counts - n_chunk[:, np.newaxis] * ref[np.newaxis, :]) ** 2
+      sigma    = n_ref ** 2 * counts + (n_chunk ** 2)[:, np.newaxis] * ref[np.newaxis, :]
+      chi2 = np.where(filled, residual / np.where(filled, sigma, 1.), 0.).sum(axis = 1)
+      ndf  = filled.sum(axis = 1) - 1
+      pvalues = np.where(ndf > 0, stats.chi2.sf(chi2, np.maximum(ndf, 1)), 1.)
+    elif test == 'KS':
+      cdf_ref   = np.cumsum(ref) / max(n_ref, 1.)
+      cdf_chunk = np.cumsum(counts, axis = 1) / np.maximum(n_chunk, 1.)[:, np.newaxis]
+      dist = np.abs(cdf_chunk - cdf_ref[np.newaxis, :]).max(axis = 1)
+      z = dist * np.sqrt(n_ref * n_chunk / np.maximum(n_ref + n_chunk, 1.))
+      pvalues = special.kolmogorov(z)
+    else:
+      raise ValueError("Test {} not valid".format(args.test))
+
+    self.pvalues = [float(pv) for pv in np.where(non_empty, pvalues, 99)]
+    self.check_pvalues()
+
+  def compare_backends(self, test, tolerance = 1e-4):
+    ## the ROOT tests are run on the same chunks and compared to the p-values of the numpy backend
+    self.make_chunks()
+    root_pvalues = self.root_pvalues(test)
+    mismatch = [ii for ii, (pv_np, pv_root) in enumerate(zip(self.pvalues, root_pvalues)) if abs(pv_np - pv_root) > tolerance]
+    if len(mismatch):
+      print ('[WARNING] numpy and ROOT backends disagree for step {} in chunks {}:'.format(self.tdir, mismatch))
+      print ('\t numpy:', [self.pvalues[ii] for ii in mismatch])
+      print ('\t ROOT :', [root_pvalues[ii] for ii in mismatch])
+
+  def check_pvalues(self):
     if not all([pv >= PVAL_THRESHOLD for pv in self.pvalues]):
       print ('[WARNING] KS test failed for step {}. p-values are:'.format(self.tdir))
       print ('\t', self.pvalues)
-  
-  def save_data(self):
-    OUTPUT_ROOT.cd()
-    
-    if not OUTPUT_ROOT.GetDirectory(self.tdir):
-      OUTPUT_ROOT.mkdir(self.tdir)
-    
-    OUTPUT_ROOT.cd(self.tdir)
-    
+
+  def draw(self):
     can = ROOT.TCanvas()
     leg = ROOT.TLegend(0.9, 0.1, 1., 0.9, "p-values (KS with the first chunk)")
     for ii, hh in enumerate(self.chunks):
-      hh.Write()
       hh.Draw('PE'+' SAME'*(ii != 0))
       leg.AddEntry(hh, 'chunk %d - pval = %.3f' %(ii, self.pvalues[ii]), 'lep')
     if args.legend:
       leg.Draw("SAME")
-    
-    for formats in args.formats.split(","):
+    return can, leg
+
+  def save_plots(self, can = None):
+    if can is None:
+      can, leg = self.draw()
+    for formats in FORMATS:
       can.SaveAs('{}/{}/{}.{}'.format(args.output, formats, self.tdir.replace('/', '_'), formats), formats)
-    can.Write()
+
+  def save_data(self, save_plots = True):
+    OUTPUT_ROOT.cd()
+    
+    if not OUTPUT_ROOT.GetDirectory(self.tdir):
+      OUTPUT_ROOT.mkdir(self.tdir)
+    
+    OUTPUT_ROOT.cd(self.tdir)
+    
+    if hasattr(self, 'chunks'):
+      for hh in self.chunks:
+        hh.Write()
+      if not args.no_plots:
+        can, leg = self.draw()
+        if save_plots:
+          self.save_plots(can)
+        can.Write()
+    else:
+      self.hst.Write(self.var)
 
     OUTPUT_ROOT.cd()
 
@@ -125,6 +205,11 @@ class Entry:  ## 2D entry (chunk_id x variable)
       json_here = json_here[here]
     json_here['pvalues'] = self.pvalues
 
+def save_plots_worker(worker_id):
+  ## entries are inherited from the parent process when the pool is forked
+  for ee in ENTRIES[worker_id::args.n_plot_workers]:
+    ee.save_plots()
+
 def to_2D(histo, vbin):
   histo.GetZaxis().SetRange(vbin, vbin)
   return histo.Project3D('yx').Clone()
@@ -231,9 +316,26 @@ if (*it == %s) return line;
     [ee for ee in entries_tau_eta] +\
     [ee for ee in entries_dataset_id]
 
+  parallel_plots = not args.no_plots and args.n_plot_workers > 1
   for ee in entries:
-    ee.run_test(test = args.test)
-    ee.save_data()
+    if args.backend == 'numpy':
+      ee.run_test_numpy(test = args.test)
+      if args.check_backends:
+        ee.compare_backends(test = args.test)
+      elif not args.no_plots:
+        ee.make_chunks()
+    else:
+      ee.run_test(test = args.test)
+    ee.save_data(save_plots = not parallel_plots)
+
+  if parallel_plots:
+    if args.n_threads > 1:
+      ROOT.ROOT.DisableImplicitMT()
+    ENTRIES = entries
+    pool = multiprocessing.Pool(args.n_plot_workers)
+    pool.map(save_plots_worker, range(args.n_plot_workers))
+    pool.close()
+    pool.join()
   print ("ID names for uh_dataset_group_id:", sorted(BINNED_VARIABLENAMES['uh_dataset_group_id'].items()))
   if args.use_dataset_id: print ("ID names for uh_dataset_id:", sorted(BINNED_VARIABLENAMES['uh_dataset_id'].items()))
 
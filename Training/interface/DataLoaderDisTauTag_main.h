@@ -19,13 +19,16 @@ struct Data {
     template<typename T, T... I> Data(std::integer_sequence<T, I...> int_seq)
     : y(Setup::n_tau * Setup::output_classes, 0), tau_i(0), 
     uncompress_index(Setup::n_tau, 0), uncompress_size(0),
-    weights(Setup::n_tau, 0), x_glob(Setup::n_tau * Setup::n_Global, 0)
+    weights(Setup::n_tau, 0), weight_pt(Setup::n_tau, 0), weight_eta(Setup::n_tau, 0),
+    x_glob(Setup::n_tau * Setup::n_Global, 0)
     {
         ((init_grid<FeaturesHelper<std::tuple_element_t<I, FeatureTuple>>>()),...);
     }
     std::unordered_map<CellObjectType, std::vector<Float_t>> x;
     std::vector<Float_t> y;
     std::vector<Float_t> weights;
+    std::vector<Float_t> weight_pt; // pt and |eta| for the weights computed on the python side
+    std::vector<Float_t> weight_eta;
     std::vector<Float_t> x_glob; // will not be scaled
 
     Long64_t tau_i; // the number of taus filled in the tensor filled_tau <= n_tau;
@@ -56,6 +59,9 @@ public:
             throw std::invalid_argument("Y binning list does not match X binning length");
         }
 
+        // with weights_from_table the weights are taken from the WeightTable on the python side
+        if (Setup::weights_from_table) return;
+
         // auto spectrum_file = std::make_shared<TFile>(Setup::spectrum_to_reweight.c_str());
         auto file_input = std::make_shared<TFile>(Setup::spectrum_to_reweight.c_str());
         auto file_target = std::make_shared<TFile>(Setup::spectrum_to_reweight.c_str());
@@ -165,7 +171,12 @@ public:
             {
                 if(Setup::to_propagate_glob) FillGlob(data->tau_i, tau, jet_match_type);
                 data->y.at(data->tau_i * Setup::output_classes + static_cast<Int_t>(*jet_match_type)) = 1.0;
-                data->weights.at(data->tau_i) = GetWeight(static_cast<Int_t>(*jet_match_type), tau.jet_pt, std::abs(tau.jet_eta));
+                if (Setup::weights_from_table) {
+                    data->weight_pt.at(data->tau_i) = tau.jet_pt;
+                    data->weight_eta.at(data->tau_i) = std::abs(tau.jet_eta);
+                }
+                else
+                    data->weights.at(data->tau_i) = GetWeight(static_cast<Int_t>(*jet_match_type), tau.jet_pt, std::abs(tau.jet_eta));
                 FillPfCand(data->tau_i, tau);
                 data->uncompress_index[data->tau_i] = data->uncompress_size;
                 ++(data->tau_i);
@@ -110,7 +110,8 @@ struct Data {
          size_t n_outer_cells, size_t globalgrid_fn, size_t pfelectron_fn, size_t pfmuon_fn,
          size_t pfchargedhad_fn, size_t pfneutralhad_fn, size_t pfgamma_fn,
          size_t electron_fn, size_t muon_fn, size_t tau_labels) :
-         tau_i(0), x_tau(n_tau * tau_fn, 0), weight(n_tau, 0), y_onehot(n_tau * tau_labels, 0),
+         tau_i(0), x_tau(n_tau * tau_fn, 0), weight(n_tau, 0), weight_pt(n_tau, 0), weight_eta(n_tau, 0),
+         y_onehot(n_tau * tau_labels, 0),
          uncompress_index(n_tau, 0), uncompress_size(0)
          {
            x_grid[CellObjectType::GridGlobal][0].resize(n_tau * n_outer_cells * n_outer_cells * globalgrid_fn,0);
@@ -144,6 +145,8 @@ struct Data {
     std::vector<float> x_tau;
     GridMap x_grid; // [enum class CellObjectType][ 0 - outer, 1 - inner]
     std::vector<float> weight;
+    std::vector<float> weight_pt; // pt and |eta| for the weights computed on the python side
+    std::vector<float> weight_eta;
     std::vector<float> y_onehot;
 };
 
@@ -177,6 +180,8 @@ public:
       // end_entry = std::min((long long)end_dataset, tauTuple->GetEntries());
 
       // histogram to calculate weights
+      // (with weights_from_table the weights are taken from the WeightTable on the python side)
+      if (weights_from_table) return;
 
       auto file_input = std::make_shared<TFile>(input_spectrum.c_str());
       auto file_target = std::make_shared<TFile>(target_spectrum.c_str());
@@ -261,7 +266,12 @@ public:
             // skip event if it is not tau_e, tau_mu, tau_jet or tau_h
             if ( tau_types_names.find(tau.tauType) != tau_types_names.end() ) {
               data->y_onehot[ data->tau_i * tau_types_names.size() + tau.tauType ] = 1.0; // filling labels
-              data->weight.at(data->tau_i) = GetWeight(tau.tauType, tau.tau_pt, std::abs(tau.tau_eta)); // filling weights
+              if (weights_from_table) {
+                data->weight_pt.at(data->tau_i) = tau.tau_pt;
+                data->weight_eta.at(data->tau_i) = std::abs(tau.tau_eta);
+              }
+              else
+                data->weight.at(data->tau_i) = GetWeight(tau.tauType, tau.tau_pt, std::abs(tau.tau_eta)); // filling weights
               FillTauBranches(tau, data->tau_i);
               FillCellGrid(tau, data->tau_i, innerCellGridRef, true);
               FillCellGrid(tau, data->tau_i, outerCellGridRef, false);
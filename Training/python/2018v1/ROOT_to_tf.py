@@ -13,10 +13,14 @@ import DataLoader
 import argparse
 
 parser = argparse.ArgumentParser(description='Convert ROOT files to TF dataset')
-parser.add_argument('--n_batches', required=True, type=int, help="Number of batches")
+parser.add_argument('--n_batches', required=True, type=int, help="Number of training batches")
+parser.add_argument('--n_batches_val', required=False, type=int, default=0, help="Number of validation batches")
 parser.add_argument('--scaling_cfg', required=True, type=str, help="Scaling config")
 parser.add_argument('--save_path', required=True, type=str, help="Save path")
 parser.add_argument('--training_cfg', required=True, type=str, help="Training config")
+parser.add_argument('--n_shards', required=False, type=int, default=16, help="Number of shards per split")
+parser.add_argument('--codec', required=False, type=str, default="NONE", choices=["NONE", "ZLIB", "GZIP"],
+                    help="Compression of the TFRecord shards")
 args = parser.parse_args()
 
 
@@ -29,8 +33,8 @@ with open(training_cfg_path) as file:
     training_cfg = yaml.full_load(file)
     print("Training Config Loaded")
 
-training_cfg["SetupNN"]["n_batches"]=args.n_batches
-training_cfg["SetupNN"]["n_batches_val"]=0 # only generate training data as train/val split done later in training
+training_cfg["SetupNN"]["n_batches"]=args.n_batches+args.n_batches_val
+training_cfg["SetupNN"]["n_batches_val"]=0 # one generator, the train/val split is done when writing the cache
 training_cfg["SetupNN"]["validation_split"]=0
 training_cfg["Setup"]["input_type"]="ROOT" # make ROOT so generator loads
 
@@ -43,5 +47,5 @@ input_shape, input_types = dataloader.get_input_config()
 print("Input shapes and Types acquired")
 data_train = tf.data.Dataset.from_generator(gen_train, output_types = input_types, output_shapes = input_shape).prefetch(tf.data.AUTOTUNE)
 print("Dataset extracted from DataLoader")
-tf.data.experimental.save(data_train, save_path, compression = "GZIP")
+save_tfrecord_cache(data_train, save_path, args.n_batches, args.n_batches_val, args.n_shards, args.codec)
 print("Conversion Complete")
\ No newline at end of file
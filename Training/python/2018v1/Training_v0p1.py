@@ -9,6 +9,9 @@ import numpy as np
 from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 import copy
+import hashlib
+import shutil
+import tempfile
 import tensorflow as tf
 from tensorflow import keras
 import tensorflow.keras.backend as K
@@ -55,6 +58,10 @@ class DeepTauModel(keras.Model):
             # self.adv_loss = TauLosses.focal_adversarial
             # self.gamma = 0.5
             self.adv_accuracy = tf.keras.metrics.BinaryAccuracy(name="adv_accuracy") 
+            # the common layers are updated with a combination of the gradients of both losses, which can't be kept
+            # consistent with two independent dynamic loss scales
+            if tf.keras.mixed_precision.global_policy().compute_dtype == 'float16':
+                raise RuntimeError("mixed_float16 is not supported for the adversarial training, use mixed_bfloat16.")
             self.adv_optimizer = tf.keras.optimizers.Nadam(learning_rate=adv_learning_rate)
             self.n_adv_tau = n_adv_tau
             self.mean_grad_class= keras.metrics.Mean(name="mean_grad_class")
@@ -101,28 +108,35 @@ class DeepTauModel(keras.Model):
             else:
                 return y_pred_class, loss, reg_loss, pure_loss
 
+        # apply_gradients sums the gradients over the replicas, so that the losses are divided by the number of replicas
+        # to obtain the gradients of the loss averaged over the global batch. As the combination of the classification
+        # and adversarial gradients below is linear, it is the same for the summed and for the per-replica gradients.
+        n_replicas = tf.distribute.get_strategy().num_replicas_in_sync
         if self.use_AdvDataset:
             with tf.GradientTape() as class_tape, tf.GradientTape() as adv_tape:
                 y_pred_class, y_pred_adv, loss, reg_loss, pure_loss, adv_loss = run_pred()
+                scaled_loss = scale_loss(self.optimizer, loss / n_replicas)
+                scaled_adv_loss = adv_loss / n_replicas # no loss scaling, as mixed_float16 is not supported
         else:
             with tf.GradientTape() as class_tape:
                 y_pred_class, loss, reg_loss, pure_loss = run_pred()
+                scaled_loss = scale_loss(self.optimizer, loss / n_replicas)
         # Compute gradients and update weights
         if self.use_AdvDataset:
             class_layers = [var for var in self.trainable_variables if ("final" in var.name and "_adv" not in var.name)] # final classification dense only
             adv_layers = [var for var in self.trainable_variables if ("final" in var.name and "_adv" in var.name)] #final adv only
             common_layers = [var for var in self.trainable_variables if "final" not in var.name] #gradients common to both
-            grad_class = class_tape.gradient(loss, common_layers + class_layers) 
-            grad_adv = adv_tape.gradient(adv_loss, common_layers + adv_layers)
+            grad_class = unscale_gradients(self.optimizer, class_tape.gradient(scaled_loss, common_layers + class_layers))
+            grad_adv = adv_tape.gradient(scaled_adv_loss, common_layers + adv_layers)
             grad_class_excl = grad_class[len(common_layers):] # gradients of common part
             grad_adv_excl = grad_adv[len(common_layers):] #gradients of adv part
             grad_common = [self.k1*grad_class[i] - self.k2 * grad_adv[i] for i in range(len(common_layers))] 
-            mean_class = tf.add_n([tf.math.reduce_mean(tf.math.abs(grad_class[i])) for i in range(len(common_layers))])/len(common_layers) 
-            mean_adv = tf.add_n([tf.math.reduce_mean(tf.math.abs(grad_adv[i])) for i in range(len(common_layers))])/len(common_layers)
+            mean_class = tf.add_n([tf.math.reduce_mean(tf.math.abs(grad_class[i])) for i in range(len(common_layers))])/len(common_layers)*n_replicas
+            mean_adv = tf.add_n([tf.math.reduce_mean(tf.math.abs(grad_adv[i])) for i in range(len(common_layers))])/len(common_layers)*n_replicas
             self.optimizer.apply_gradients(zip( grad_common + grad_class_excl, common_layers + class_layers)) 
             self.adv_optimizer.apply_gradients(zip(grad_adv_excl, adv_layers))
         else: 
-            grad_class = class_tape.gradient(loss, self.trainable_variables) 
+            grad_class = unscale_gradients(self.optimizer, class_tape.gradient(scaled_loss, self.trainable_variables))
             self.optimizer.apply_gradients(zip(grad_class, self.trainable_variables)) 
         # Update metrics
         self.loss_tracker.update_state(loss)
@@ -212,32 +226,20 @@ class DeepTauModel(keras.Model):
         return metrics
 
 
-def reshape_tensor(x, y, weights, active): 
-    x_out = []
-    count = 0
-    for elem in x:
-        if count in active:
-            x_out.append(elem)
-        count +=1
-    return tuple(x_out), y, weights
-
-def rm_inner(x, y, weights, i_outer, i_start_cut, i_end_cut): 
-    x_out = []
-    count = 0
-    for elem in x:
-        if count in i_outer: 
-            s = elem.get_shape().as_list()
-            m = np.ones((s[1], s[2], s[3])) 
-            m[i_start_cut:i_end_cut, i_start_cut:i_end_cut, :] = 0
-            m = m[None,:, :, :]
-            t = tf.constant(m, dtype=tf.float32)
-            out = tf.multiply(elem, t)
-            x_out.append(out)
-        else: 
-            x_out.append(elem)
-        count+=1
-    print("Removed Inner Area From Outer Cone")
-    return tuple(x_out), y, weights
+def make_tf_input_preprocess(active, outer_indices=None, n_outer_cells=None, i_start_cut=None, i_end_cut=None):
+    """Returns the function for Dataset.map which keeps only the active inputs (indices in the x tuple of the
+    tf dataset) and, if outer_indices are given, zeroes the area of the outer grids which is covered by the inner grid
+    (cells i_start_cut:i_end_cut). The mask is computed once and broadcast over the batch and the features."""
+    active = sorted(active)
+    mask = None
+    if outer_indices is not None:
+        mask = np.ones((1, n_outer_cells, n_outer_cells, 1), dtype=np.float32)
+        mask[:, i_start_cut:i_end_cut, i_start_cut:i_end_cut, :] = 0
+        print("Removed Inner Area From Outer Cone")
+    def preprocess(x, y, weights):
+        x_out = tuple(x[i] * mask if mask is not None and i in outer_indices else x[i] for i in active)
+        return x_out, y, weights
+    return preprocess
 
 class NetSetup:
     def __init__(self, activation, dropout_rate=0, reduction_rate=1, kernel_regularizer=None):
@@ -449,7 +451,8 @@ def create_model(net_config, model_name, loss=None, use_AdvDataset = False, adv_
     final_dense = reduce_n_features_1d(features_concat, dense_net_setup, 'final')
     output_layer = Dense(net_config.n_outputs, name="final_dense_last",
                          kernel_initializer=dense_net_setup.kernel_init)(final_dense)
-    softmax_output = Activation("softmax", name="main_output")(output_layer)
+    # outputs are computed in float32 with mixed precision for the numerical stability of the losses
+    softmax_output = Activation("softmax", name="main_output", dtype="float32")(output_layer)
 
     
     
@@ -457,14 +460,14 @@ def create_model(net_config, model_name, loss=None, use_AdvDataset = False, adv_
         final_dense_adv = reduce_n_features_1d(features_concat, dense_net_setup, 'final_adv')
         output_layer_adv = Dense(1, name="final_dense_adv",
                             kernel_initializer=dense_net_setup.kernel_init)(final_dense_adv)
-        sigmoid_output_adv = Activation("sigmoid", name="adv_output")(output_layer_adv)
+        sigmoid_output_adv = Activation("sigmoid", name="adv_output", dtype="float32")(output_layer_adv)
         model = DeepTauModel(input_layers, [softmax_output, sigmoid_output_adv], loss=loss, name=model_name, use_AdvDataset=True,
                              adv_parameter=adv_param, n_adv_tau=n_adv_tau, adv_learning_rate=adv_learning_rate)
     else:
         model = DeepTauModel(input_layers, softmax_output, loss = loss, name=model_name)
     return model
 
-def compile_model(model, opt_name, learning_rate):
+def compile_model(model, opt_name, learning_rate, jit_compile=False):
     # opt = keras.optimizers.Adam(lr=learning_rate)
     opt = getattr(tf.keras.optimizers, opt_name)(learning_rate=learning_rate)
         
@@ -479,7 +482,8 @@ def compile_model(model, opt_name, learning_rate):
         TauLosses.Hcat_eInv, TauLosses.Hcat_muInv, TauLosses.Hcat_jetInv,
         TauLosses.Fe, TauLosses.Fmu, TauLosses.Fjet, TauLosses.Fcmb
     ]
-    model.compile(loss=None, optimizer=opt, metrics=metrics, weighted_metrics=metrics) # loss is now defined in DeepTauModel
+    model.compile(loss=None, optimizer=opt, metrics=metrics, weighted_metrics=metrics,
+                  jit_compile=jit_compile) # loss is now defined in DeepTauModel
 
     # log metric names for passing them during model loading
     metric_names = {(m if isinstance(m, str) else m.__name__): '' for m in metrics}
@@ -494,7 +498,6 @@ def run_training(model, data_loader, to_profile, log_suffix, old_opt=None):
         tauflat_index = tf_dataset_x_order.index("TauFlat")
         inner_indices = [i for i, elem in enumerate(tf_dataset_x_order) if 'inner' in elem]
         outer_indices = [i for i, elem in enumerate(tf_dataset_x_order) if 'outer' in elem]
-        ds = tf.data.experimental.load(data_loader.tf_input_dir, compression="GZIP") # import dataset
         if data_loader.rm_inner_from_outer:
             n_inner = data_loader.n_inner_cells
             n_outer = data_loader.n_outer_cells
@@ -505,9 +508,6 @@ def run_training(model, data_loader, to_profile, log_suffix, old_opt=None):
             if outer_cellstoexclude % 2 != n_outer % 2: outer_cellstoexclude += 1
             i_start = int((n_outer - outer_cellstoexclude) / 2)
             i_end = int(n_outer - i_start)
-            my_ds = ds.map(lambda x, y, weights: rm_inner(x, y, weights, outer_indices, i_start, i_end))
-        else: 
-            my_ds = ds
         cell_locations = data_loader.cell_locations
         active_features = data_loader.active_features
         active = [] #list of elements to be kept
@@ -517,9 +517,53 @@ def run_training(model, data_loader, to_profile, log_suffix, old_opt=None):
             active.extend(inner_indices)
         if "outer" in cell_locations:
             active.extend(outer_indices)
-        dataset = my_ds.map(lambda x, y, weights: reshape_tensor(x, y, weights, active))
-        data_train = dataset.take(data_loader.n_batches) #take first values for training
-        data_val = dataset.skip(data_loader.n_batches).take(data_loader.n_batches_val) # take next values for validation
+        if data_loader.rm_inner_from_outer:
+            preprocess_fn = make_tf_input_preprocess(active, outer_indices, n_outer, i_start, i_end)
+        else:
+            preprocess_fn = make_tf_input_preprocess(active)
+        def preprocess(ds):
+            return ds.map(preprocess_fn, num_parallel_calls=tf.data.AUTOTUNE)
+        if is_tfrecord_cache(data_loader.tf_input_dir):
+            # sharded cache written by ROOT_to_tf.py with separate train and val splits
+            n_batches, n_batches_val = data_loader.n_batches, data_loader.n_batches_val
+            if data_loader.n_workers > 1: # each worker reads a disjoint subset of the shards
+                n_batches, n_batches_val = n_batches // data_loader.n_workers, n_batches_val // data_loader.n_workers
+            data_train = preprocess(load_tfrecord_cache(data_loader.tf_input_dir, "train", data_loader.worker_index,
+                                                        data_loader.n_workers)).take(n_batches)
+            data_val = preprocess(load_tfrecord_cache(data_loader.tf_input_dir, "val", data_loader.worker_index,
+                                                      data_loader.n_workers)).take(n_batches_val)
+        else:
+            # dataset saved with tf.data.experimental.save
+            dataset = preprocess(tf.data.experimental.load(data_loader.tf_input_dir, compression="GZIP"))
+            data_train = dataset.take(data_loader.n_batches) #take first values for training
+            data_val = dataset.skip(data_loader.n_batches).take(data_loader.n_batches_val) # take next values for validation
+            if data_loader.n_workers > 1:
+                data_train = data_train.shard(data_loader.n_workers, data_loader.worker_index)
+                data_val = data_val.shard(data_loader.n_workers, data_loader.worker_index)
+        if data_loader.tf_cache is not False:
+            # the preprocessed batches are cached during the first epoch: in memory ("") or in files in tf_cache
+            # the file names include a hash of the inputs of the preprocessing, so that a cache is never reused with
+            # a different dataset, split or selection of the inputs
+            cache_key = hashlib.sha1(json.dumps({
+                "tf_input_dir": os.path.abspath(data_loader.tf_input_dir),
+                "n_batches": data_loader.n_batches, "n_batches_val": data_loader.n_batches_val,
+                "n_workers": data_loader.n_workers, "active": sorted(active),
+                "i_start": i_start if data_loader.rm_inner_from_outer else None,
+                "i_end": i_end if data_loader.rm_inner_from_outer else None,
+            }, sort_keys=True).encode()).hexdigest()[:12]
+            def cache_file(split):
+                if data_loader.tf_cache == "": return ""
+                os.makedirs(data_loader.tf_cache, exist_ok=True)
+                path = os.path.join(data_loader.tf_cache, f"worker{data_loader.worker_index}_{split}_{cache_key}")
+                # a run interrupted during the first epoch leaves a lockfile and a partial cache (path_<shard>.*),
+                # on which tf refuses to write the cache: they are removed (tf_cache must not be shared by concurrent runs)
+                for partial_file in glob(path + "_*"):
+                    os.remove(partial_file)
+                return path
+            data_train = data_train.cache(cache_file("train"))
+            data_val = data_val.cache(cache_file("val"))
+        data_train = data_train.prefetch(tf.data.AUTOTUNE)
+        data_val = data_val.prefetch(tf.data.AUTOTUNE)
         print("Dataset Loaded with TensorFlow")
     elif data_loader.input_type == "ROOT":
         gen_train = data_loader.get_generator(primary_set = True, return_weights = data_loader.use_weights)
@@ -546,8 +590,23 @@ def run_training(model, data_loader, to_profile, log_suffix, old_opt=None):
     else:
         raise RuntimeError("Input type not supported, please select 'ROOT', 'tf' or 'Adversarial'")
 
-    
-    
+    profiler = TrainingProfiler(lambda: data_loader.active_queues.get(True), data_loader.batch_size, mlflow.log_metrics)
+    data_train = profiler.instrument_dataset(data_train)
+
+    steps_per_epoch, validation_steps = None, None
+    if data_loader.n_workers > 1:
+        if data_loader.use_previous_opt:
+            raise RuntimeError("use_previous_opt is not supported for the multi-worker training.")
+        # The datasets are already split between the workers, so that they are neither sharded nor rebatched by the
+        # strategy (n_tau is the batch size per replica). All workers have to run the same number of steps:
+        # the datasets are repeated and the number of steps is fixed.
+        strategy = model.distribute_strategy
+        n_replicas = strategy.num_replicas_in_sync
+        steps_per_epoch = data_loader.n_batches // n_replicas
+        validation_steps = data_loader.n_batches_val // n_replicas
+        data_train_local, data_val_local = data_train.repeat(), data_val.repeat()
+        data_train = strategy.distribute_datasets_from_function(lambda input_context: data_train_local)
+        data_val = strategy.distribute_datasets_from_function(lambda input_context: data_val_local)
 
     if data_loader.use_previous_opt:
         for elem in data_train:
@@ -560,46 +619,58 @@ def run_training(model, data_loader, to_profile, log_suffix, old_opt=None):
 
     model_name = data_loader.model_name
     log_name = '%s_%s' % (model_name, log_suffix)
+    is_chief = data_loader.worker_index == 0
     csv_log_file = "metrics.log"
-    if os.path.isfile(csv_log_file):
-        close_file(csv_log_file)
-        os.remove(csv_log_file)
-    csv_log = CSVLogger(csv_log_file, append=True)
-    time_checkpoint = TimeCheckpoint(12*60*60, log_name)
-    callbacks = [time_checkpoint, csv_log]
+    time_checkpoint = TimeCheckpoint(12*60*60, log_name, data_loader.worker_index)
+    callbacks = [time_checkpoint, profiler]
 
+    # only the chief worker writes the logs
     logs = log_name + '_' + datetime.now().strftime("%Y.%m.%d(%H:%M)")
-    tboard_callback = tf.keras.callbacks.TensorBoard(log_dir = logs,
-                                                     profile_batch = ('100, 300' if to_profile else 0),
-                                                     update_freq = ( 0 if data_loader.n_batches_log<=0 else data_loader.n_batches_log ))
-    callbacks.append(tboard_callback)
+    if is_chief:
+        if os.path.isfile(csv_log_file):
+            close_file(csv_log_file)
+            os.remove(csv_log_file)
+        csv_log = CSVLogger(csv_log_file, append=True)
+        callbacks.append(csv_log)
+
+        tboard_callback = tf.keras.callbacks.TensorBoard(log_dir = logs,
+                                                         profile_batch = ('100, 300' if to_profile else 0),
+                                                         update_freq = ( 0 if data_loader.n_batches_log<=0 else data_loader.n_batches_log ))
+        callbacks.append(tboard_callback)
 
     fit_hist = model.fit(data_train, validation_data = data_val,
                          epochs = data_loader.n_epochs, initial_epoch = data_loader.epoch,
+                         steps_per_epoch = steps_per_epoch, validation_steps = validation_steps,
                          callbacks = callbacks)
 
     model_path = f"{log_name}_final.tf"
-    model.save(model_path, save_format="tf")
+    save_model(model, model_path, data_loader.worker_index)
 
     # mlflow logs
-    for checkpoint_dir in glob(f'{log_name}*.tf'):
-         mlflow.log_artifacts(checkpoint_dir, f"model_checkpoints/{checkpoint_dir}")
-    mlflow.log_artifacts(model_path, "model")
-    mlflow.log_artifacts(logs, "custom_tensorboard_logs")
-    mlflow.log_artifact(csv_log_file)
+    if is_chief:
+        for checkpoint_dir in glob(f'{log_name}*.tf'):
+             mlflow.log_artifacts(checkpoint_dir, f"model_checkpoints/{checkpoint_dir}")
+        mlflow.log_artifacts(model_path, "model")
+        mlflow.log_artifacts(logs, "custom_tensorboard_logs")
+        mlflow.log_artifact(csv_log_file)
     mlflow.log_param('model_name', model_name)
 
     return fit_hist
 
 @hydra.main(config_path='.', config_name='train')
 def main(cfg: DictConfig) -> None:
-    # set up mlflow experiment id
-    mlflow.set_tracking_uri(f"file://{to_absolute_path(cfg.path_to_mlflow)}")
+    setup_gpu(cfg.gpu_cfg)
+    strategy, worker_index, n_workers = setup_strategy(cfg.get("multi_worker", False))
+
+    # set up mlflow experiment id, only the chief worker logs to path_to_mlflow, the others use a temporary storage
+    path_to_mlflow = to_absolute_path(cfg.path_to_mlflow) if worker_index == 0 else \
+                     tempfile.mkdtemp(prefix=f'mlruns_worker{worker_index}_')
+    mlflow.set_tracking_uri(f"file://{path_to_mlflow}")
     experiment = mlflow.get_experiment_by_name(cfg.experiment_name)
 
     if experiment is not None:
         run_kwargs = {'experiment_id': experiment.experiment_id}
-        if cfg["pretrained"] is not None: # initialise with pretrained run, otherwise create a new run
+        if cfg["pretrained"] is not None and worker_index == 0: # initialise with pretrained run, otherwise create a new run
             run_kwargs['run_id'] = cfg["pretrained"]["run_id"]
     else: # create new experiment
         experiment_id = mlflow.create_experiment(cfg.experiment_name)
@@ -612,21 +683,23 @@ def main(cfg: DictConfig) -> None:
         active_run = mlflow.active_run()
         run_id = active_run.info.run_id
 
-        setup_gpu(cfg.gpu_cfg)
         training_cfg = OmegaConf.to_object(cfg.training_cfg) # convert to python dictionary
         scaling_cfg = to_absolute_path(cfg.scaling_cfg)
-        dataloader = DataLoader.DataLoader(training_cfg, scaling_cfg)
+        dataloader = DataLoader.DataLoader(training_cfg, scaling_cfg, worker_index, n_workers)
         setup = dataloader.config["SetupNN"]
+        setup_mixed_precision(setup)
         TauLosses.SetSFs(*setup["TauLossesSFs"])
         print("loss consts:",TauLosses.Le_sf, TauLosses.Lmu_sf, TauLosses.Ltau_sf, TauLosses.Ljet_sf)
 
         netConf_full = dataloader.get_net_config()
 
-        if dataloader.input_type == "Adversarial":
-            model = create_model(netConf_full, dataloader.model_name, loss=setup["loss"], use_AdvDataset = True, 
-                                adv_param = dataloader.adversarial_parameter, n_adv_tau=dataloader.adv_batch_size, adv_learning_rate=dataloader.adv_learning_rate)
-        else:
-            model = create_model(netConf_full, dataloader.model_name, loss=setup["loss"])
+        # the model and the optimizers are created within the scope of the distribution strategy
+        with strategy.scope():
+            if dataloader.input_type == "Adversarial":
+                model = create_model(netConf_full, dataloader.model_name, loss=setup["loss"], use_AdvDataset = True, 
+                                    adv_param = dataloader.adversarial_parameter, n_adv_tau=dataloader.adv_batch_size, adv_learning_rate=dataloader.adv_learning_rate)
+            else:
+                model = create_model(netConf_full, dataloader.model_name, loss=setup["loss"])
 
         if cfg.pretrained is None:
             print("Warning: no pretrained NN -> training will be started from scratch")
@@ -650,14 +723,15 @@ def main(cfg: DictConfig) -> None:
             old_opt = old_model.optimizer
             old_vars = [var.name for var in old_model.trainable_variables]
 
-        compile_model(model, setup["optimizer_name"], setup["learning_rate"])
+        with strategy.scope():
+            compile_model(model, setup["optimizer_name"], setup["learning_rate"], setup.get("jit_compile", False))
         fit_hist = run_training(model, dataloader, False, cfg.log_suffix, old_opt=old_opt)
 
         # log NN params
         for net_type in ['tau_net', 'comp_net', 'comp_merge_net', 'conv_2d_net', 'dense_net']:
             mlflow.log_params({f'{net_type}_{k}': v for k,v in cfg.training_cfg.SetupNN[net_type].items()})
         mlflow.log_params({f'TauLossesSFs_{i}': v for i,v in enumerate(cfg.training_cfg.SetupNN.TauLossesSFs)})
-        with open(to_absolute_path(f'{cfg.path_to_mlflow}/{run_kwargs["experiment_id"]}/{run_id}/artifacts/model_summary.txt')) as f:
+        with open(f'{path_to_mlflow}/{run_kwargs["experiment_id"]}/{run_id}/artifacts/model_summary.txt') as f:
             for l in f:
                 if (s:='Trainable params: ') in l:
                     mlflow.log_param('n_train_params', int(l.split(s)[-1].replace(',', '')))
@@ -677,6 +751,8 @@ def main(cfg: DictConfig) -> None:
         mlflow.log_param('git_commit', _get_git_commit(to_absolute_path('.')))
         print(f'\nTraining has finished! Corresponding MLflow experiment name (ID): {cfg.experiment_name}({run_kwargs["experiment_id"]}), and run ID: {run_id}\n')
         mlflow.end_run()
+        if worker_index != 0:
+            shutil.rmtree(path_to_mlflow)
 
         # Temporary workaround to kill additional subprocesses that have not exited correctly
         current_process = psutil.Process()
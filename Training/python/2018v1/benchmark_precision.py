@@ -0,0 +1,57 @@
+import argparse
+parser = argparse.ArgumentParser(description='Training steps/s of DeepTauModel for each mixed precision policy and XLA setting.')
+parser.add_argument('--config', required=False, type=str, default='../../configs/training_v1.yaml', help="training config")
+parser.add_argument('--scaling', required=False, type=str,
+                    default='../../configs/ShuffleMergeSpectral_trainingSamples-2_files_0_498.json', help="scaling config")
+parser.add_argument('--policies', required=False, type=str, default='float32,mixed_float16,mixed_bfloat16',
+                    help="list of the Keras dtype policies")
+parser.add_argument('--jit-compile', required=False, type=str, default='0,1', help="list of the jit_compile settings")
+parser.add_argument('--n-tau', required=False, type=int, default=None, help="batch size (default: Setup.n_tau)")
+parser.add_argument('--n-warmup', required=False, type=int, default=3, help="number of steps before the timing")
+parser.add_argument('--n-steps', required=False, type=int, default=20, help="number of timed steps")
+parser.add_argument('--cpu', action='store_true', help="hide the GPUs")
+args = parser.parse_args()
+
+import os
+if args.cpu:
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+import time
+import yaml
+import numpy as np
+import tensorflow as tf
+from Training_v0p1 import create_model
+from common import TauLosses, setup_mixed_precision
+import DataLoader
+
+with open(args.config) as f:
+    training_cfg = yaml.safe_load(f)
+dataloader = DataLoader.DataLoader(training_cfg, args.scaling)
+net_config = dataloader.get_net_config()
+setup = dataloader.config["SetupNN"]
+TauLosses.SetSFs(*setup["TauLossesSFs"])
+n_tau = args.n_tau if args.n_tau is not None else dataloader.batch_size
+
+def make_dataset(model):
+    rng = np.random.default_rng(12345)
+    x = tuple(rng.normal(size=(n_tau, *inp.shape[1:])).astype(np.float32) for inp in model.inputs)
+    y = np.eye(net_config.n_outputs, dtype=np.float32)[rng.integers(0, net_config.n_outputs, size=n_tau)]
+    weights = np.ones(n_tau, dtype=np.float32)
+    return tf.data.Dataset.from_tensors((x, y, weights)).repeat()
+
+print("{:>16} {:>12} {:>10} {:>12}".format('policy', 'jit_compile', 'steps/s', 'loss'))
+for policy in args.policies.split(','):
+    for jit_compile in [ bool(int(j)) for j in args.jit_compile.split(',') ]:
+        tf.keras.backend.clear_session()
+        setup_mixed_precision({ "mixed_precision": policy })
+        model = create_model(net_config, dataloader.model_name)
+        # metrics are not included, as in the training they are only a small fraction of the step time
+        model.compile(loss=None, optimizer=getattr(tf.keras.optimizers, setup["optimizer_name"])(setup["learning_rate"]),
+                      jit_compile=jit_compile)
+        dataset = make_dataset(model)
+        model.fit(dataset, steps_per_epoch=args.n_warmup, epochs=1, verbose=0)
+        start = time.time()
+        hist = model.fit(dataset, steps_per_epoch=args.n_steps, epochs=1, verbose=0)
+        steps_per_second = args.n_steps / (time.time() - start)
+        print("{:>16} {:>12} {:>10.2f} {:>12.4f}".format(policy, str(jit_compile), steps_per_second,
+                                                        hist.history['loss'][-1]))
+tf.keras.mixed_precision.set_global_policy("float32")
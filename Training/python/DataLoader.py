@@ -18,13 +18,17 @@ def LoaderThread(queue_out,
                  return_truth,
                  return_weights,
                  active_features,
-                 cell_locations):
+                 cell_locations,
+                 weight_table):
 
     def DataProcess(data):
 
         X_all = GetData.getX(data, data.tau_i, batch_size, n_grid_features, n_flat_features,
                              input_grids, n_inner_cells, n_outer_cells, active_features, cell_locations)
-        if return_weights:
+        if return_weights and weight_table is not None:
+            weights = GetData.getweights(weight_table, data.weight_pt, data.weight_eta, data.y_onehot,
+                                         data.tau_i, tau_types)
+        elif return_weights:
             weights = GetData.getdata(data.weight, data.tau_i, -1, debug_area="weights")
         if return_truth:
             Y = GetData.getdata(data.y_onehot, data.tau_i, (batch_size, tau_types), debug_area="truth")
@@ -62,7 +66,7 @@ def LoaderThread(queue_out,
 
 class DataLoader (DataLoaderBase):
 
-    def __init__(self, config, file_scaling):
+    def __init__(self, config, file_scaling, worker_index = 0, n_workers = 1):
 
         self.dataloader_core = config["Setup"]["dataloader_core"]
 
@@ -107,22 +111,44 @@ class DataLoader (DataLoaderBase):
         self.input_type = self.config["Setup"]["input_type"]
         self.tf_input_dir = self.config["Setup"]["tf_input_dir"]
         self.tf_dataset_x_order = self.config["Setup"]["tf_dataset_x_order"]
+        self.tf_cache = self.config["Setup"]["tf_cache"]
         self.adversarial_dataset = self.config["Setup"]["adversarial_dataset"]
         self.adversarial_parameter = self.config["Setup"]["adv_parameter"]
         self.adv_batch_size = self.config["Setup"]["n_adv_tau"]
         self.adv_learning_rate = self.config["Setup"]["adv_learning_rate"]
         self.use_previous_opt = self.config["Setup"]["use_previous_opt"]
-        
+        self.weights_from_table = self.config["Setup"]["weights_from_table"]
+        self.worker_index = worker_index
+        self.n_workers = n_workers
+        self.active_queues = {} # {primary_set: QueueEx of the running generator}
+        if self.n_workers > 1 and (self.n_batches <= 0 or self.n_batches_val <= 0):
+            raise RuntimeError("n_batches and n_batches_val should be set for the multi-worker training.")
+
         if self.input_type == "ROOT" or self.input_type == "Adversarial":
             data_files = glob.glob(f'{self.config["Setup"]["input_dir"]}/*.root') 
+            if self.n_workers > 1:
+                # the same split on all workers
+                data_files = sorted(data_files)
             self.train_files, self.val_files = \
                 np.split(data_files, [int(len(data_files)*(1-self.validation_split))])
+            # each worker reads a disjoint subset of files
+            self.train_files = self.train_files[self.worker_index::self.n_workers]
+            self.val_files = self.val_files[self.worker_index::self.n_workers]
             print("Files for training:", len(self.train_files))
             print("Files for validation:", len(self.val_files))
             
 
         self.compile_classes(config, file_scaling, self.dataloader_core, data_files)
 
+        # weights are computed once here and shared with all loader workers
+        self.weight_table = None
+        if self.weights_from_table:
+            self.weight_table = WeightTable.from_spectra(
+                self.config["Setup"]["input_spectrum"], self.config["Setup"]["target_spectrum"],
+                { int(tau_type): "eta_pt_hist_"+tau_name for tau_type, tau_name in self.config["Setup"]["tau_types_names"].items() },
+                "eta_pt_hist_tau", self.tau_types, self.config["Setup"]["yaxis"], self.config["Setup"]["xaxis_list"],
+                self.config["Setup"]["xmin"], self.config["Setup"]["xmax"], self.config["Setup"]["weight_thr"])
+
 
 
     def get_generator(self, primary_set = True, return_truth = True, return_weights = True, show_progress = False, adversarial = False):
@@ -133,6 +159,8 @@ class DataLoader (DataLoaderBase):
                                " file list is empty.")
 
         n_batches = self.n_batches if primary_set else self.n_batches_val
+        if self.n_workers > 1:
+            n_batches = n_batches // self.n_workers # batches per worker
         print("Number of workers in DataLoader: ", self.n_load_workers)
         converter = torch_to_tf(return_truth, return_weights)
 
@@ -145,6 +173,7 @@ class DataLoader (DataLoaderBase):
             [ queue_files.put(file) for file in _files ]
 
             queue_out = QueueEx(max_size = self.max_queue_size, max_n_puts = n_batches)
+            self.active_queues[primary_set] = queue_out # monitored by TrainingProfiler
             terminators = [ [mp.Event(),mp.Event()] for _ in range(self.n_load_workers) ]
 
             processes = []
@@ -154,7 +183,8 @@ class DataLoader (DataLoaderBase):
                         args = (queue_out, queue_files, terminators, i,
                                 self.input_grids, self.batch_size, self.n_inner_cells,
                                 self.n_outer_cells, self.n_flat_features, self.n_grid_features,
-                                self.tau_types, return_truth, return_weights, self.active_features, self.cell_locations)))
+                                self.tau_types, return_truth, return_weights, self.active_features, self.cell_locations,
+                                self.weight_table)))
                 processes[-1].start()
 
             if adversarial:
@@ -1,4 +1,5 @@
 import torch.multiprocessing as mp
+from multiprocessing import shared_memory
 from queue import Empty as EmptyException
 from queue import Full as FullException
 
@@ -8,8 +9,10 @@ import ROOT as R
 import config_parse
 import tensorflow as tf
 import torch
+import uproot
 import os
 import time
+import weakref
 from makeTree import MakeTupleClass
 
 # class TerminateGenerator:
@@ -139,6 +142,122 @@ class DataSource:
         else:
             return None
 
+class WeightTable:
+    '''
+    (pt, |eta|) weights of each class as a flat lookup table.
+    The table reproduces the TH2D weights of the c++ DataLoader
+    (Histogram_2D::get_weights_th2d), but it is built only once
+    in the main process and is shared with the loader workers
+    through shared memory, where the weights of the whole batch
+    are looked up at once with get_weights().
+    Table layout: [class, pt bin, eta bin], with the
+    underflow/overflow bins (index 0 and n+1) set to 0.
+    '''
+
+    def __init__(self, table, xmin, xmax, ymin, ymax):
+        self.xmin, self.xmax = xmin, xmax
+        self.ymin, self.ymax = ymin, ymax
+        self.shm = shared_memory.SharedMemory(create=True, size=table.nbytes)
+        self.table = np.ndarray(table.shape, dtype=table.dtype, buffer=self.shm.buf)
+        self.table[:] = table
+        # the segment is owned by the main process, the workers only attach to it
+        weakref.finalize(self, self.shm.unlink)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["table"]
+        state["shm"] = self.shm.name
+        state["shape"] = self.table.shape
+        return state
+
+    def __setstate__(self, state):
+        shape = state.pop("shape")
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state["shm"])
+        self.table = np.ndarray(shape, dtype=np.float64, buffer=self.shm.buf)
+
+    @staticmethod
+    def find_fix_bin(x, n, xmin, xmax):
+        '''Vectorized TAxis::FindFixBin'''
+        x = np.asarray(x, dtype=np.float64)
+        bins = np.full(x.shape, n+1, dtype=np.int64)
+        inside = (x >= xmin) & (x < xmax)
+        bins[inside] = 1 + (n * (x[inside] - xmin) / (xmax - xmin)).astype(np.int64)
+        bins[x < xmin] = 0
+        return bins
+
+    @staticmethod
+    def project(values, xedges, yedges, yaxis, xaxis_list, xmin, xmax):
+        '''
+        Sums the TH2D bins into the custom binning of Histogram_2D
+        by the bin centers (Histogram_2D::th2d_add).
+        Returns [y bin, x bin] with the x underflow in x bin 0.
+        '''
+        def check_axis(input_axis, this_axis):
+            return np.all(np.min(np.abs(np.subtract.outer(this_axis, input_axis)), axis=1)
+                          < 2*np.finfo(np.float32).eps)
+        if not check_axis(yedges, yaxis) or not all(check_axis(xedges, xaxis) for xaxis in xaxis_list):
+            raise RuntimeError("Given TH2D can not be imported: binning does not match yaxis/xaxis_list")
+
+        cx, cy = np.meshgrid((xedges[1:] + xedges[:-1]) / 2, (yedges[1:] + yedges[:-1]) / 2, indexing="ij")
+        selected = (cx >= xmin) & (cx < xmax) & (cy >= yaxis[0]) & (cy < yaxis[-1])
+        cx, cy, values = cx[selected], cy[selected], values[selected]
+        iy = np.searchsorted(yaxis, cy, side="right") - 1
+        ix = np.empty_like(iy)
+        for i, xaxis in enumerate(xaxis_list):
+            ix[iy==i] = np.searchsorted(xaxis, cx[iy==i], side="right")
+        content = np.zeros((len(yaxis)-1, max(len(xaxis) for xaxis in xaxis_list)+1))
+        np.add.at(content, (iy, ix), values)
+        return content
+
+    @classmethod
+    def from_spectra(cls, input_spectrum, target_spectrum, input_hists, target_hist,
+                     n_classes, yaxis, xaxis_list, xmin, xmax, weight_thr):
+        '''
+        input_hists: {class index: name of the input (eta, pt) TH2D},
+        target_hist: name of the target (eta, pt) TH2D.
+        '''
+        if len(yaxis) != len(xaxis_list) + 1:
+            raise ValueError("Y binning list does not match X binning length")
+        yaxis = np.asarray(yaxis, dtype=np.float64)
+        xaxis_list = [ np.asarray(xaxis, dtype=np.float64) for xaxis in xaxis_list ]
+
+        with uproot.open(target_spectrum) as file_target:
+            target = cls.project(*file_target[target_hist].to_numpy(), yaxis, xaxis_list, xmin, xmax)
+
+        # uniform binning with the finest bin width (as in get_weights_th2d)
+        ny = int((yaxis[-1] - yaxis[0]) / np.min(np.diff(yaxis)))
+        nx = int((xmax - xmin) / min(np.min(np.diff(xaxis)) for xaxis in xaxis_list))
+        cy = yaxis[0] + (np.arange(1, ny+1) - 0.5) * ((yaxis[-1] - yaxis[0]) / ny)
+        cx = xmin + (np.arange(1, nx+1) - 0.5) * ((xmax - xmin) / nx)
+        iy = np.repeat(np.searchsorted(yaxis, cy, side="right") - 1, nx)
+        ix = np.empty_like(iy)
+        cx = np.tile(cx, ny)
+        for i, xaxis in enumerate(xaxis_list):
+            ix[iy==i] = np.searchsorted(xaxis, cx[iy==i], side="right")
+
+        table = np.zeros((n_classes, ny+2, nx+2))
+        with uproot.open(input_spectrum) as file_input:
+            for class_index, hist_name in input_hists.items():
+                input_content = cls.project(*file_input[hist_name].to_numpy(), yaxis, xaxis_list, xmin, xmax)
+                ratio = np.divide(target, input_content, out=np.zeros_like(target), where=input_content!=0)
+                table[class_index, 1:-1, 1:-1] = ratio[iy, ix].reshape(ny, nx)
+
+        weights = table[list(input_hists.keys()), 1:-1, 1:-1]
+        with np.errstate(divide="ignore"):
+            imbalance = np.max(weights) / np.min(weights)
+        print(f"Weights imbalance: {imbalance}, imbalance threshold: {weight_thr}")
+        if imbalance > weight_thr:
+            raise RuntimeError("The imbalance in the weights exceeds the threshold.")
+
+        return cls(table, xmin, xmax, yaxis[0], yaxis[-1])
+
+    def get_weights(self, class_index, pt, eta):
+        _, ny, nx = self.table.shape
+        iy = self.find_fix_bin(pt, ny-2, self.ymin, self.ymax)
+        ix = self.find_fix_bin(eta, nx-2, self.xmin, self.xmax)
+        return self.table[class_index, iy, ix].astype(np.float32)
+
 class DataLoaderBase:
 
     @staticmethod
@@ -180,6 +299,18 @@ class GetData():
             raise RuntimeError("Terminate: nans detected in the tensor.")
         return torch.from_numpy(x)[:_filled_tau] if _reshape==-1 else torch.reshape(torch.from_numpy(x), _reshape)[:_filled_tau]
 
+    @staticmethod
+    def getweights(_weight_table,
+                   _obj_pt,
+                   _obj_eta,
+                   _obj_y,
+                   _filled_tau,
+                   _n_classes):
+        pt  = np.frombuffer(_obj_pt.data(), dtype=np.float32, count=_obj_pt.size())[:_filled_tau]
+        eta = np.frombuffer(_obj_eta.data(), dtype=np.float32, count=_obj_eta.size())[:_filled_tau]
+        y   = np.frombuffer(_obj_y.data(), dtype=np.float32, count=_obj_y.size()).reshape(-1, _n_classes)[:_filled_tau]
+        return torch.from_numpy(_weight_table.get_weights(np.argmax(y, axis=1), pt, eta))
+
     @staticmethod
     def getgrid(_obj_grid,
                 _filled_tau,
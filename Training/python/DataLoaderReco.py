@@ -12,14 +12,18 @@ def LoaderThread(queue_out,
                  n_features,
                  output_classes,
                  return_truth,
-                 return_weights):
+                 return_weights,
+                 weight_table):
 
 
     def DataProcess(data):
 
         X_all = GetData.getsequence(data.x, data.tau_i, batch_size, input_grids, n_sequence, n_features)
 
-        if return_weights:
+        if return_weights and weight_table is not None:
+            weights = GetData.getweights(weight_table, data.weight_pt, data.weight_eta, data.y,
+                                         data.tau_i, output_classes)
+        elif return_weights:
             weights = GetData.getdata(data.weights, data.tau_i, -1, debug_area="weights")
         if return_truth:
             Y = GetData.getdata(data.y, data.tau_i, (batch_size, output_classes), debug_area="truth")
@@ -63,6 +67,8 @@ class DataLoader (DataLoaderBase):
         self.compile_classes(config, file_scaling, dataloader_core)
 
         self.config = config
+        self.weights_from_table = self.config["Setup"]["weights_from_table"]
+        self.active_queues = {} # {primary_set: QueueEx of the running generator}
 
         # Computing additional variables: 
         self.config['input_map'] = {}
@@ -92,6 +98,16 @@ class DataLoader (DataLoaderBase):
         print("Files for training:", len(self.train_files))
         print("Files for validation:", len(self.val_files))
 
+        # weights are computed once here and shared with all loader workers
+        self.weight_table = None
+        if self.weights_from_table:
+            self.weight_table = WeightTable.from_spectra(
+                self.config["Setup"]["spectrum_to_reweight"], self.config["Setup"]["spectrum_to_reweight"],
+                { int(jet_type): "jet_eta_pt_"+jet_name for jet_type, jet_name in self.config["Setup"]["jet_types_names"].items() },
+                "jet_eta_pt_tau", self.config["Setup"]["output_classes"], self.config["Setup"]["yaxis"],
+                self.config["Setup"]["xaxis_list"], self.config["Setup"]["xmin"], self.config["Setup"]["xmax"],
+                self.config["Setup"]["weight_thr"])
+
     def get_predict_generator(self, return_truth=True, return_weights=False):
         '''
         The implementation of the deterministic generator
@@ -157,6 +173,7 @@ class DataLoader (DataLoaderBase):
             [ queue_files.put(file) for file in _files ]
 
             queue_out = QueueEx(max_size = self.config["SetupBaseNN"]["max_queue_size"], max_n_puts = n_batches)
+            self.active_queues[primary_set] = queue_out # monitored by TrainingProfiler
 
             processes = []
             n_load_workers = self.config["SetupBaseNN"]["n_load_workers"]
@@ -173,7 +190,8 @@ class DataLoader (DataLoaderBase):
                                    self.config['n_features'],
                                    self.config["Setup"]["output_classes"],
                                    return_truth,
-                                   return_weights)))
+                                   return_weights,
+                                   self.weight_table)))
                 processes[-1].start()
 
             # First part to iterate through the main part
@@ -29,7 +29,7 @@ from omegaconf import DictConfig, OmegaConf
 
 sys.path.insert(0, "..")
 from commonReco import *
-from common import setup_gpu
+from common import setup_gpu, setup_mixed_precision, TrainingProfiler
 import DataLoaderReco
 
 class _DotDict:
@@ -57,6 +57,28 @@ def knn(num_points, k, topk_indices, features):
         indices = tf.concat([batch_indices, tf.expand_dims(topk_indices, axis=3)], axis=3)  # (N, P, K, 2)
         return tf.gather_nd(features, indices)
 
+def knn_indices(points, num_points, k, mask=None, block_size=0):
+    """Indices of the k nearest neighbours of each point (N, P, k), the nearest point (the point itself) is excluded.
+    Args:
+        points: (N, P, C_p)
+        mask: (N, P), 1 for the valid points. Invalid points are selected as neighbours only if a point has less
+              than k valid neighbours.
+        block_size: if > 0, the distance matrix is computed for blocks of block_size query points,
+                    which limits the size of the distance matrix to (N, block_size, P).
+    """
+    with tf.name_scope('knn_indices'):
+        if block_size <= 0 or block_size > num_points:
+            block_size = num_points
+        if mask is not None:
+            valid = tf.expand_dims(tf.not_equal(mask, 0), axis=1)  # (N, 1, P)
+        indices = []
+        for start in range(0, num_points, block_size):
+            D = batch_distance_matrix_general(points[:, start:start+block_size, :], points)  # (N, block_size, P)
+            if mask is not None:
+                D = tf.where(valid, D, tf.constant(np.inf, dtype=D.dtype))
+            _, block_indices = tf.nn.top_k(-D, k=k + 1)  # (N, block_size, k+1)
+            indices.append(block_indices[:, :, 1:])
+        return indices[0] if len(indices) == 1 else tf.concat(indices, axis=1)
 
 class EdgeConv(tf.keras.layers.Layer):
 
@@ -66,15 +88,18 @@ class EdgeConv(tf.keras.layers.Layer):
         in_channels: # of input channels
         channels: tuple of output channels
         pooling: pooling method ('max' or 'average')
+        knn_block_size: if > 0, the neighbours are searched for blocks of knn_block_size points (see knn_indices)
     Inputs:
         points: (N, P, C_p)
         features: (N, P, C_0)
+        mask: (N, P), optional. If given, the neighbours are searched with knn_indices among the valid points,
+              otherwise with the full distance matrix (invalid points are expected to be shifted away).
     Returns:
         transformed points: (N, P, C_out), C_out = channels[-1]
     """
 
     def __init__(self, num_points, K, channels, with_bn=True,
-                activation='relu', pooling='average', name='edgeconv',
+                activation='relu', pooling='average', name='edgeconv', knn_block_size=0,
                 **kwargs):
         
         super(EdgeConv, self).__init__()
@@ -86,6 +111,7 @@ class EdgeConv(tf.keras.layers.Layer):
         self.activation = activation
         self.pooling = pooling
         self.name_ = name
+        self.knn_block_size = knn_block_size
 
         self.Conv2D_layers = []
         self.BatchNormalization_layers = []
@@ -107,23 +133,42 @@ class EdgeConv(tf.keras.layers.Layer):
             self.shortcut_activ = keras.layers.Activation(self.activation, name='%s_sc_act' % self.name_)
 
     @tf.function
-    def call(self, points, features):
+    def call(self, points, features, mask=None):
 
         with tf.name_scope('edgeconv'):
 
-            # distance
-            D = batch_distance_matrix_general(points, points)  # (N, P, P)
-            _, indices = tf.nn.top_k(-D, k=self.K + 1)  # (N, P, K+1)
-            indices = indices[:, :, 1:]  # (N, P, K)
-
             fts = features
-            knn_fts = knn(self.num_points, self.K, indices, fts)  # (N, P, K, C)
-            knn_fts_center = tf.tile(tf.expand_dims(fts, axis=2), (1, 1, self.K, 1))  # (N, P, K, C)
-            knn_fts = tf.concat([knn_fts_center, tf.subtract(knn_fts, knn_fts_center)], axis=-1)  # (N, P, K, 2*C)
+            if mask is None:
+                # distance
+                D = batch_distance_matrix_general(points, points)  # (N, P, P)
+                _, indices = tf.nn.top_k(-D, k=self.K + 1)  # (N, P, K+1)
+                indices = indices[:, :, 1:]  # (N, P, K)
+
+                knn_fts = knn(self.num_points, self.K, indices, fts)  # (N, P, K, C)
+                knn_fts_center = tf.tile(tf.expand_dims(fts, axis=2), (1, 1, self.K, 1))  # (N, P, K, C)
+                knn_fts = tf.concat([knn_fts_center, tf.subtract(knn_fts, knn_fts_center)], axis=-1)  # (N, P, K, 2*C)
+                x = self.Conv2D_layers[0](knn_fts)
+            else:
+                indices = knn_indices(points, self.num_points, self.K, mask, self.knn_block_size)  # (N, P, K)
+
+                # the first 1x1 convolution is linear: conv([x_i, x_j - x_i]) = x_i (W_c - W_d) + x_j W_d,
+                # hence it is applied to the points before gathering the neighbours,
+                # which avoids the (N, P, K, 2*C) edge features
+                conv = self.Conv2D_layers[0]
+                n_fts = features.shape[-1]
+                if not conv.built:
+                    conv.build(tf.TensorShape([None, self.num_points, self.K, 2 * n_fts]))
+                kernel = conv.kernel[0, 0]  # (2*C, C1)
+                fts = tf.cast(fts, kernel.dtype) # only the first input (points) is cast by keras with mixed precision
+                x_center = tf.matmul(fts, kernel[:n_fts] - kernel[n_fts:])  # (N, P, C1)
+                x_knn = tf.gather(tf.matmul(fts, kernel[n_fts:]), indices, batch_dims=1)  # (N, P, K, C1)
+                x = tf.expand_dims(x_center, axis=2) + x_knn
+                if conv.use_bias:
+                    x = tf.nn.bias_add(x, conv.bias)
 
-            x = knn_fts
             for idx, channel in enumerate(self.channels):
-                x = self.Conv2D_layers[idx](x)
+                if idx > 0:
+                    x = self.Conv2D_layers[idx](x)
                 if self.with_bn:
                     x = self.BatchNormalization_layers[idx](x)
                 if self.activation:
@@ -175,6 +220,12 @@ class ParticleNet(tf.keras.Model):
         assert(cfg["SequenceLength"]["PfCand"]==cfg["SequenceLength"]["PfCandCategorical"])
         self.setting.num_points = cfg["SequenceLength"]["PfCand"]
 
+        # neighbours search: among the valid pfCands only (masked) or among all pfCands with the invalid ones shifted away
+        self.setting.knn_masked = cfg["SetupParticleNet"].get("knn_masked", False)
+        self.setting.knn_block_size = cfg["SetupParticleNet"].get("knn_block_size", 0)
+        if not self.setting.knn_masked and tf.keras.mixed_precision.global_policy().compute_dtype == "float16":
+            raise RuntimeError("Distances to the shifted invalid pfCands overflow float16, set knn_masked: True.")
+
         self.map_features = cfg["input_map"]["PfCand"]
         self.name_ = name
 
@@ -185,7 +236,8 @@ class ParticleNet(tf.keras.Model):
         for layer_idx, layer_param in enumerate(self.setting.conv_params):
             K, channels = layer_param
             self.edge_conv_layers.append(EdgeConv(self.setting.num_points, K, channels, with_bn=True, activation='relu',
-                    pooling=self.setting.conv_pooling, name='%s_%s%d' % (self.name_, 'EdgeConv', layer_idx)))
+                    pooling=self.setting.conv_pooling, name='%s_%s%d' % (self.name_, 'EdgeConv', layer_idx),
+                    knn_block_size=self.setting.knn_block_size))
 
         self.dense_layers = []
         self.dense_dropout = []
@@ -198,7 +250,8 @@ class ParticleNet(tf.keras.Model):
                 if drop_rate is not None and drop_rate > 0:
                     self.dense_dropout.append(keras.layers.Dropout(drop_rate))
 
-            self.out = keras.layers.Dense(self.setting.num_class, activation='softmax')
+            # output is computed in float32 with mixed precision
+            self.out = keras.layers.Dense(self.setting.num_class, activation='softmax', dtype='float32')
 
 
 
@@ -214,14 +267,18 @@ class ParticleNet(tf.keras.Model):
 
         with tf.name_scope(self.name):
 
-            mask = tf.cast(tf.not_equal(xx_mask, 0), dtype='float32')  # 1 if valid
-            coord_shift = tf.multiply(999., tf.cast(tf.equal(mask, 0), dtype='float32'))  # make non-valid positions to 99
+            mask = tf.cast(tf.not_equal(xx_mask, 0), dtype=xx.dtype)  # 1 if valid
+            coord_shift = tf.multiply(999., tf.cast(tf.equal(mask, 0), dtype=xx.dtype))  # make non-valid positions to 99
 
             fts = tf.squeeze(self.batch_norm(tf.expand_dims(xx_ftr, axis=2)), axis=2)
 
             for layer_idx, layer_param in enumerate(self.setting.conv_params):
-                pts = tf.add(coord_shift, xx_coord) if layer_idx == 0 else tf.add(coord_shift, fts)
-                fts = self.edge_conv_layers[layer_idx](pts, fts)
+                if self.setting.knn_masked:
+                    pts = xx_coord if layer_idx == 0 else fts
+                    fts = self.edge_conv_layers[layer_idx](pts, fts, mask=mask[:, :, 0])
+                else:
+                    pts = tf.add(coord_shift, xx_coord) if layer_idx == 0 else tf.add(coord_shift, fts)
+                    fts = self.edge_conv_layers[layer_idx](pts, fts)
 
             fts = tf.multiply(fts, mask)
             pool = tf.reduce_mean(fts, axis=1)  # (N, C)
@@ -238,7 +295,7 @@ class ParticleNet(tf.keras.Model):
             return out  # (N, num_classes)
 
 
-def compile_model(model, learning_rate):
+def compile_model(model, learning_rate, jit_compile=False):
 
     opt = tf.keras.optimizers.Nadam(learning_rate=learning_rate, schedule_decay=1e-4)
     # opt = tf.keras.optimizers.Adam(learning_rate = learning_rate)
@@ -246,7 +303,7 @@ def compile_model(model, learning_rate):
     metrics = ["accuracy",
                tf.keras.metrics.BinaryAccuracy(name='BinaryAccuracy'),
                tf.keras.metrics.AUC(name='AUC', curve='ROC')]
-    model.compile(loss='binary_crossentropy', optimizer=opt, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=opt, metrics=metrics, jit_compile=jit_compile)
 
     # log metric names for passing them during model loading
     # metric_names = {(m if isinstance(m, str) else m.__name__): '' for m in metrics}
@@ -265,6 +322,9 @@ def run_training(model, data_loader, to_profile, log_suffix):
     data_val = tf.data.Dataset.from_generator(
         gen_val, output_types = input_types, output_shapes = input_shape
         ).prefetch(tf.data.AUTOTUNE)
+    profiler = TrainingProfiler(lambda: data_loader.active_queues.get(True), data_loader.config["Setup"]["n_tau"],
+                                mlflow.log_metrics)
+    data_train = profiler.instrument_dataset(data_train)
 
     net_setups =  data_loader.config["SetupBaseNN"]
     model_name = net_setups["model_name"]
@@ -275,7 +335,7 @@ def run_training(model, data_loader, to_profile, log_suffix):
         os.remove(csv_log_file)
     csv_log = CSVLogger(csv_log_file, append=True)
     time_checkpoint = TimeCheckpoint(12*60*60, log_name)
-    callbacks = [time_checkpoint, csv_log]
+    callbacks = [time_checkpoint, csv_log, profiler]
 
     # does not allow perbatch logging: 
     logs = log_name + '_' + datetime.now().strftime("%Y.%m.%d(%H:%M)")
@@ -327,13 +387,14 @@ def main(cfg: DictConfig) -> None:
         dl_config =  dataloader.config
 
 
+        setup_mixed_precision(dl_config["SetupBaseNN"])
         model = ParticleNet(name=dl_config["SetupBaseNN"]["model_name"], cfg=dl_config)
         model._name = dl_config["SetupBaseNN"]["model_name"]
 
         # print(input_shape[0])
         # compile_build = tf.ones(input_shape[0], dtype=tf.float32, name=None)
         model.build(list(input_shape[0]))
-        compile_model(model, dl_config["SetupBaseNN"]["learning_rate"])
+        compile_model(model, dl_config["SetupBaseNN"]["learning_rate"], dl_config["SetupBaseNN"].get("jit_compile", False))
         model.summary()
         fit_hist = run_training(model, dataloader, False, cfg.log_suffix)
 
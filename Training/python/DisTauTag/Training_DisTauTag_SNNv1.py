@@ -29,7 +29,7 @@ from omegaconf import DictConfig, OmegaConf
 
 sys.path.insert(0, "..")
 from commonReco import *
-from common import setup_gpu
+from common import setup_gpu, setup_mixed_precision, TrainingProfiler
 import DataLoaderReco
 
 # A shape is (N, P_A, C), B shape is (N, P_B, C)
@@ -87,7 +87,7 @@ class SpaceEdgeConv(tf.keras.layers.Layer):
         a   = tf.tile(x, (1, P, 1))   # (N, P*P, n_features)
         na   = tf.reshape(a, (N, P, P,-1))   # (N, P, P, n_features)
 
-        mask = tf.expand_dims(mask, axis=-1)    # (N, P, 1)
+        mask = tf.expand_dims(tf.cast(mask, x.dtype), axis=-1)    # (N, P, 1)
         mask_dim = tf.tile(mask, (1, P ,1))    # (N, P*P, 1)
         mask_dim = tf.reshape(mask_dim, (N, P, P,1))    # (N, P, P, 1)
 
@@ -104,6 +104,33 @@ class SpaceEdgeConv(tf.keras.layers.Layer):
 
         return output
 
+class SpaceEdgeConvReduced(SpaceEdgeConv):
+
+    """SpaceEdgeConv without the (N, P, P, n_features) copies of the input
+    The weighted sum of SpaceEdgeConv multiplies the features of each point j by W_ij and sums over i,
+    which is equal to the features of j scaled by the column sum of W. Same weights and output as SpaceEdgeConv.
+    """
+
+    @tf.function
+    def call(self, x, mask):
+
+        coor = x[:,:,-self.n_dim:]
+        D = batch_distance_matrix_general(coor,coor)    # (N, P, P)
+        W = tf.math.exp(-10*D)  # (N, P, P)
+
+        mask = tf.expand_dims(tf.cast(mask, x.dtype), axis=-1)    # (N, P, 1)
+        W_sum = tf.expand_dims(tf.math.reduce_sum(W, axis = 1), axis=-1) * mask    # (N, P, 1)
+
+        # need to substruct the personal features because they were counted in the 'W_sum'
+        ss = x * W_sum - x     # (N, P, n_features)
+        x = tf.concat((x, ss), axis = 2)    # (N, P, n_features*2)
+
+        ### Ax+b:
+        output = tf.matmul(x, self.A) + self.b
+        output = output * mask # reapply mask to be sure
+
+        return output
+
 class SpaceParticleNet(tf.keras.Model):
 
     def __init__(self, dl_config):
@@ -118,6 +145,7 @@ class SpaceParticleNet(tf.keras.Model):
         self.dropout_rate = dl_config["SetupSNN"]["dropout_rate"]
         self.regu_rate = dl_config["SetupSNN"]["regu_rate"]
         self.output_labels = dl_config["Setup"]["output_classes"]
+        self.edge_conv_impl = dl_config["SetupSNN"].get("edge_conv_impl", "tile")
 
         self.embedding_n       = dl_config["n_features"]["PfCandCategorical"]
         self.embedding         = self.embedding_n * [None]
@@ -140,8 +168,9 @@ class SpaceParticleNet(tf.keras.Model):
                 tf.keras.layers.Embedding(dl_config['embedded_param']['PfCandCategorical'][var][0],
                                           dl_config['embedded_param']['PfCandCategorical'][var][1])
 
+        edge_conv_cls = { "tile": SpaceEdgeConv, "reduced": SpaceEdgeConvReduced }[self.edge_conv_impl]
         for i,(n_dim, n_output) in enumerate(self.conv_params):
-            self.EdgeConv_layers.append(SpaceEdgeConv(n_dim=n_dim, num_outputs=n_output, regu_rate = self.regu_rate, name='EdgeConv_{}'.format(i)))
+            self.EdgeConv_layers.append(edge_conv_cls(n_dim=n_dim, num_outputs=n_output, regu_rate = self.regu_rate, name='EdgeConv_{}'.format(i)))
             self.EdgeConv_bnorm_layers.append(tf.keras.layers.BatchNormalization(name='EdgeConv_bnorm_{}'.format(i)))
             self.EdgeConv_acti_layers.append(tf.keras.layers.Activation("relu", name='EdgeConv_acti_{}'.format(i)))
             if(self.dropout_rate > 0):
@@ -157,8 +186,9 @@ class SpaceParticleNet(tf.keras.Model):
             if(self.dropout_rate > 0):
                 self.dense_dropout_layers.append(tf.keras.layers.Dropout(self.dropout_rate ,name='dropout_dense_{}'.format(i)))
 
+        # output is computed in float32 with mixed precision
         self.dense_out = tf.keras.layers.Dense(self.output_labels, kernel_initializer="he_uniform", activation='sigmoid',
-                                               bias_initializer="he_uniform", name='dense_final')
+                                               bias_initializer="he_uniform", name='dense_final', dtype="float32")
 
     @tf.function
     def call(self, input_):
@@ -198,7 +228,7 @@ class SpaceParticleNet(tf.keras.Model):
 
         return x
 
-def compile_model(model, learning_rate):
+def compile_model(model, learning_rate, jit_compile=False):
 
     opt = tf.keras.optimizers.Nadam(learning_rate=learning_rate, schedule_decay=1e-4)
     # opt = tf.keras.optimizers.Adam(learning_rate = learning_rate)
@@ -206,7 +236,7 @@ def compile_model(model, learning_rate):
     metrics = ["accuracy",
                tf.keras.metrics.BinaryAccuracy(name='BinaryAccuracy'),
                tf.keras.metrics.AUC(name='AUC', curve='ROC')]
-    model.compile(loss='binary_crossentropy', optimizer=opt, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=opt, metrics=metrics, jit_compile=jit_compile)
 
     # log metric names for passing them during model loading
     # metric_names = {(m if isinstance(m, str) else m.__name__): '' for m in metrics}
@@ -225,6 +255,9 @@ def run_training(model, data_loader, to_profile, log_suffix):
     data_val = tf.data.Dataset.from_generator(
         gen_val, output_types = input_types, output_shapes = input_shape
         ).prefetch(tf.data.AUTOTUNE)
+    profiler = TrainingProfiler(lambda: data_loader.active_queues.get(True), data_loader.config["Setup"]["n_tau"],
+                                mlflow.log_metrics)
+    data_train = profiler.instrument_dataset(data_train)
 
     net_setups =  data_loader.config["SetupBaseNN"]
     model_name = net_setups["model_name"]
@@ -235,7 +268,7 @@ def run_training(model, data_loader, to_profile, log_suffix):
         os.remove(csv_log_file)
     csv_log = CSVLogger(csv_log_file, append=True)
     time_checkpoint = TimeCheckpoint(12*60*60, log_name)
-    callbacks = [time_checkpoint, csv_log]
+    callbacks = [time_checkpoint, csv_log, profiler]
 
     logs = log_name + '_' + datetime.now().strftime("%Y.%m.%d(%H:%M)")
     tboard_callback = tf.keras.callbacks.TensorBoard(log_dir = logs,
@@ -284,12 +317,13 @@ def main(cfg: DictConfig) -> None:
         dataloader = DataLoaderReco.DataLoader(training_cfg, scaling_cfg)
 
         dl_config =  dataloader.config
+        setup_mixed_precision(dl_config["SetupBaseNN"])
         model = SpaceParticleNet(dl_config)
         model._name = dl_config["SetupBaseNN"]["model_name"]
         input_shape, _  = dataloader.get_shape()
 
         model.build(list(input_shape[0]))
-        compile_model(model, dl_config["SetupBaseNN"]["learning_rate"])
+        compile_model(model, dl_config["SetupBaseNN"]["learning_rate"], dl_config["SetupBaseNN"].get("jit_compile", False))
         model.summary()
 
         fit_hist = run_training(model, dataloader, False, cfg.log_suffix)
@@ -0,0 +1,87 @@
+import argparse
+parser = argparse.ArgumentParser(description='Benchmark of the EdgeConv (ParticleNet) and SpaceEdgeConv (SNN) implementations.')
+parser.add_argument('--n-tau', required=False, type=int, default=500, help="number of taus in a batch")
+parser.add_argument('--n-features', required=False, type=int, default=50, help="number of input features per pf_Cand")
+parser.add_argument('--K', required=False, type=int, default=16, help="number of neighbours of EdgeConv")
+parser.add_argument('--channels', required=False, type=str, default='50,50,50', help="output channels of EdgeConv")
+parser.add_argument('--n-outputs', required=False, type=int, default=50, help="number of outputs of SpaceEdgeConv")
+parser.add_argument('--block-size', required=False, type=int, default=32, help="knn_block_size of the blocked EdgeConv")
+parser.add_argument('--seq-lengths', required=False, type=str, default='50,100,200', help="list of SequenceLength values")
+parser.add_argument('--n-steps', required=False, type=int, default=20, help="number of timed steps")
+args = parser.parse_args()
+
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+from Training_DisTauTag_ParticleNetv1 import EdgeConv
+from Training_DisTauTag_SNNv1 import SpaceEdgeConv, SpaceEdgeConvReduced
+
+def peak_memory_mb(device):
+    if device is None:
+        return float('nan')
+    return tf.config.experimental.get_memory_info(device)['peak'] / 2**20
+
+def run_step(layer, inputs, kwargs):
+    with tf.GradientTape() as tape:
+        y = layer(*inputs, **kwargs)
+        loss = tf.reduce_sum(tf.square(y))
+    grads = tape.gradient(loss, layer.trainable_weights)
+    return y, grads
+
+def benchmark(layer, inputs, kwargs):
+    y, grads = run_step(layer, inputs, kwargs) # warm-up and tracing
+    if device is not None:
+        tf.config.experimental.reset_memory_stats(device)
+    start = time.time()
+    for _ in range(args.n_steps):
+        y, grads = run_step(layer, inputs, kwargs)
+    _ = y.numpy()
+    step_time = (time.time() - start) / args.n_steps * 1000
+    return step_time, peak_memory_mb(device)
+
+gpus = tf.config.list_physical_devices('GPU')
+device = 'GPU:0' if len(gpus) else None
+rng = np.random.default_rng(12345)
+channels = [ int(c) for c in args.channels.split(',') ]
+
+print("{:>8} {:>14} {:>14} {:>14} {:>16}".format('n_pf', 'impl', 'step time [ms]', 'GPU peak [MB]', 'max |dy| / |y|'))
+for n_pf in [ int(n) for n in args.seq_lengths.split(',') ]:
+    # valid pfCands are stored first, as in the DataLoader
+    n_valid = rng.integers(1, n_pf + 1, size=args.n_tau)
+    mask = (np.arange(n_pf)[np.newaxis, :] < n_valid[:, np.newaxis]).astype(np.float32)
+    x = rng.normal(size=(args.n_tau, n_pf, args.n_features)).astype(np.float32) * mask[:, :, np.newaxis]
+    x, mask = tf.constant(x), tf.constant(mask)
+    coord = x[:, :, -2:]
+    coord_shift = 999. * (1. - tf.expand_dims(mask, axis=-1))
+
+    # EdgeConv: reference with shifted invalid points, outputs are compared for the valid pfCands of the taus
+    # with at least K+1 valid pfCands (for the others the padded pfCands used as neighbours can differ)
+    edge_convs = {
+        'knn_dense'  : (EdgeConv(n_pf, args.K, channels), (coord + coord_shift, x), {}),
+        'knn_masked' : (EdgeConv(n_pf, args.K, channels), (coord, x), { 'mask': mask }),
+        'knn_blocked': (EdgeConv(n_pf, args.K, channels, knn_block_size=args.block_size), (coord, x), { 'mask': mask }),
+    }
+    compare = (mask * tf.cast(tf.expand_dims(n_valid > args.K, axis=-1), tf.float32)).numpy() > 0
+    # SpaceEdgeConv: outputs are compared for all pfCands
+    space_edge_convs = {
+        'snn_tile'   : (SpaceEdgeConv(n_dim=2, num_outputs=args.n_outputs, regu_rate=0), (x,), { 'mask': mask }),
+        'snn_reduced': (SpaceEdgeConvReduced(n_dim=2, num_outputs=args.n_outputs, regu_rate=0), (x,), { 'mask': mask }),
+    }
+
+    for layers, selection in [ (edge_convs, compare), (space_edge_convs, np.ones(mask.shape, dtype=bool)) ]:
+        y_ref = None
+        for impl, (layer, inputs, kwargs) in layers.items():
+            y = layer(*inputs, **kwargs).numpy() # builds the weights
+            if y_ref is None:
+                ref_weights = layer.get_weights()
+            else:
+                layer.set_weights(ref_weights)
+                y = layer(*inputs, **kwargs).numpy()
+            y = y[selection]
+            if y_ref is None:
+                y_ref = y
+            dy = np.abs(y - y_ref).max() / max(np.abs(y_ref).max(), 1e-12)
+            step_time, peak_mem = benchmark(layer, inputs, kwargs)
+            print("{:>8} {:>14} {:>14.2f} {:>14.1f} {:>16.2e}".format(n_pf, impl, step_time, peak_mem, dy))
+    sys.stdout.flush()
@@ -224,12 +224,13 @@ def create_model(net_config, model_name):
     final_dense = reduce_n_features_1d(features_concat, dense_net_setup, 'final')
     output_layer = Dense(net_config.n_outputs, name="final_dense_last",
                          kernel_initializer=dense_net_setup.kernel_init)(final_dense)
-    softmax_output = Activation("softmax", name="main_output")(output_layer)
+    # output is computed in float32 with mixed precision for the numerical stability of the losses
+    softmax_output = Activation("softmax", name="main_output", dtype="float32")(output_layer)
 
     model = Model(input_layers, softmax_output, name=model_name)
     return model
 
-def compile_model(model, opt_name, learning_rate):
+def compile_model(model, opt_name, learning_rate, jit_compile=False):
     # opt = keras.optimizers.Adam(lr=learning_rate)
     opt = getattr(tf.keras.optimizers, opt_name)(learning_rate=learning_rate)
     #opt = tf.keras.optimizers.Nadam(learning_rate=learning_rate, schedule_decay=1e-4)
@@ -243,7 +244,8 @@ def compile_model(model, opt_name, learning_rate):
         TauLosses.Hcat_eInv, TauLosses.Hcat_muInv, TauLosses.Hcat_jetInv,
         TauLosses.Fe, TauLosses.Fmu, TauLosses.Fjet, TauLosses.Fcmb
     ]
-    model.compile(loss=TauLosses.tau_crossentropy_v2, optimizer=opt, metrics=metrics, weighted_metrics=metrics)
+    model.compile(loss=TauLosses.tau_crossentropy_v2, optimizer=opt, metrics=metrics, weighted_metrics=metrics,
+                  jit_compile=jit_compile)
 
     # log metric names for passing them during model loading
     metric_names = {(m if isinstance(m, str) else m.__name__): '' for m in metrics}
@@ -261,6 +263,8 @@ def run_training(model, data_loader, to_profile, log_suffix):
     data_val = tf.data.Dataset.from_generator(
         gen_val, output_types = input_types, output_shapes = input_shape
         ).prefetch(tf.data.AUTOTUNE)
+    profiler = TrainingProfiler(lambda: data_loader.active_queues.get(True), data_loader.batch_size, mlflow.log_metrics)
+    data_train = profiler.instrument_dataset(data_train)
 
     model_name = data_loader.model_name
     log_name = '%s_%s' % (model_name, log_suffix)
@@ -270,7 +274,7 @@ def run_training(model, data_loader, to_profile, log_suffix):
         os.remove(csv_log_file)
     csv_log = CSVLogger(csv_log_file, append=True)
     time_checkpoint = TimeCheckpoint(12*60*60, log_name)
-    callbacks = [time_checkpoint, csv_log]
+    callbacks = [time_checkpoint, csv_log, profiler]
 
     logs = log_name + '_' + datetime.now().strftime("%Y.%m.%d(%H:%M)")
     tboard_callback = tf.keras.callbacks.TensorBoard(log_dir = logs,
@@ -314,12 +318,13 @@ def main(cfg: DictConfig) -> None:
         scaling_cfg = to_absolute_path(cfg.scaling_cfg)
         dataloader = DataLoader.DataLoader(training_cfg, scaling_cfg)
         setup = dataloader.config["SetupNN"]
+        setup_mixed_precision(setup)
         TauLosses.SetSFs(*setup["TauLossesSFs"])
         print("loss consts:",TauLosses.Le_sf, TauLosses.Lmu_sf, TauLosses.Ltau_sf, TauLosses.Ljet_sf)
 
         netConf_full = dataloader.get_net_config()
         model = create_model(netConf_full, dataloader.model_name)
-        compile_model(model, setup["optimizer_name"], setup["learning_rate"])
+        compile_model(model, setup["optimizer_name"], setup["learning_rate"], setup.get("jit_compile", False))
         fit_hist = run_training(model, dataloader, False, cfg.log_suffix)
 
         # log NN params
@@ -65,6 +65,8 @@ class WeightManager:
                                                                index=self.weight_df.index)
 
         self.sum_tau_weights = self.weight_df[self.weight_df.gen_tau == 1].weight.sum()
+        self.hist_file_name = None
+        self.test_tau_indices = {}
 
         gc.collect()
 
@@ -76,6 +78,48 @@ class WeightManager:
         if hist_file_name is not None and os.path.isfile(hist_file_name):
             os.remove(hist_file_name)
 
+    def GetTestTauIndices(self, test_start, n_test):
+        # positions of the genuine taus in the test range, relative to test_start
+        key = (test_start, n_test)
+        if key not in self.test_tau_indices:
+            gen_tau = self.weight_df.gen_tau.values[test_start:test_start+n_test]
+            self.test_tau_indices[key] = np.flatnonzero(gen_tau == 1)
+        return self.test_tau_indices[key]
+
+    def CreateUpdateDataFrame(self, epoch, class_target_eff, thr, sf_results):
+        # one row per (class, pt bin, eta bin), in the order of class_target_eff
+        n_pt_bins, n_eta_bins = len(self.pt_bins) - 1, len(self.eta_bins) - 1
+        n_bins = n_pt_bins * n_eta_bins
+        cl_ids = np.array([ min(match_suffixes.index(cl), 2) for cl, target_eff in class_target_eff ], dtype=int)
+        target_effs = np.array([ target_eff for cl, target_eff in class_target_eff ], dtype=float)
+        cl_idx = np.repeat(cl_ids, n_bins)
+        pt_bin_id = np.tile(np.repeat(np.arange(n_pt_bins), n_eta_bins), len(cl_ids))
+        eta_bin_id = np.tile(np.arange(n_eta_bins), n_pt_bins * len(cl_ids))
+        cl_results = sf_results[cl_ids, :n_pt_bins, :n_eta_bins].reshape(-1, sf_results.shape[-1])
+        return pandas.DataFrame(data = {
+            'epoch': np.full(len(cl_idx), epoch, dtype=int),
+            'cl_idx': cl_idx,
+            'target_eff': np.repeat(target_effs, n_bins),
+            'threashold': thr[cl_idx],
+            'pt_bin_id': pt_bin_id,
+            'eta_bin_id': eta_bin_id,
+            'pt_min': self.pt_bins[pt_bin_id].astype(float),
+            'pt_max': self.pt_bins[pt_bin_id + 1].astype(float),
+            'eta_min': self.eta_bins[eta_bin_id].astype(float),
+            'eta_max': self.eta_bins[eta_bin_id + 1].astype(float),
+            'is_updated': cl_results[:, 0].astype(int),
+            'sf': cl_results[:, 1],
+            'eff': cl_results[:, 2],
+            'eff_err': cl_results[:, 3],
+            'n_taus': cl_results[:, 4].astype(int),
+            'n_passed': cl_results[:, 7],
+        })
+
+    def SaveUpdates(self, df_update):
+        # the history file is opened only for the update, so that it is not locked during the training
+        with pandas.HDFStore(self.hist_file_name, complevel=1, complib='zlib') as hist_store:
+            hist_store.append("weight_updates", df_update)
+
     def SaveWeights(self, weight_file_name):
         self.weight_df.to_hdf(weight_file_name, 'weights', mode='w', format='fixed', complevel=1)
 
@@ -85,31 +129,7 @@ class WeightManager:
                              batch_size = batch_size, verbose=0)
         print("\tpredictions has been calculated.")
 
-        n_bins = self.pteta_bins.shape[0]
-        n_updates = n_bins * len(class_target_eff)
-        df_update = pandas.DataFrame(data ={
-            'epoch': np.ones(n_updates, dtype=int) * epoch,
-            'cl_idx': np.ones(n_updates, dtype=int) * (-1),
-            'target_eff': np.zeros(n_updates),
-            'threashold': np.zeros(n_updates),
-            'pt_bin_id': np.zeros(n_updates, dtype=int),
-            'eta_bin_id': np.zeros(n_updates, dtype=int),
-            'pt_min': np.zeros(n_updates),
-            'pt_max': np.zeros(n_updates),
-            'eta_min': np.zeros(n_updates),
-            'eta_max': np.zeros(n_updates),
-            'is_updated': np.ones(n_updates, dtype=int),
-            'sf': np.ones(n_updates),
-            'eff': np.zeros(n_updates),
-            'eff_err': np.zeros(n_updates),
-            'n_taus': np.zeros(n_updates, dtype=int),
-            'n_passed': np.ones(n_updates),
-        })
-
-        upd_idx = 0
-
-        test_sel = (self.weight_df.index >= test_start) & (self.weight_df.index < test_start + n_test)
-        tau_sel = test_sel & (self.weight_df.gen_tau == 1)
+        tau_indices = self.GetTestTauIndices(test_start, n_test)
 
         thr = np.zeros(3)
         all_target_eff = np.zeros(3)
@@ -117,12 +137,12 @@ class WeightManager:
         for cl, target_eff in class_target_eff:
             br_loc = self.weight_df.columns.get_loc('tau_vs_'+cl)
             cl_idx = match_suffixes.index(cl)
-            tau_vs_cl = TauLosses.tau_vs_other(pred[:, tau], pred[:, cl_idx])
+            tau_vs_cl = np.asarray(TauLosses.tau_vs_other(pred[:, tau], pred[:, cl_idx]))
             self.weight_df.iloc[test_start:test_start+n_test, br_loc] = tau_vs_cl
-            df_tau = self.weight_df[tau_sel]
             cl_idx = min(cl_idx, 2)
-            thr[cl_idx] = np.percentile(df_tau["tau_vs_" + cl], (1 - target_eff) * 100)
-            #thr[cl_idx] = quantile_ex(df_tau["tau_vs_" + cl].values, 1 - target_eff, df_tau.weight.values)
+            thr[cl_idx] = np.percentile(tau_vs_cl[tau_indices], (1 - target_eff) * 100)
+            #thr[cl_idx] = quantile_ex(tau_vs_cl[tau_indices], 1 - target_eff,
+            #                          self.weight_df.weight.values[test_start + tau_indices])
             all_target_eff[cl_idx] = target_eff
 
         sf_results = sf_calc.CalculateScaleFactors(self.pt_bins, self.eta_bins,
@@ -142,37 +162,16 @@ class WeightManager:
                     w_br_loc = self.weight_df.columns.get_loc('weight_' + cl)
                     self.weight_df.iloc[:, w_br_loc] = new_weights[:, cl_idx]
 
+        df_update = self.CreateUpdateDataFrame(epoch, class_target_eff, thr, sf_results)
+        is_updated = df_update.is_updated.values > 0
         for cl, target_eff in class_target_eff:
             cl_idx = min(match_suffixes.index(cl), 2)
-            for pt_bin_id in range(len(self.pt_bins) - 1):
-                for eta_bin_id in range(len(self.eta_bins) - 1):
-                    df_update.loc[upd_idx, 'cl_idx'] = cl_idx
-                    df_update.loc[upd_idx, 'target_eff'] = target_eff
-                    df_update.loc[upd_idx, 'threashold'] = thr[cl_idx]
-                    df_update.loc[upd_idx, 'pt_bin_id'] = pt_bin_id
-                    df_update.loc[upd_idx, 'eta_bin_id'] = eta_bin_id
-                    df_update.loc[upd_idx, 'pt_min'] = self.pt_bins[pt_bin_id]
-                    df_update.loc[upd_idx, 'pt_max'] = self.pt_bins[pt_bin_id+1]
-                    df_update.loc[upd_idx, 'eta_min'] = self.eta_bins[eta_bin_id]
-                    df_update.loc[upd_idx, 'eta_max'] = self.eta_bins[eta_bin_id+1]
-
-                    df_update.loc[upd_idx, 'is_updated'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 0]
-                    df_update.loc[upd_idx, 'sf'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 1]
-                    df_update.loc[upd_idx, 'n_taus'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 4]
-                    df_update.loc[upd_idx, 'n_passed'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 7]
-                    df_update.loc[upd_idx, 'eff'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 2]
-                    df_update.loc[upd_idx, 'eff_err'] = sf_results[cl_idx, pt_bin_id, eta_bin_id, 3]
-
-                    upd_idx += 1
-
-
-            cl_update = df_update[df_update.cl_idx == cl_idx]
-            cl_updated = cl_update[cl_update.is_updated > 0]
-            if cl_updated.shape[0] > 0:
-                average_sf = np.average(cl_updated.sf, weights=cl_updated.n_taus)
+            cl_updated = is_updated & (df_update.cl_idx.values == cl_idx)
+            n_updated = np.count_nonzero(cl_updated)
+            if n_updated > 0:
+                average_sf = np.average(df_update.sf.values[cl_updated], weights=df_update.n_taus.values[cl_updated])
             else:
                 average_sf = 0
-            print('tau_vs_{}: bins changed = {}, average sf = {}'.format(cl, cl_updated.shape[0], average_sf))
+            print('tau_vs_{}: bins changed = {}, average sf = {}'.format(cl, n_updated, average_sf))
         if self.hist_file_name is not None:
-            df_update.to_hdf(self.hist_file_name, "weight_updates", append=True, complevel=1, complib='zlib')
-        gc.collect()
+            self.SaveUpdates(df_update)
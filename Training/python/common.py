@@ -1,5 +1,9 @@
+import os
+import json
 import time
 import gc
+import shutil
+import tempfile
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.callbacks import Callback
@@ -20,29 +24,251 @@ def setup_gpu(gpu_cfg):
         except RuntimeError as e:
             print(e)
 
+def setup_mixed_precision(setup):
+    """Sets the global Keras dtype policy from setup["mixed_precision"]: "float32" (default), "mixed_float16" or
+    "mixed_bfloat16". Must be called before the model is created. Returns the name of the policy."""
+    policy = setup.get("mixed_precision", "float32")
+    tf.keras.mixed_precision.set_global_policy(policy)
+    print("Keras dtype policy:", policy)
+    return policy
+
+def setup_strategy(multi_worker):
+    """Returns the distribution strategy, the index of the worker and the number of workers.
+    For the multi-worker training the cluster is described by the TF_CONFIG environment variable (only "worker" tasks,
+    the worker 0 is the chief). Must be called at the start of the program, before any other TensorFlow operation."""
+    if not multi_worker:
+        return tf.distribute.get_strategy(), 0, 1
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    resolver = strategy.cluster_resolver
+    worker_index = resolver.task_id
+    n_workers = resolver.cluster_spec().num_tasks('worker')
+    print("Multi-worker training: worker {} of {}, {} replicas in sync".format(worker_index, n_workers,
+                                                                               strategy.num_replicas_in_sync))
+    return strategy, worker_index, n_workers
+
+def save_model(model, path, worker_index=0):
+    # with the multi-worker training all workers take part in the saving, only the chief keeps the result
+    if worker_index == 0:
+        model.save(path, save_format="tf")
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='worker{}_'.format(worker_index))
+        model.save(os.path.join(tmp_dir, os.path.basename(path)), save_format="tf")
+        shutil.rmtree(tmp_dir)
+
+tfrecord_cache_index = "cache_index.json"
+tfrecord_codecs = { "NONE": "", "ZLIB": "ZLIB", "GZIP": "GZIP" }
+
+def save_tfrecord_cache(dataset, path, n_batches, n_batches_val=0, n_shards=16, codec="NONE"):
+    """Writes the batches of the dataset into a sharded TFRecord cache: the first n_batches batches (all if -1) go to
+    the "train" split and the next n_batches_val batches to the "val" split. The batches are distributed round-robin over
+    the shards of each split, so that load_tfrecord_cache restores their order. codec is the compression of the records:
+    "NONE", "ZLIB" or "GZIP". The shards of each split and the element spec are listed in cache_index.json."""
+    if codec not in tfrecord_codecs:
+        raise ValueError("Unknown codec {}, supported: {}".format(codec, list(tfrecord_codecs.keys())))
+    def serialize(*elem):
+        return tf.io.serialize_tensor(tf.stack([ tf.io.serialize_tensor(t) for t in tf.nest.flatten(elem) ]))
+    index = {
+        "codec": codec,
+        "element_spec": tf.nest.map_structure(lambda spec: { "dtype": spec.dtype.name, "shape": spec.shape.as_list() },
+                                              dataset.element_spec),
+        "splits": {},
+    }
+    options = tf.io.TFRecordOptions(compression_type=tfrecord_codecs[codec])
+    os.makedirs(path, exist_ok=True)
+    records = iter(dataset.map(serialize, num_parallel_calls=tf.data.AUTOTUNE))
+    for split, n_split in [ ("train", n_batches), ("val", n_batches_val) ]:
+        if n_split == 0: continue
+        shards = [ "{}-{:05d}-of-{:05d}.tfrecord".format(split, i, n_shards) for i in range(n_shards) ]
+        writers = [ tf.io.TFRecordWriter(os.path.join(path, shard), options) for shard in shards ]
+        n_written = 0
+        for record in records:
+            writers[n_written % n_shards].write(record.numpy())
+            n_written += 1
+            if n_written == n_split: break
+        for writer in writers:
+            writer.close()
+        index["splits"][split] = { "shards": shards, "n_batches": n_written }
+        print("{} batches are written into the {} split".format(n_written, split))
+    # the index is written last: a cache without it is incomplete
+    with open(os.path.join(path, tfrecord_cache_index), 'w') as f:
+        json.dump(index, f, indent=2)
+
+def is_tfrecord_cache(path):
+    return os.path.isfile(os.path.join(path, tfrecord_cache_index))
+
+def load_tfrecord_cache(path, split, worker_index=0, n_workers=1):
+    """Reads a split ("train" or "val") of the cache written by save_tfrecord_cache. The shards are read with
+    a parallel interleave, which keeps the order of the batches. With n_workers > 1 each worker reads a disjoint
+    subset of the shards."""
+    with open(os.path.join(path, tfrecord_cache_index)) as f:
+        index = json.load(f)
+    if split not in index["splits"]:
+        raise RuntimeError("Split '{}' is not found in the cache {}".format(split, path))
+    shards = index["splits"][split]["shards"]
+    if n_workers > 1:
+        if len(shards) < n_workers:
+            raise RuntimeError("The cache {} has less shards than workers.".format(path))
+        shards = shards[worker_index::n_workers]
+    def to_spec(obj):
+        if isinstance(obj, dict):
+            return tf.TensorSpec(obj["shape"], obj["dtype"])
+        return tuple(to_spec(o) for o in obj)
+    element_spec = to_spec(index["element_spec"])
+    flat_spec = tf.nest.flatten(element_spec)
+    def parse(record):
+        flat = tf.io.parse_tensor(record, tf.string)
+        return tf.nest.pack_sequence_as(element_spec,
+            [ tf.ensure_shape(tf.io.parse_tensor(flat[i], spec.dtype), spec.shape) for i, spec in enumerate(flat_spec) ])
+    compression_type = tfrecord_codecs[index["codec"]]
+    files = tf.data.Dataset.from_tensor_slices([ os.path.join(path, shard) for shard in shards ])
+    ds = files.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=compression_type),
+                          cycle_length=len(shards), block_length=1,
+                          num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    return ds.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+
+def scale_loss(optimizer, loss):
+    # loss scaling is applied only if the optimizer is wrapped into LossScaleOptimizer (mixed_float16)
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_scaled_loss(loss)
+    return loss
+
+def unscale_gradients(optimizer, grads):
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_unscaled_gradients(grads)
+    return grads
 
 class TimeCheckpoint(Callback):
-    def __init__(self, time_interval, file_name_prefix):
+    def __init__(self, time_interval, file_name_prefix, worker_index=0):
         self.time_interval = time_interval
         self.file_name_prefix = file_name_prefix
+        self.worker_index = worker_index
         self.initial_time = time.time()
         self.last_check_time = self.initial_time
 
+    def time_since_last_check(self, current_time):
+        delta_t = current_time - self.last_check_time
+        strategy = self.model.distribute_strategy
+        if strategy.num_replicas_in_sync == 1:
+            return delta_t
+        # all workers have to take the same decision, as all of them take part in the saving: the time of the chief is used.
+        # It is the maximum over all replicas (tf.distribute.ReduceOp has no MAX, hence all_gather + reduce_max),
+        # which does not depend on the number of replicas on each worker, unlike a SUM
+        delta_t = tf.constant([delta_t if self.worker_index == 0 else 0.])
+        delta_t = strategy.run(lambda: tf.reduce_max(tf.distribute.get_replica_context().all_gather(delta_t, axis=0)))
+        return float(strategy.experimental_local_results(delta_t)[0])
+
     def on_batch_end(self, batch, logs=None):
         if self.time_interval is None or batch % 100 != 0: return
         current_time = time.time()
-        delta_t = current_time - self.last_check_time
+        delta_t = self.time_since_last_check(current_time)
         if delta_t >= self.time_interval:
             abs_delta_t_h = (current_time - self.initial_time) / 60. / 60.
-            self.model.save('{}_historic_b{}_{:.1f}h.tf'.format(self.file_name_prefix, batch, abs_delta_t_h),
-                            save_format="tf")
+            save_model(self.model, '{}_historic_b{}_{:.1f}h.tf'.format(self.file_name_prefix, batch, abs_delta_t_h),
+                       self.worker_index)
             self.last_check_time = current_time
 
     def on_epoch_end(self, epoch, logs=None):
-        self.model.save('{}_e{}.tf'.format(self.file_name_prefix, epoch),
-                        save_format="tf")
+        save_model(self.model, '{}_e{}.tf'.format(self.file_name_prefix, epoch), self.worker_index)
         print("Epoch {} is ended.".format(epoch))
 
+def host_rss_mb():
+    """Resident memory of this process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 # peak RSS (in kB on Linux)
+
+class TrainingProfiler(Callback):
+    """Tells whether the training is bound by the input pipeline or by the model.
+    The training dataset should be wrapped with instrument_dataset(), which records the moment each batch leaves
+    the tf.data pipeline: the time from the start of the step until then is the time waiting for the input,
+    the rest of the step is the compute. Additionally the depth of the loader queue (QueueEx returned by
+    get_queue), the throughput of the loader workers and the host RSS are monitored.
+    At the end of each epoch a summary is printed and passed to log_metrics (e.g. mlflow.log_metrics).
+    The first step of the training (tracing of the train function) is not counted."""
+    def __init__(self, get_queue=None, loader_batch_size=None, log_metrics=None, prefix='profiler'):
+        self.get_queue = get_queue
+        self.loader_batch_size = loader_batch_size
+        self.log_metrics = log_metrics
+        self.prefix = prefix
+        self.is_first_step = True
+        self.batch_ready_time = None
+        self.n_taus = 0
+
+    def instrument_dataset(self, dataset):
+        def record_batch(n_taus):
+            self.batch_ready_time = time.time()
+            self.n_taus += int(n_taus)
+            return n_taus
+        def instrument(*elem):
+            n_taus = tf.shape(tf.nest.flatten(elem)[0])[0]
+            with tf.control_dependencies([tf.py_function(record_batch, [n_taus], tf.int32)]):
+                return tf.nest.map_structure(tf.identity, elem)
+        # the map is sequential and comes after the prefetch: it is executed when the train step requests the batch
+        return dataset.map(instrument)
+
+    def queue_stats(self):
+        queue = self.get_queue() if self.get_queue is not None else None
+        if queue is None:
+            return None, None
+        return queue, queue.mp_queue.qsize()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.step_times, self.wait_times, self.queue_depths = [], [], []
+        self.n_taus, self.n_taus_counted = 0, 0
+        self.queue, self.n_puts_begin = None, 0
+        self.epoch_start_time = time.time()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_ready_time = None
+        self.step_start_time = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        # logs are converted to numpy for this callback, so that the step is finished at this point
+        step_end_time = time.time()
+        if self.is_first_step:
+            self.is_first_step = False
+            self.n_taus_counted = self.n_taus
+            self.epoch_start_time = step_end_time
+        else:
+            ready_time = self.batch_ready_time if self.batch_ready_time is not None else self.step_start_time
+            self.step_times.append(step_end_time - self.step_start_time)
+            self.wait_times.append(max(ready_time - self.step_start_time, 0.))
+        queue, depth = self.queue_stats()
+        if queue is not None:
+            if queue is not self.queue: # a new generator was started
+                self.queue, self.n_puts_begin, self.n_puts_time = queue, queue.n_puts.value, step_end_time
+            self.queue_depths.append(depth)
+        self.last_step_end_time = step_end_time
+
+    def on_epoch_end(self, epoch, logs=None):
+        if len(self.step_times) == 0: return
+        step_times, wait_times = np.array(self.step_times), np.array(self.wait_times)
+        train_time = self.last_step_end_time - self.epoch_start_time
+        summary = {
+            'step_time_ms': 1e3 * np.mean(step_times),
+            'input_wait_ms': 1e3 * np.mean(wait_times),
+            'compute_ms': 1e3 * np.mean(step_times - wait_times),
+            'input_wait_frac': np.sum(wait_times) / np.sum(step_times),
+            'taus_per_s': (self.n_taus - self.n_taus_counted) / train_time if train_time > 0 else 0.,
+            'host_rss_mb': host_rss_mb(),
+        }
+        if len(self.queue_depths) > 0:
+            queue_depths = np.array(self.queue_depths)
+            summary['queue_depth_mean'] = np.mean(queue_depths)
+            summary['queue_empty_frac'] = np.mean(queue_depths == 0)
+            loader_time = self.last_step_end_time - self.n_puts_time
+            if self.loader_batch_size is not None and loader_time > 0:
+                n_puts = self.queue.n_puts.value - self.n_puts_begin
+                summary['loader_taus_per_s'] = n_puts * self.loader_batch_size / loader_time
+        summary = { '{}_{}'.format(self.prefix, name): float(value) for name, value in summary.items() }
+        print("Epoch {} profile: ".format(epoch) + ", ".join("{}={:.4g}".format(name, value)
+                                                             for name, value in summary.items()))
+        if self.log_metrics is not None:
+            self.log_metrics(summary, step=epoch)
+
 def close_file(f_name):
     file_objs = [ obj for obj in gc.get_objects() if ("TextIOWrapper" in str(type(obj))) and (obj.name == f_name)]
     for obj in file_objs:
@@ -64,6 +290,13 @@ class TauLosses:
     Ljet_sf = 1
     epsilon = 1e-7
     merge_thr = 0.1
+    # minimal epsilon for the lower precision dtypes, such that 1 - epsilon < 1
+    low_precision_epsilon = { tf.float16: 2 ** -11, tf.bfloat16: 2 ** -8 }
+
+    @staticmethod
+    def Epsilon(dtype):
+        dtype = dtype.base_dtype
+        return tf.constant(max(TauLosses.epsilon, TauLosses.low_precision_epsilon.get(dtype, 0)), dtype)
 
     @staticmethod
     @tf.function
@@ -77,7 +310,7 @@ class TauLosses:
     @staticmethod
     @tf.function
     def Lbase(target, output, genuine_index, fake_index):
-        epsilon = tf.constant(TauLosses.epsilon, output.dtype.base_dtype)
+        epsilon = TauLosses.Epsilon(output.dtype)
         genuine_vs_fake = output[:, genuine_index] / (output[:, genuine_index] + output[:, fake_index] + epsilon)
         genuine_vs_fake = tf.clip_by_value(genuine_vs_fake, epsilon, 1 - epsilon)
         loss = -target[:, genuine_index] * tf.math.log(genuine_vs_fake) - target[:, fake_index] * tf.math.log(1 - genuine_vs_fake)
@@ -86,7 +319,7 @@ class TauLosses:
     @staticmethod
     @tf.function
     def Hbase(target, output, index, inverse):
-        epsilon = tf.constant(TauLosses.epsilon, output.dtype.base_dtype)
+        epsilon = TauLosses.Epsilon(output.dtype)
         x = tf.clip_by_value(output[:, index], epsilon, 1 - epsilon)
         if inverse:
             return - (1 - target[:, index]) * tf.math.log(1 - x)
@@ -98,13 +331,41 @@ class TauLosses:
         decay_factor = (tf.math.tanh(70 * (output[:, tau] - 0.1)) + 1) / 2 if apply_decay else 1
         if gamma <= 0:
             raise RuntimeError("Focal Loss requires gamma > 0.")
-        epsilon = tf.constant(TauLosses.epsilon, output.dtype.base_dtype)
+        epsilon = TauLosses.Epsilon(output.dtype)
         gamma_t = tf.constant(gamma, output.dtype.base_dtype)
         x = tf.clip_by_value(output[:, index], epsilon, 1 - epsilon)
         if inverse:
             return - decay_factor * (1 - target[:, index]) * tf.pow(x, gamma_t) * tf.math.log(1 - x)
         return - decay_factor * target[:, index] * tf.pow(1-x, gamma_t) * tf.math.log(x)
 
+    @staticmethod
+    @tf.function
+    def Lterms(target, output):
+        # Lbase of tau vs each output in one pass: [batch, 4], the tau column is set to 0
+        dtype = output.dtype.base_dtype
+        epsilon = TauLosses.Epsilon(dtype)
+        genuine = output[:, tau:tau+1]
+        genuine_vs_fake = genuine / (genuine + output + epsilon)
+        genuine_vs_fake = tf.clip_by_value(genuine_vs_fake, epsilon, 1 - epsilon)
+        loss = - target[:, tau:tau+1] * tf.math.log(genuine_vs_fake) - target * tf.math.log(1 - genuine_vs_fake)
+        return loss * tf.constant([ float(i != tau) for i in range(4) ], dtype)
+
+    @staticmethod
+    @tf.function
+    def Fterms(target, output):
+        # Fe, Fmu, Fcmb and Fjet (with their factors) in one pass: [batch, 4], in the order of the outputs
+        dtype = output.dtype.base_dtype
+        epsilon = TauLosses.Epsilon(dtype)
+        x = tf.clip_by_value(output, epsilon, 1 - epsilon)
+        # Fe, Fmu, Fjet: gamma = 2 with decay
+        decay_factor = (tf.math.tanh(70 * (output[:, tau:tau+1] - 0.1)) + 1) / 2
+        F_factor = tf.constant([ 0 if i == tau else 1.63636 for i in range(4) ], dtype)
+        loss = - F_factor * decay_factor * target * tf.math.square(1 - x) * tf.math.log(x)
+        # Fcmb: inverse, gamma = 0.5 without decay
+        x_tau = x[:, tau:tau+1]
+        loss_cmb = - 1.17153 * (1 - target[:, tau:tau+1]) * tf.math.sqrt(x_tau) * tf.math.log(1 - x_tau)
+        return loss + loss_cmb * tf.constant([ float(i == tau) for i in range(4) ], dtype)
+
     @staticmethod
     @tf.function
     def Le(target, output):
@@ -228,17 +489,19 @@ class TauLosses:
     @staticmethod
     @tf.function
     def tau_crossentropy(target, output):
-        return TauLosses.sLe(target, output) + TauLosses.sLmu(target, output) + TauLosses.sLjet(target, output)
+        sf = tf.constant([TauLosses.Le_sf, TauLosses.Lmu_sf, 0, TauLosses.Ljet_sf], dtype=output.dtype.base_dtype)
+        return tf.reduce_sum(sf * TauLosses.Lterms(target, output), axis=1)
 
     @staticmethod
     @tf.function
     def tau_crossentropy_v2(target, output):
-        F_factor = tf.constant(5, dtype=output.dtype.base_dtype)
-        sf = tf.constant([TauLosses.Le_sf, TauLosses.Lmu_sf, TauLosses.Ltau_sf, TauLosses.Ljet_sf],
-                         dtype=output.dtype.base_dtype)
-        return sf[tau] * TauLosses.Htau(target, output) + (sf[e] + sf[mu] + sf[jet]) * TauLosses.Fcmb(target, output) \
-               + F_factor * (sf[e] * TauLosses.Fe(target, output) + sf[mu] * TauLosses.Fmu(target, output) \
-                             + sf[jet] * TauLosses.Fjet(target, output))
+        F_factor = 5
+        sf_e, sf_mu, sf_tau, sf_jet = TauLosses.Le_sf, TauLosses.Lmu_sf, TauLosses.Ltau_sf, TauLosses.Ljet_sf
+        # weights of Fe, Fmu, Fcmb and Fjet
+        sf_F = tf.constant([F_factor * sf_e, F_factor * sf_mu, sf_e + sf_mu + sf_jet, F_factor * sf_jet],
+                           dtype=output.dtype.base_dtype)
+        return tf.constant(sf_tau, dtype=output.dtype.base_dtype) * TauLosses.Htau(target, output) \
+               + tf.reduce_sum(sf_F * TauLosses.Fterms(target, output), axis=1)
 
     @staticmethod
     @tf.function
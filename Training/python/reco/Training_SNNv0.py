@@ -29,7 +29,7 @@ from omegaconf import DictConfig, OmegaConf
 
 sys.path.insert(0, "..")
 from commonReco import *
-from common import setup_gpu
+from common import setup_gpu, setup_mixed_precision, TrainingProfiler
 import DataLoaderReco
 
 class MyGNNLayer(tf.keras.layers.Layer):
@@ -85,7 +85,7 @@ class MyGNNLayer(tf.keras.layers.Layer):
         w = tf.math.exp(-10*na[:,:,:,-1]) # weights
         w_shape = tf.shape(w)
         w    = tf.reshape(w,(w_shape[0],w_shape[1],w_shape[2],1)) # needed for multiplication
-        mask = tf.reshape(mask, (w_shape[0],w_shape[1],1)) # needed for multiplication
+        mask = tf.reshape(tf.cast(mask, x.dtype), (w_shape[0],w_shape[1],1)) # needed for multiplication
         ## copies of mask:
         rep  = tf.stack([1,w_shape[1],1])
         mask_copy = tf.tile(mask, rep)
@@ -94,7 +94,7 @@ class MyGNNLayer(tf.keras.layers.Layer):
         s = na * w * mask_copy # weighted na
         ss = tf.math.reduce_sum(s, axis = 1) # weighted sum of features
         # ss = [n_tau, n_pf, features+1]
-        self_dist = tf.zeros((x_shape[0], x_shape[1], 1))
+        self_dist = tf.zeros((x_shape[0], x_shape[1], 1), dtype=x.dtype)
         xx = tf.concat([x, self_dist], axis = 2) # [n_tau, n_pf, features+1]
         ss = ss - xx # difference between weighted features and original ones
         x = tf.concat((x, ss), axis = 2) # add to original features
@@ -109,6 +109,35 @@ class MyGNNLayer(tf.keras.layers.Layer):
 
         return output
 
+class MyGNNLayerReduced(MyGNNLayer):
+    """
+    Same output and weights as MyGNNLayer, without building the [n_tau, n_pf, n_pf, features] copies of the input.
+    In MyGNNLayer the features of each pf_Cand j are multiplied by the weights w_ij = exp(-10*d_ij) and summed over
+    the other pf_Cands i, which is equivalent to scaling the features of j by the column sum of the [n_pf, n_pf]
+    weight matrix. Only [n_tau, n_pf, n_pf] tensors are needed for the weights and distances.
+    """
+
+    @tf.function
+    def call(self, x, mask):
+        ### Compute distances: dist[n_tau, pf_others, pf]
+        coord = x[:, :, -self.n_dim:]
+        diff  = tf.expand_dims(coord, axis=1) - tf.expand_dims(coord, axis=2)
+        dist  = tf.math.reduce_sum(tf.math.square(diff), axis=-1)
+
+        ### Weighted sum of features:
+        w = tf.math.exp(-10*dist) # weights
+        mask = tf.expand_dims(tf.cast(mask, x.dtype), axis=-1) # [n_tau, n_pf, 1]
+        w_sum    = tf.expand_dims(tf.math.reduce_sum(w, axis=1), axis=-1) * mask
+        dist_sum = tf.expand_dims(tf.math.reduce_sum(w * dist, axis=1), axis=-1) * mask
+        ss = tf.concat([x * w_sum - x, dist_sum], axis=2) # difference between weighted features and original ones
+        x = tf.concat((x, ss), axis=2) # add to original features
+
+        ### Ax+b:
+        output = tf.matmul(x, self.A) + self.b
+        output = output * mask # reapply mask to be sure
+
+        return output
+
 class MyGNN(tf.keras.Model):
 
     def __init__(self, dl_config):
@@ -117,6 +146,9 @@ class MyGNN(tf.keras.Model):
         self.map_features = dl_config["input_map"]["PfCand"]
 
         self.mode = dl_config["SetupNN"]["mode"]
+        if "p4" in self.mode and tf.keras.mixed_precision.global_policy().compute_dtype == "float16":
+            raise RuntimeError('The "p4" modes sum the unscaled pfCand momenta, which overflow float16, '
+                               'use "mixed_bfloat16" instead.')
 
         self.n_gnn_layers      = dl_config["SetupNN"]["n_gnn_layers"]
         self.n_dim_gnn         = dl_config["SetupNN"]["n_dim_gnn"]
@@ -127,6 +159,7 @@ class MyGNN(tf.keras.Model):
         self.wiring_mode       = dl_config["SetupNN"]["wiring_mode"]
         self.dropout_rate      = dl_config["SetupNN"]["dropout_rate"]
         self.regu_rate         = dl_config["SetupNN"]["regu_rate"]
+        self.gnn_layer_impl    = dl_config["SetupNN"].get("gnn_layer_impl", "tile")
         self.embedding_n       = dl_config["n_features"]["PfCandCategorical"]
         self.embedding         = self.embedding_n * [None]
 
@@ -152,8 +185,9 @@ class MyGNN(tf.keras.Model):
                 tf.keras.layers.Embedding(dl_config['embedded_param']['PfCandCategorical'][var][0],
                                           dl_config['embedded_param']['PfCandCategorical'][var][1])
 
+        gnn_layer_cls = { "tile": MyGNNLayer, "reduced": MyGNNLayerReduced }[self.gnn_layer_impl]
         for i in range(self.n_gnn_layers):
-            self.GNN_layers.append(MyGNNLayer(n_dim=list_n_dim[i], num_outputs=list_outputs[i], regu_rate = self.regu_rate, name='GNN_layer_{}'.format(i)))
+            self.GNN_layers.append(gnn_layer_cls(n_dim=list_n_dim[i], num_outputs=list_outputs[i], regu_rate = self.regu_rate, name='GNN_layer_{}'.format(i)))
             self.batch_norm.append(tf.keras.layers.BatchNormalization(name='batch_normalization_{}'.format(i)))
             self.acti_gnn.append(tf.keras.layers.Activation("tanh", name='acti_gnn_{}'.format(i)))
             if(self.dropout_rate > 0):
@@ -177,8 +211,9 @@ class MyGNN(tf.keras.Model):
         #                         bias_initializer="he_uniform", activation="softmax", name='dense_dm')
         # self.dense_p4 = tf.keras.layers.Dense(2, kernel_initializer="he_uniform",
         #                         bias_initializer="he_uniform", name='dense_p4')
+        # output is computed in float32 with mixed precision
         self.dense2 = tf.keras.layers.Dense(n_last, kernel_initializer="he_uniform",
-                                bias_initializer="he_uniform", name='dense2')
+                                bias_initializer="he_uniform", name='dense2', dtype="float32")
 
     @tf.function
     def call(self, input_):
@@ -263,7 +298,7 @@ class MyGNN(tf.keras.Model):
         
         x = self.dense2(x)
 
-        x_zeros = tf.zeros((x_shape[0], 2))
+        x_zeros = tf.zeros((x_shape[0], 2), dtype=x.dtype)
         if(self.mode == "dm"):
             xout = tf.concat([x, x_zeros], axis=1)
         elif self.mode == "p4":
@@ -291,7 +326,7 @@ class MyGNN(tf.keras.Model):
 
         return tf.stack([mypt,mymass], axis=1)
 
-def compile_model(model, mode, learning_rate):
+def compile_model(model, mode, learning_rate, jit_compile=False):
     # opt = tf.keras.optimizers.Nadam(learning_rate=learning_rate, beta_1=1e-4)
     opt = tf.keras.optimizers.Nadam(learning_rate=learning_rate, schedule_decay=1e-4)
     # opt = tf.keras.optimizers.Adam(learning_rate = learning_rate)
@@ -301,7 +336,7 @@ def compile_model(model, mode, learning_rate):
         metrics.extend([my_acc, my_mse_ch, my_mse_neu])
     if "p4" in mode:
         metrics.extend([my_mse_pt, my_mse_mass, pt_res, pt_res_rel, m2_res])
-    model.compile(loss=CustomMSE(), optimizer=opt, metrics=metrics)
+    model.compile(loss=CustomMSE(), optimizer=opt, metrics=metrics, jit_compile=jit_compile)
     
     # log metric names for passing them during model loading
     metric_names = {(m if isinstance(m, str) else m.__name__): '' for m in metrics}
@@ -320,6 +355,9 @@ def run_training(model, data_loader, to_profile, log_suffix):
     data_val = tf.data.Dataset.from_generator(
         gen_val, output_types = input_types, output_shapes = input_shape
         ).prefetch(tf.data.AUTOTUNE)
+    profiler = TrainingProfiler(lambda: data_loader.active_queues.get(True), data_loader.config["Setup"]["n_tau"],
+                                mlflow.log_metrics)
+    data_train = profiler.instrument_dataset(data_train)
 
     net_setups =  data_loader.config["SetupNN"]
     model_name = net_setups["model_name"]
@@ -330,7 +368,7 @@ def run_training(model, data_loader, to_profile, log_suffix):
         os.remove(csv_log_file)
     csv_log = CSVLogger(csv_log_file, append=True)
     time_checkpoint = TimeCheckpoint(12*60*60, log_name)
-    callbacks = [time_checkpoint, csv_log]
+    callbacks = [time_checkpoint, csv_log, profiler]
 
     logs = log_name + '_' + datetime.now().strftime("%Y.%m.%d(%H:%M)")
     tboard_callback = tf.keras.callbacks.TensorBoard(log_dir = logs,
@@ -373,12 +411,14 @@ def main(cfg: DictConfig) -> None:
         dataloader = DataLoaderReco.DataLoader(training_cfg, scaling_cfg)
 
         dl_config =  dataloader.config
+        setup_mixed_precision(dl_config["SetupNN"])
         model = model = MyGNN(dl_config)
         input_shape, _  = dataloader.get_shape()
         # print(input_shape[0])
         # compile_build = tf.ones(input_shape[0], dtype=tf.float32, name=None)
         model.build(list(input_shape[0]))
-        compile_model(model, dl_config["SetupNN"]["mode"], dl_config["SetupNN"]["learning_rate"])
+        compile_model(model, dl_config["SetupNN"]["mode"], dl_config["SetupNN"]["learning_rate"],
+                      dl_config["SetupNN"].get("jit_compile", False))
         fit_hist = run_training(model, dataloader, False, cfg.log_suffix)
 
         mlflow.log_dict(training_cfg, 'input_cfg/training_cfg.yaml')
@@ -0,0 +1,68 @@
+import argparse
+parser = argparse.ArgumentParser(description='Benchmark of MyGNNLayer implementations (step time, memory, output difference).')
+parser.add_argument('--n-tau', required=False, type=int, default=500, help="number of taus in a batch")
+parser.add_argument('--n-features', required=False, type=int, default=50, help="number of input features per pf_Cand")
+parser.add_argument('--n-outputs', required=False, type=int, default=50, help="number of outputs of the layer")
+parser.add_argument('--n-dim', required=False, type=int, default=2, help="number of coordinates used for the distance")
+parser.add_argument('--seq-lengths', required=False, type=str, default='50,100,200', help="list of SequenceLength values")
+parser.add_argument('--n-steps', required=False, type=int, default=20, help="number of timed steps")
+args = parser.parse_args()
+
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+from Training_SNNv0 import MyGNNLayer, MyGNNLayerReduced
+
+def peak_memory_mb(device):
+    if device is None:
+        return float('nan')
+    return tf.config.experimental.get_memory_info(device)['peak'] / 2**20
+
+def largest_tensor_mb(impl, n_tau, n_pf, n_features, n_dim):
+    # float32 size of the largest intermediate tensor of the forward pass
+    n_last = n_features + 1 if impl == 'tile' else n_dim
+    return n_tau * n_pf * n_pf * n_last * 4 / 2**20
+
+def run_step(layer, x, mask):
+    with tf.GradientTape() as tape:
+        y = layer(x, mask=mask)
+        loss = tf.reduce_sum(tf.square(y))
+    grads = tape.gradient(loss, layer.trainable_weights)
+    return y, grads
+
+gpus = tf.config.list_physical_devices('GPU')
+device = 'GPU:0' if len(gpus) else None
+rng = np.random.default_rng(12345)
+
+print("{:>8} {:>10} {:>14} {:>14} {:>18} {:>16} {:>16}".format('n_pf', 'impl', 'step time [ms]', 'GPU peak [MB]',
+                                                                'largest tensor [MB]', 'max |dy| / |y|', 'max |dg| / |g|'))
+for n_pf in [ int(n) for n in args.seq_lengths.split(',') ]:
+    x = tf.constant(rng.normal(size=(args.n_tau, n_pf, args.n_features)).astype(np.float32))
+    mask = tf.constant((rng.random((args.n_tau, n_pf)) > 0.3).astype(np.float32))
+    layers = { 'tile': MyGNNLayer(n_dim=args.n_dim, num_outputs=args.n_outputs, regu_rate=-1),
+               'reduced': MyGNNLayerReduced(n_dim=args.n_dim, num_outputs=args.n_outputs, regu_rate=-1) }
+    for layer in layers.values():
+        layer(x, mask=mask) # builds the weights
+    layers['reduced'].set_weights(layers['tile'].get_weights())
+
+    results = {}
+    for impl, layer in layers.items():
+        y, grads = run_step(layer, x, mask) # warm-up and tracing
+        if device is not None:
+            tf.config.experimental.reset_memory_stats(device)
+        start = time.time()
+        for _ in range(args.n_steps):
+            y, grads = run_step(layer, x, mask)
+        _ = y.numpy()
+        step_time = (time.time() - start) / args.n_steps * 1000
+        results[impl] = (y.numpy(), [g.numpy() for g in grads], step_time, peak_memory_mb(device))
+
+    y_ref, grads_ref = results['tile'][0], results['tile'][1]
+    for impl, (y, grads, step_time, peak_mem) in results.items():
+        dy = np.abs(y - y_ref).max() / max(np.abs(y_ref).max(), 1e-12)
+        dgrad = max(np.abs(g - g_ref).max() / max(np.abs(g_ref).max(), 1e-12) for g, g_ref in zip(grads, grads_ref))
+        tensor_mem = largest_tensor_mb(impl, args.n_tau, n_pf, args.n_features, args.n_dim)
+        print("{:>8} {:>10} {:>14.2f} {:>14.1f} {:>18.1f} {:>16.2e} {:>16.2e}".format(n_pf, impl, step_time, peak_mem,
+                                                                                  tensor_mem, dy, dgrad))
+    sys.stdout.flush()